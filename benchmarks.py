@@ -0,0 +1,360 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import gc
+import logging
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import differential
+from session_utils import CompactPageviews, CompactSession, PageviewVocab
+from session_utils import Pageview, Session
+
+PROJECTS = ['enwiki', 'eswiki', 'dewiki', 'frwiki', 'jawiki', 'ruwiki', 'itwiki', 'zhwiki']
+REFERERS = PROJECTS + ['google', 'bing.com', 'duckduckgo.com', '']
+
+def random_pageviews(num_pvs, num_items=100000, seed=0):
+    """Generate synthetic page views with realistic field shapes (fresh strings like the TSV parser produces)."""
+    rand = random.Random(seed)
+    for i in range(num_pvs):
+        qid = rand.randrange(1, num_items)
+        yield Pageview('2019-02-16T{0:02d}:{1:02d}:{2:02d}'.format(i // 3600 % 24, i // 60 % 60, i % 60),
+                       ''.join(rand.choice(PROJECTS)),
+                       'Article_{0}'.format(qid),
+                       'Q{0}'.format(qid),
+                       ''.join(rand.choice(REFERERS)))
+
+def build_sessions(num_pvs, pvs_per_session, compact):
+    sessions = []
+    pvs = random_pageviews(num_pvs)
+    # sessions of one scan share a vocabulary, as in tsv_to_sessions(compact=True)
+    vocab = PageviewVocab()
+    for s in range(0, num_pvs, pvs_per_session):
+        session_pvs = [next(pvs) for _ in range(min(pvs_per_session, num_pvs - s))]
+        if compact:
+            sessions.append(CompactSession('{0:0128x}'.format(s), 'Norway', CompactPageviews(session_pvs, vocab),
+                                           'reader'))
+        else:
+            sessions.append(Session('{0:0128x}'.format(s), 'Norway', session_pvs, 'reader'))
+    return sessions
+
+def bench_session_memory(args):
+    """Compare memory (bytes per page view) of Session/Pageview lists vs. CompactSession."""
+    for compact in (False, True):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        sessions = build_sessions(args.num_pvs, args.pvs_per_session, compact)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logging.info("{0}:\t{1:.1f} MB per million pageviews ({2:.1f} bytes/pv; peak {3:.1f} MB); built in {4:.2f}s.".format(
+            'CompactSession' if compact else 'Session', current / args.num_pvs, current / args.num_pvs,
+            peak / 1e6, elapsed))
+        del sessions
+
+def bench_title_country_counts(args):
+    """Memory of per-(title, country) page view counts: dict of dicts vs. interned ids in a SortedCounter."""
+    from lda_predictive_model import COUNTRY_BITS, SortedCounter
+    from session_utils import Vocab
+
+    countries = ['Country_{0}'.format(i) for i in range(200)]
+    rand = random.Random(0)
+    # heavy-tailed article popularity: a few very popular articles and many rarely viewed ones
+    pairs = [('Article_{0}'.format(int(rand.paretovariate(0.3)) % 3000000), rand.choice(countries))
+             for _ in range(args.num_pvs)]
+    for packed in (False, True):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        if packed:
+            titles, country_ids, counts = Vocab(), Vocab(), SortedCounter()
+            for title, country in pairs:
+                counts.add((titles.id(title) << COUNTRY_BITS) | country_ids.id(country))
+            counts.flush()
+        else:
+            counts = {}
+            for title, country in pairs:
+                if title not in counts:
+                    counts[title] = {}
+                counts[title][country] = counts[title].get(country, 0) + 1
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logging.info("{0}:\t{1:.1f} MB (peak {2:.1f} MB); counted in {3:.2f}s.".format(
+            'Vocab + SortedCounter' if packed else 'dict of dicts', current / 1e6, peak / 1e6, elapsed))
+        del counts
+
+def write_synthetic_lda(lda_dir, lang, num_titles, ndims, seed=0):
+    """Write an LDA topic model in the format read by lda_predictive_model.load_topic_model."""
+    rand = random.Random(seed)
+    titles = ['Article {0}'.format(i) for i in range(num_titles)]
+    with open(os.path.join(lda_dir, '{0}_titles.p'.format(lang)), 'wb') as fout:
+        pickle.dump(titles, fout)
+    with open(os.path.join(lda_dir, '{0}_lda_features.csv'.format(lang)), 'w') as fout:
+        for title in titles:
+            fout.write('\t'.join([title] + ['{0:.6f}'.format(rand.random()) for _ in range(ndims)]) + '\n')
+    with open(os.path.join(lda_dir, '{0}_overview.txt'.format(lang)), 'w') as fout:
+        for i in range(ndims):
+            fout.write('Topic {0}\nTop words: word_{0} other_{0}\n'.format(i))
+
+def memory_status():
+    """Resident memory of this process in MB: total, private (anonymous) and file-backed (shareable) pages."""
+    status = {}
+    with open('/proc/self/status', 'r') as fin:
+        for line in fin:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'RssAnon', 'RssFile'):
+                status[key] = int(value.split()[0]) / 1024
+    return status
+
+def topic_worker(mode, lda_dir, store_dir, lang):
+    """Get a topic model like a dataset-building / training worker would and touch all of it."""
+    from lda_predictive_model import load_topic_model
+    from topic_store import TopicStore
+
+    start = time.perf_counter()
+    if mode == 'private':
+        ndims, titles, topic_model, topic_descs = load_topic_model(lda_dir, lang)
+    else:
+        store = TopicStore.attach(store_dir, lang)
+        titles, topic_model = store.titles, store.topic_model
+    startup = time.perf_counter() - start
+    # load_topic_model stores titles with underscores
+    rows = [titles['Article_{0}'.format(i)] for i in range(0, len(titles), 97)]
+    topic_model.sum() + topic_model[rows].sum()
+    return startup, memory_status()
+
+def bench_topic_store(args):
+    """Per-worker startup time and memory with --workers processes using a private vs. shared (mmap) topic model."""
+    import multiprocessing
+    import numpy as np
+    from lda_predictive_model import load_topic_model
+    import topic_store
+
+    lang = 'xx'
+    tmpdir = tempfile.mkdtemp()
+    lda_dir = os.path.join(tmpdir, 'lda')
+    store_dir = os.path.join(tmpdir, 'store')
+    os.makedirs(lda_dir)
+    try:
+        write_synthetic_lda(lda_dir, lang, args.num_titles, args.ndims)
+        start = time.perf_counter()
+        topic_store.publish(store_dir, lang, *load_topic_model(lda_dir, lang)[1:])
+        logging.info("{0} x {1} topic model published once in {2:.2f}s.".format(
+            args.num_titles, args.ndims, time.perf_counter() - start))
+        # spawned workers start from a fresh interpreter, like separate runs (no copy-on-write sharing via fork)
+        context = multiprocessing.get_context('spawn')
+        for mode in ('private', 'shared'):
+            with context.Pool(args.workers) as pool:
+                results = pool.starmap(topic_worker, [(mode, lda_dir, store_dir, lang)] * args.workers)
+            startup = [r[0] for r in results]
+            logging.info("{0}:\t{1} workers; startup mean {2:.3f}s (max {3:.3f}s); per-worker RSS {4:.1f} MB "
+                         "({5:.1f} MB private, {6:.1f} MB file-backed/shared).".format(
+                mode, args.workers, np.mean(startup), max(startup),
+                *[np.mean([r[1][k] for r in results]) for k in ('VmRSS', 'RssAnon', 'RssFile')]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def query_mix(num_requests, num_items=100000, seed=0):
+    """Request paths for the query service, mixing per-article lookups (mostly unique) and pair / top-k queries."""
+    rand = random.Random(seed)
+    paths = []
+    for _ in range(num_requests):
+        r = rand.random()
+        if r < 0.5:
+            paths.append('/qid?qid=Q{0}'.format(rand.randrange(1, num_items)))
+        elif r < 0.7:
+            paths.append('/pairs?src={0}&dst={1}'.format(rand.choice(PROJECTS), rand.choice(PROJECTS)))
+        elif r < 0.85:
+            paths.append('/top_pairs?k={0}&weighted={1}'.format(rand.choice([10, 30]), rand.choice([0, 1])))
+        else:
+            paths.append('/top_switched?wiki={0}&k=20&rate=1&min_views=5'.format(rand.choice(PROJECTS)))
+    return paths
+
+def bench_query_service(args):
+    """Load test of query_service.py: latency percentiles and throughput with concurrent clients.
+
+    Starts a local service over an index built from synthetic sessions unless --service_url is given.
+    """
+    from query_service import make_server, QueryService
+    from switch_index import SwitchIndex, SwitchIndexBuilder
+
+    server = None
+    tmpdir = None
+    base_url = args.service_url
+    if not base_url:
+        builder = SwitchIndexBuilder(argparse.Namespace(maxpvs=500, switch_index_dir=None))
+        for session in build_sessions(args.num_pvs, args.pvs_per_session, compact=False):
+            builder.consume(session)
+        tmpdir = tempfile.mkdtemp()
+        builder.build().save(tmpdir)
+        start = time.perf_counter()
+        service = QueryService(SwitchIndex.load(tmpdir))
+        logging.info("Index with {0} QIDs loaded in {1:.4f}s.".format(len(service.index.qids),
+                                                                       time.perf_counter() - start))
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+    def timed_get(path):
+        start = time.perf_counter()
+        with urllib.request.urlopen(base_url + path) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    try:
+        paths = query_mix(args.num_requests)
+        # the second pass over the same requests is answered from the response cache
+        for lbl in ('cold', 'warm'):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                latencies = sorted(executor.map(timed_get, paths))
+            elapsed = time.perf_counter() - start
+            logging.info("{0}:\t{1:.0f} requests/s with {2} clients; latency p50 {3:.2f}ms, p95 {4:.2f}ms, "
+                         "p99 {5:.2f}ms, max {6:.2f}ms.".format(
+                lbl, len(paths) / elapsed, args.clients,
+                *[1000 * latencies[min(int(q * len(latencies)), len(latencies) - 1)] for q in (0.5, 0.95, 0.99, 1)]))
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+# dependencies that take a noticeable time to import and should only be loaded by the commands that use them
+HEAVY_MODULES = {'numpy', 'scipy', 'pandas', 'sklearn', 'mwapi', 'pyarrow'}
+STARTUP_COMMANDS = [['--help'], ['stats', '--help'], ['overlap', '--help'], ['multi', '--help'],
+                    ['dataset', '--help'], ['serve', '--help'], ['stream', '--help'], ['categories', '--help'],
+                    ['topics', '--help'], ['histogram', '--help'],
+                    ['cube', '--help']]
+
+def _run_langswitch(argv, importtime=False):
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['langswitch.py'] + argv
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    return time.perf_counter() - start, result.stderr
+
+def cold_start(argv, repeat=3):
+    """Best wall time (seconds) of `python langswitch.py <argv>` in a fresh interpreter."""
+    return min(_run_langswitch(argv)[0] for _ in range(repeat))
+
+def heavy_imports(argv):
+    """Heavy top-level modules (HEAVY_MODULES) imported by `python langswitch.py <argv>`."""
+    # -X importtime lines: 'import time: self [us] | cumulative | imported package'
+    _, stderr = _run_langswitch(argv, importtime=True)
+    modules = {line.rsplit('|', 1)[1].strip().split('.')[0] for line in stderr.splitlines()
+               if line.startswith('import time:') and line.count('|') == 2}
+    return modules & HEAVY_MODULES
+
+def bench_startup(args):
+    """Cold start of the langswitch.py commands (e.g., --help) and which heavy dependencies they import."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'])
+    logging.info("python:\t{0:.3f}s".format(time.perf_counter() - start))
+    for argv in STARTUP_COMMANDS:
+        logging.info("{0}:\t{1:.3f}s; imports {2}".format(
+            ' '.join(argv), cold_start(argv), sorted(heavy_imports(argv)) or 'no heavy dependencies'))
+
+def bench_differential(args):
+    """Speed of each session code implementation relative to the reference one (see differential.py), after checking
+    that they all give the same results on the same randomized inputs. The reference implementations are slow, so use
+    a smaller --num_pvs (e.g., 50000)."""
+    pvs_cases = differential.session_cases(num_random=args.num_pvs // args.pvs_per_session,
+                                           max_pvs=2 * args.pvs_per_session)
+    lang, nonlang = differential.switch_cases(pvs_cases)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tsv = os.path.join(tmpdir, 'pageviews.tsv.gz')
+        differential.write_random_tsv(tsv, num_users=args.num_pvs // 8)
+        tsv_cases = differential.tsv_cases(tsv)
+        for function, cases in [('trim_session', [(pvs,) for pvs in pvs_cases]), ('get_lang_switch', lang),
+                                ('get_nonlang_switch', nonlang), ('tsv_to_sessions', tsv_cases)]:
+            # tsv_to_sessions prints a summary for each file read
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                mismatches = differential.compare(function, cases)
+                timings = differential.time_implementations(function, cases)
+            logging.info("{0}: {1} cases, {2} mismatches.".format(function, len(cases), len(mismatches)))
+            for impl, seconds in timings.items():
+                logging.info("\t{0}:\t{1:.3f}s ({2:.2f}x reference)".format(
+                    impl, seconds, timings['reference'] / seconds if seconds else float('inf')))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_spill_counter(args):
+    """Peak memory and time of exact per-QID counts in a dict vs. a SpillCounter (see spill_counter.py) with a budget
+    of --max_counter_items keys, including merging the spilled runs and reading all counts back."""
+    from spill_counter import SpillCounter
+
+    for budget in (None, args.max_counter_items):
+        keys = (pv.wd for pv in random_pageviews(args.num_pvs, num_items=args.num_pvs))
+        tmpdir = tempfile.mkdtemp()
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        counter = SpillCounter(max_items=budget or args.num_pvs, spill_dir=tmpdir)
+        counts = counter.counts
+        for i, key in enumerate(keys):
+            counts[key] = counts.get(key, 0) + 1
+            if i % args.pvs_per_session == 0:
+                counter.check()
+        counted = time.perf_counter() - start
+        merged = counter.finish()
+        total = sum(merged.values())
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logging.info("{0}:\t{1} keys, {2} views; peak {3:.1f} MB; counted in {4:.2f}s, {5:.2f}s incl. merge.".format(
+            'budget {0}'.format(budget) if budget else 'dict', len(merged), total, peak / 1e6, counted, elapsed))
+        counter.close()
+        shutil.rmtree(tmpdir)
+
+def main():
+    benchmarks = {'session_memory': bench_session_memory,
+                  'query_service': bench_query_service,
+                  'title_country_counts': bench_title_country_counts,
+                  'topic_store': bench_topic_store,
+                  'startup': bench_startup,
+                  'differential': bench_differential,
+                  'spill_counter': bench_spill_counter}
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", nargs="+", default=list(benchmarks), choices=list(benchmarks),
+                        help="Which benchmarks to run.")
+    parser.add_argument("--num_pvs", type=int, default=1000000,
+                        help="Number of synthetic page views.")
+    parser.add_argument("--pvs_per_session", type=int, default=10,
+                        help="Page views per synthetic session.")
+    parser.add_argument("--num_requests", type=int, default=5000,
+                        help="query_service: number of requests per pass.")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="query_service: concurrent clients.")
+    parser.add_argument("--num_titles", type=int, default=100000,
+                        help="topic_store: titles in the synthetic topic model.")
+    parser.add_argument("--ndims", type=int, default=100,
+                        help="topic_store: topics in the synthetic topic model.")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="topic_store: concurrent worker processes.")
+    parser.add_argument("--max_counter_items", type=int, default=100000,
+                        help="spill_counter: keys kept in memory.")
+    parser.add_argument("--service_url",
+                        help="query_service: load test an already running service (e.g., http://127.0.0.1:8000).")
+    args = parser.parse_args()
+    logging.info(args)
+
+    for bench in args.bench:
+        logging.info("==={0}===".format(bench))
+        benchmarks[bench](args)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,129 @@
+"""Reading and writing the switch / non-switch dataset built by lda_predictive_model.build_dataset, as untyped .tsv rows
+in DATASET_COLUMNS order or as typed .parquet columns (chosen by file extension)."""
+
+import csv
+import json
+import logging
+
+from session_utils import int_to_qid
+from session_utils import qid_to_int
+from session_utils import Switch
+
+NON_SWITCH_PLACEHOLDER = "N/A"
+# older datasets also used a mistyped placeholder
+NON_SWITCH_VALUES = (NON_SWITCH_PLACEHOLDER, 'N\\A')
+# positional layout of a dataset row as used by the TSV format and returned by read_dataset
+# switch: the other language of the switch (or NON_SWITCH_PLACEHOLDER)
+DATASET_COLUMNS = ['switch', 'country', 'qid', 'title', 'datetime', 'usertype', 'title_country_src_count']
+METADATA_KEY = b'language_switching'
+
+# .parquet datasets have typed columns following the Switch namedtuple (dictionary-encoded languages / country /
+# usertype, integer QID, timestamp, integer title_country_src_count) and the dataset's language and direction in the
+# file metadata; readers only load the columns they need and push filters down to pyarrow
+def is_parquet(fn):
+    return fn.endswith('.parquet')
+
+def write_dataset(fn, rows, wiki_db, direction):
+    """Write dataset rows (in DATASET_COLUMNS order) to a TSV or Parquet file depending on the extension."""
+    if is_parquet(fn):
+        write_parquet(fn, rows, wiki_db, direction)
+    else:
+        with open(fn, 'w') as fout:
+            csvwriter = csv.writer(fout, delimiter="\t")
+            for row in rows:
+                csvwriter.writerow(row)
+
+def write_parquet(fn, rows, wiki_db, direction):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {f:[] for f in Switch._fields}
+    for row in rows:
+        record = dict(zip(DATASET_COLUMNS, row))
+        other = record.pop('switch')
+        if direction == "from":
+            record['srclang'], record['targetlang'] = wiki_db, other
+        else:
+            record['srclang'], record['targetlang'] = other, wiki_db
+        record['qid'] = qid_to_int(record['qid']) or None
+        for f in Switch._fields:
+            columns[f].append(record[f])
+    logging.debug("Writing {0} rows to {1}".format(len(columns['qid']), fn))
+
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([('srclang', dictionary),
+                        ('targetlang', dictionary),
+                        ('country', dictionary),
+                        ('qid', pa.int64()),
+                        ('title', pa.string()),
+                        ('datetime', pa.timestamp('s')),
+                        ('usertype', dictionary),
+                        ('title_country_src_count', pa.int64())],
+                       metadata={METADATA_KEY: json.dumps({'lang': wiki_db, 'direction': direction})})
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if field.name == 'datetime':
+            values = pa.array(values, pa.string()).cast(pa.timestamp('s'))
+        elif pa.types.is_dictionary(field.type):
+            values = pa.array(values, pa.string()).dictionary_encode()
+        else:
+            values = pa.array(values, field.type)
+        arrays.append(values)
+    pq.write_table(pa.Table.from_arrays(arrays, schema=schema), fn)
+
+def read_dataset(fn, columns=DATASET_COLUMNS, switches_only=False, non_switches_only=False, usertype=None):
+    """Read dataset rows, optionally only some columns and only switches / non-switches / a given usertype.
+
+    Returns a list of rows (lists) holding the requested columns in the requested order. Values are strings as in
+    the TSV format (e.g., QID 'Q10856') except title_country_src_count, which is an int for Parquet files.
+    """
+    if is_parquet(fn):
+        return read_parquet(fn, columns, switches_only, non_switches_only, usertype)
+    col_indices = [DATASET_COLUMNS.index(c) for c in columns]
+    switch_idx = DATASET_COLUMNS.index('switch')
+    usertype_idx = DATASET_COLUMNS.index('usertype')
+    rows = []
+    with open(fn, 'r') as fin:
+        for line in csv.reader(fin, delimiter="\t"):
+            is_switch = line[switch_idx] not in NON_SWITCH_VALUES
+            if (switches_only and not is_switch) or (non_switches_only and is_switch):
+                continue
+            if usertype and line[usertype_idx] != usertype:
+                continue
+            rows.append([line[idx] if idx < len(line) else None for idx in col_indices])
+    return rows
+
+def parquet_metadata(fn):
+    """Language and direction ({'lang': ..., 'direction': ...}) of a Parquet dataset."""
+    import pyarrow.parquet as pq
+
+    return json.loads(pq.read_schema(fn).metadata[METADATA_KEY])
+
+def read_parquet(fn, columns=DATASET_COLUMNS, switches_only=False, non_switches_only=False, usertype=None):
+    import pyarrow.parquet as pq
+
+    metadata = parquet_metadata(fn)
+    other_col = 'targetlang' if metadata['direction'] == "from" else 'srclang'
+    to_read = set(c if c != 'switch' else other_col for c in columns)
+    filters = []
+    if switches_only:
+        filters.append((other_col, '!=', NON_SWITCH_PLACEHOLDER))
+    if non_switches_only:
+        filters.append((other_col, '=', NON_SWITCH_PLACEHOLDER))
+    if usertype:
+        filters.append(('usertype', '=', usertype))
+    table = pq.read_table(fn, columns=sorted(to_read), filters=filters or None)
+
+    output_cols = []
+    for c in columns:
+        if c == 'switch':
+            values = table.column(other_col).to_pylist()
+        elif c == 'qid':
+            values = [int_to_qid(q) or '' for q in table.column('qid').to_pylist()]
+        elif c == 'datetime':
+            values = [dt.isoformat() if dt else dt for dt in table.column('datetime').to_pylist()]
+        else:
+            values = table.column(c).to_pylist()
+        output_cols.append(values)
+    return [list(row) for row in zip(*output_cols)]
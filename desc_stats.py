@@ -1,13 +1,28 @@
 import argparse
-from copy import deepcopy
 import glob
 import logging
-
-from session_utils import tsv_to_sessions
+import os
+
+from histogram import LogHistogram
+from histogram import QUANTILES
+from histogram import save_histograms
+from histogram import write_quantiles
+from reporting import Report
+from reporting import top_k
+from reporting import weight_by_proj
+from reporting import weight_by_pvs
 from session_utils import get_lang_switch
+from session_utils import log_scaled_counts
+from session_utils import pageview_epochs
+from session_utils import scaled_count_interval
+from session_utils import scan_sessions
+from session_utils import SessionConsumer
 from session_utils import usertypes
+from session_utils import wilson_interval
+from spill_counter import SpillCounter
+from spill_counter import SpillDict
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--tsvs", nargs="+",
                         help=".tsv files with anonymized page views ordered by user/datetime")
@@ -15,6 +30,22 @@ def main():
                         help="if included, specific languages to only track switching statistics for")
     parser.add_argument("--stopafter", type=int, default=-1,
                         help="Process only this many sessions.")
+    parser.add_argument("--sample_rate", type=float, default=1.0,
+                        help="Only analyze this fraction of users (selected deterministically by user hash).")
+    parser.add_argument("--gap_seconds", type=int, default=None,
+                        help="Split users' page views into sessions at gaps of more than n seconds (e.g., 1800).")
+    parser.add_argument("--checkpoint",
+                        help="Save counts and input position to this file after each TSV (to --resume from).")
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="With --checkpoint: also checkpoint after every n sessions.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from --checkpoint (same --tsvs and options).")
+    parser.add_argument("--early_maxpvs", type=int, default=None,
+                        help="Drop users while reading as soon as a session has more than n pageviews (likely bots; "
+                             "their remaining lines are not parsed).")
+    parser.add_argument("--max_per_minute", type=int, default=None,
+                        help="Drop users while reading as soon as they have more than n page views in one minute "
+                             "(likely bots).")
     parser.add_argument("--debug", action="store_true",
                         help="More verbose logging")
     parser.add_argument("--maxpvs", type=int, default=500,
@@ -25,10 +56,30 @@ def main():
                         help="Wikidata IDs to track more thoroughly")
     parser.add_argument("--output_results",
                         help="TSV file to print relationship between wikis")
+    parser.add_argument("--report_fn",
+                        help="If given, also write the reported tables to this .json or .tsv file")
+    parser.add_argument("--timing_fn",
+                        help="If given, write mergeable switch latency / dwell histograms per language pair to this "
+                             ".json file (quantiles to the same name as .tsv; see histogram.py)")
+    parser.add_argument("--switch_index_dir",
+                        help="If given, also save a sparse QID x project index of views / switches here (see switch_index.py)")
+    parser.add_argument("--cube_dir",
+                        help="If given, also save usertype x country x project x project counts of switches and "
+                             "co-occurrence here (see switch_cube.py)")
+    parser.add_argument("--max_counter_items", type=int, default=None,
+                        help="If given, keep at most n keys in memory for each of the per-QID and language pair counts "
+                             "(per usertype) and the English titles of QIDs and spill the rest to sorted files on disk "
+                             "(see spill_counter.py)")
+    parser.add_argument("--spill_dir",
+                        help="With --max_counter_items: directory for the spilled counts (default: a temporary "
+                             "directory). Keep it with --checkpoint so that --resume finds them.")
     parser.add_argument("--filter_editors",
                         action="store_true",
                         help="Filter out editors.")
-    args = parser.parse_args()
+    return parser
+
+def main():
+    args = get_parser().parse_args()
 
     if len(args.tsvs) == 1:
         args.tsvs = glob.glob(args.tsvs[0])
@@ -37,231 +88,321 @@ def main():
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    logging.info(("Filtering of statistics:\n"
-                  "\t*only Wikipedia projects considered (.wikipedia; mobile/desktop/app aggregated)\n"
-                  "\t*only namespace = 0 considered\n"
-                  "\t*only first pageview of a given article retained (e.g. enwiki+Chicago)\n"
-                  "\t*language switching defined as same wikidata item, different project\n"
-                  "\t*devices w/ greater than {0} pageviews dropped as likely bots.".format(args.maxpvs)))
-
-    # count of language pairs involved in switches (directional)
-    to_from = {}
-    # number of page views per session
-    pv_counts = {}
-    # number of unique language projects per session
-    lang_counts = {}
-    # number of switches per session
-    switch_counts = {}
-    # specific stats for switches of form: <other language> -> args.language_stats
-    lang_to = {}
-    # specific stats for switches of form: args.language_stats -> <other language>
-    lang_from = {}
-    # number of views per wikidata item (across all languages)
-    wd_pvs = {}
-    # number of views per language project
-    proj_pvs = {}
-    # map QIDs to English titles (if in dataset) for easier debugging purposes
-    wd_to_entitle = {}
-    # if wdids_to_print, keep track of the switches for these Wikidata IDs
-    wd_examples = {}
-    # track referral sources of sessions
-    ref_counts_s = {}
-    ref_counts_pv = {}
-    for ut in usertypes:
-        wd_examples[ut] = {}
-        for wditem in args.wdids_to_print:
-            wd_examples[ut][wditem] = {}
-
-    for d in [to_from, pv_counts, lang_counts, switch_counts, lang_to, lang_from, wd_pvs, proj_pvs, ref_counts_pv, ref_counts_s]:
+    consumers = [DescStats(args)]
+    if args.switch_index_dir:
+        # needs numpy / scipy, so only imported when requested
+        from switch_index import SwitchIndexBuilder
+        consumers.append(SwitchIndexBuilder(args))
+    if args.cube_dir:
+        from switch_cube import SwitchCubeBuilder
+        consumers.append(SwitchCubeBuilder(args))
+    # this only includes the first page view for a given QID-project so a user repeatedly viewing a page doesn't skew the statistics
+    scan_sessions(args.tsvs, consumers, stopafter=args.stopafter, sample_rate=args.sample_rate,
+                  gap_seconds=args.gap_seconds, checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                  resume=args.resume, max_pvs=args.early_maxpvs, max_per_minute=args.max_per_minute)
+    for consumer in consumers:
+        consumer.report()
+
+
+# counts keyed by QIDs or language pairs, which grow with the number of days scanned
+SPILLED_COUNTS = ('wd_pvs', 'lang_from', 'lang_to', 'to_from')
+
+class DescStats(SessionConsumer):
+    """Descriptive statistics regarding user sessions and language switching."""
+
+    def __init__(self, args):
+        self.args = args
+        logging.info(("Filtering of statistics:\n"
+                      "\t*only Wikipedia projects considered (.wikipedia; mobile/desktop/app aggregated)\n"
+                      "\t*only namespace = 0 considered\n"
+                      "\t*only first pageview of a given article retained (e.g. enwiki+Chicago)\n"
+                      "\t*language switching defined as same wikidata item, different project\n"
+                      "\t*devices w/ greater than {0} pageviews dropped as likely bots.".format(args.maxpvs)))
+
+        self.num_sessions = 0
+        # number of sessions by their index among a user's sessions (all 0 unless split by --gap_seconds)
+        self.subsession_counts = {}
+        # count of language pairs involved in switches (directional)
+        self.to_from = {}
+        # number of page views per session
+        self.pv_counts = {}
+        # number of unique language projects per session
+        self.lang_counts = {}
+        # number of switches per session
+        self.switch_counts = {}
+        # specific stats for switches of form: <other language> -> args.language_stats
+        self.lang_to = {}
+        # specific stats for switches of form: args.language_stats -> <other language>
+        self.lang_from = {}
+        # number of views per wikidata item (across all languages)
+        self.wd_pvs = {}
+        # number of views per language project
+        self.proj_pvs = {}
+        # map QIDs to English titles (if in dataset) for easier debugging purposes
+        self.wd_to_entitle = {}
+        # if wdids_to_print, keep track of the switches for these Wikidata IDs
+        self.wd_examples = {}
+        # track referral sources of sessions
+        self.ref_counts_s = {}
+        self.ref_counts_pv = {}
+        # number of repeat views of the same page (project + title) dropped by trimming
+        self.duplicate_pvs = {}
+        # number of sessions dropped for having more than maxpvs page views
+        self.bot_sessions = {}
+        # histograms per language pair of seconds from the source to the target page view (latency) and from the
+        # page view before the target to the target (dwell: time spent on the last page before switching)
+        self.switch_timing = {}
+        # sessions with switches left out of the timing because of a malformed datetime
+        self.untimed_sessions = {}
         for ut in usertypes:
-            d[ut] = {}
-
-    i = 0
-    for tsv in args.tsvs:
-        logging.info("Processing: {0}".format(tsv))
-        # this only includes the first page view for a given QID-project so a user repeatedly viewing a page doesn't skew the statistics
-        for session in tsv_to_sessions(tsv, trim=True):
-            if i == args.stopafter:
-                break
-            i += 1
-            if i % 500000 == 0:
-                logging.info("{0} sessions analyzed.".format(i))
-
-            ut = session.usertype
-
-            # filter out likely bots
-            num_pvs = len(session.pageviews)
-            if not num_pvs or num_pvs > args.maxpvs:
-                continue
-            pv_counts[ut][num_pvs] = pv_counts[ut].get(num_pvs, 0) + 1
-
-            for pv in session.pageviews:
-                wditem = pv.wd
-                if wditem:
-                    wd_pvs[ut][wditem] = wd_pvs[ut].get(wditem, 0) + 1
-                    if pv.proj == 'enwiki':
-                        wd_to_entitle[wditem] = pv.title
-                proj_pvs[ut][pv.proj] = proj_pvs[ut].get(pv.proj, 0) + 1
-                ref_counts_pv[ut][pv.referer] = ref_counts_pv[ut].get(pv.referer, 0) + 1
-
-            ref_counts_s[ut][session.pageviews[0].referer] = ref_counts_s[ut].get(session.pageviews[0].referer, 0) + 1
-
-            # only analyze language switching when >1 pageview associated w/ device (~50% of sessions)
-            if num_pvs > 1:
-                pvs = session.pageviews
-                num_langs = len(set([p.proj for p in pvs]))
-                lang_counts[ut][num_langs] = lang_counts[ut].get(num_langs, 0) + 1
-                if num_langs > 1:
-                    lang_switches = get_lang_switch(pvs)
-                    num_switches = len(lang_switches)
-                    switch_counts[ut][num_switches] = switch_counts[ut].get(num_switches, 0) + 1
-                    for ls_pair in lang_switches:
-                        frompv = pvs[ls_pair[0]]
-                        topv = pvs[ls_pair[1]]
-                        if not args.langs or frompv.proj in args.langs or topv.proj in args.langs:
-                            tf = '{0}-{1}'.format(frompv.proj, topv.proj)
-                            to_from[ut][tf] = to_from[ut].get(tf, 0) + 1
-                            if frompv.wd in args.wdids_to_print:
-                                wd_examples[ut][frompv.wd][tf] = wd_examples[ut][frompv.wd].get(tf, 0) + 1
-
-                        if frompv.proj == args.language_stats:
-                            lang_from[ut][frompv.wd] = lang_from[ut].get(frompv.wd, 0) + 1
-                        elif topv.proj == args.language_stats:
-                            lang_to[ut][topv.wd] = lang_to[ut].get(topv.wd, 0) + 1
-
-    for ut in usertypes:
-        logging.info("{0}: {1} users with switches ({2} false alarms) out of {3} sessions.".format(
-            ut, sum([v for k,v in switch_counts[ut].items() if k > 0]), switch_counts[ut].get(0, -1), i))
-
-    # print summary stats on sessions
-    logging.info("\nPVs per userhash:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(pv_counts[ut], 10, "pageviews")
-
-    logging.info("\nLangs per userhash:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        logging.info("Not included because 1 pageview: {0}".format(pv_counts[ut].get(1, 0)))
-        print_stats(lang_counts[ut], 10, "langs")
-
-    logging.info("\nSwitches per userhash:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        logging.info("Not included because 1 pageview: {0}".format(pv_counts[ut].get(1, 0)))
-        logging.info("Not included because 2+ pageviews but 1 language: {0}".format(lang_counts[ut].get(1, 0)))
-        print_stats(switch_counts[ut], 10, "switches")
-
-    logging.info("\nTop referral sources for first page in session:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(ref_counts_pv[ut], 10, "pageviews")
-        print_stats(ref_counts_s[ut], 10, 'sessions')
-
-    # print summary stats on individual pages
-    # normalize keys w/ wd-item + english title if available for easier interpretation
-    for ut in usertypes:
-        for d in [wd_pvs[ut], lang_from[ut], lang_to[ut]]:
-            for wditem in list(d.keys()):
-                entitle = wd_to_entitle.get(wditem, "UNK")
-                count = d.pop(wditem)
-                d['{0} ({1})'.format(wditem, entitle)] = count
-
-    logging.info("\n{0} pages from:".format(args.language_stats))
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(lang_from[ut], 20, "")
-
-    logging.info("\nWeighted {0} pages from:".format(args.language_stats))
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        weight_by_pvs(lang_from[ut], wd_pvs[ut])
-        print_stats(lang_from[ut], 20, "", context_dict=wd_pvs[ut])
-
-    logging.info("\n{0} pages to:".format(args.language_stats))
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(lang_to[ut], 20, "")
-
-    logging.info("\nWeighted {0} pages to:".format(args.language_stats))
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        weight_by_pvs(lang_to[ut], wd_pvs[ut])
-        print_stats(lang_to[ut], 20, "", context_dict=wd_pvs[ut])
-
-    logging.info("\nLanguage pairs:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(to_from[ut], 30, "")
-
-    logging.info("\nWeighted language pairs:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        weighted_to_from = weight_by_proj(to_from[ut], proj_pvs[ut])
-        print_stats(weighted_to_from, 20, "", context_dict=to_from[ut])
-
-    logging.info("\nTop-viewed WD items:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(wd_pvs[ut], 40, "")
-
-    for ut in usertypes:
-        if wd_examples[ut]:
-            logging.info("==={0}===".format(ut))
-            for wditem in wd_examples[ut]:
-                logging.info('{0} ({1}):'.format(wditem, wd_to_entitle[wditem]))
-                print_stats(wd_examples[ut][wditem], threshold=20, lbl="", context_dict=to_from[ut])
-
-
-def weight_by_proj(countdict, pvs_by_proj, minpv_threshold=500):
-    """Normalize count stats by how many page views occurred on a project"""
-    # have to deep copy otherwise, this will change in-place and affect other statistics
-    countdict = deepcopy(countdict)
-    for pi_to_pj in list(countdict.keys()):
-        count = countdict.pop(pi_to_pj)
-        pi = pi_to_pj.split("-")[0]
-        norm = pvs_by_proj[pi]
-        # only compute proportion for projects w/ enough traffic that the pattern MIGHT be real
-        if norm > minpv_threshold:
-            countdict[pi_to_pj] = count / norm
-        else:
-            countdict[pi_to_pj] = 0
-    return countdict
-
-
-def weight_by_pvs(countdict, pvs_by_wd, minpv_threshold=50):
-    """Normalize count stats by how often a page was viewed"""
-    for wd_title in list(countdict.keys()):
-        count = countdict.pop(wd_title)
-        norm = pvs_by_wd[wd_title]
-        # only compute proportion for pages w/ enough traffic that the pattern MIGHT be real
-        if norm > minpv_threshold:
-            countdict[wd_title] = count / norm
-        else:
-            countdict[wd_title] = 0
-
-def print_stats(countdict, threshold, lbl, ignore=(), context_dict=None):
-    """Print limited statistics for count dictionaries."""
-    rest = 0
-    ignorevals = []
-    for k in ignore:
-        ignorevals.append((k, countdict.pop(k)))
-    denominator = sum(countdict.values())
-    for topk, sc in enumerate([(k, countdict[k]) for k in sorted(countdict, key=countdict.get, reverse=True)]):
-        if topk <= threshold:
-            if context_dict:
-                logging.info("{0} {1}:\t{2}\t({3}) times.".format(sc[0], lbl, sc[1], context_dict.get(sc[0], "N/A")))
+            self.duplicate_pvs[ut] = 0
+            self.untimed_sessions[ut] = 0
+            self.bot_sessions[ut] = 0
+            self.switch_timing[ut] = {'latency': {}, 'dwell': {}}
+            self.wd_examples[ut] = {}
+            for wditem in self.args.wdids_to_print:
+                self.wd_examples[ut][wditem] = {}
+
+        for d in [self.to_from, self.pv_counts, self.lang_counts, self.switch_counts, self.lang_to, self.lang_from,
+                  self.wd_pvs, self.proj_pvs, self.ref_counts_pv, self.ref_counts_s]:
+            for ut in usertypes:
+                d[ut] = {}
+
+        # high-cardinality counts that are spilled to disk with --max_counter_items
+        self.spill_counters = {}
+        if self.args.max_counter_items:
+            for name in SPILLED_COUNTS:
+                for ut in usertypes:
+                    self.spill_counters[(name, ut)] = SpillCounter(getattr(self, name)[ut], self.args.max_counter_items,
+                                                                   self.args.spill_dir, '{0}_{1}'.format(name, ut))
+            # one title per QID viewed on enwiki: as many keys as wd_pvs
+            self.spill_counters[('wd_to_entitle', None)] = SpillDict(self.wd_to_entitle, self.args.max_counter_items,
+                                                                     self.args.spill_dir, 'wd_to_entitle')
+
+    def consume(self, session):
+        for counter in self.spill_counters.values():
+            counter.check()
+        self.num_sessions += 1
+        ut = session.usertype
+        self.duplicate_pvs[ut] += session.duplicates
+        self.subsession_counts[session.subsession] = self.subsession_counts.get(session.subsession, 0) + 1
+
+        # filter out likely bots
+        num_pvs = len(session.pageviews)
+        if not num_pvs or num_pvs > self.args.maxpvs:
+            if num_pvs:
+                self.bot_sessions[ut] += 1
+            return
+        self.pv_counts[ut][num_pvs] = self.pv_counts[ut].get(num_pvs, 0) + 1
+
+        for pv in session.pageviews:
+            wditem = pv.wd
+            if wditem:
+                self.wd_pvs[ut][wditem] = self.wd_pvs[ut].get(wditem, 0) + 1
+                if pv.proj == 'enwiki':
+                    self.wd_to_entitle[wditem] = pv.title
+            self.proj_pvs[ut][pv.proj] = self.proj_pvs[ut].get(pv.proj, 0) + 1
+            self.ref_counts_pv[ut][pv.referer] = self.ref_counts_pv[ut].get(pv.referer, 0) + 1
+
+        first_ref = session.pageviews[0].referer
+        self.ref_counts_s[ut][first_ref] = self.ref_counts_s[ut].get(first_ref, 0) + 1
+
+        # only analyze language switching when >1 pageview associated w/ device (~50% of sessions)
+        if num_pvs > 1:
+            pvs = session.pageviews
+            num_langs = len(set([p.proj for p in pvs]))
+            self.lang_counts[ut][num_langs] = self.lang_counts[ut].get(num_langs, 0) + 1
+            if num_langs > 1:
+                lang_switches = get_lang_switch(pvs)
+                num_switches = len(lang_switches)
+                self.switch_counts[ut][num_switches] = self.switch_counts[ut].get(num_switches, 0) + 1
+                # timestamps are only parsed for sessions with switches
+                epochs = None
+                if lang_switches:
+                    try:
+                        epochs = pageview_epochs(pvs)
+                    except ValueError:
+                        # a malformed datetime: the switches still count, just without timing
+                        self.untimed_sessions[ut] += 1
+                for ls_pair in lang_switches:
+                    frompv = pvs[ls_pair[0]]
+                    topv = pvs[ls_pair[1]]
+                    if not self.args.langs or frompv.proj in self.args.langs or topv.proj in self.args.langs:
+                        tf = '{0}-{1}'.format(frompv.proj, topv.proj)
+                        self.to_from[ut][tf] = self.to_from[ut].get(tf, 0) + 1
+                        if epochs is not None:
+                            to_epoch = epochs[ls_pair[1]]
+                            self.add_timing(ut, 'latency', tf, to_epoch - epochs[ls_pair[0]])
+                            self.add_timing(ut, 'dwell', tf, to_epoch - epochs[ls_pair[1] - 1])
+                        if frompv.wd in self.args.wdids_to_print:
+                            self.wd_examples[ut][frompv.wd][tf] = self.wd_examples[ut][frompv.wd].get(tf, 0) + 1
+
+                    if frompv.proj == self.args.language_stats:
+                        self.lang_from[ut][frompv.wd] = self.lang_from[ut].get(frompv.wd, 0) + 1
+                    elif topv.proj == self.args.language_stats:
+                        self.lang_to[ut][topv.wd] = self.lang_to[ut].get(topv.wd, 0) + 1
+
+    def add_timing(self, ut, kind, tf, seconds):
+        hists = self.switch_timing[ut][kind]
+        hist = hists.get(tf)
+        if hist is None:
+            hist = hists[tf] = LogHistogram()
+        hist.add(seconds)
+
+    def report(self):
+        for (name, ut), counter in self.spill_counters.items():
+            if ut is None:
+                setattr(self, name, counter.finish())
             else:
-                logging.info("{0} {1}:\t{2}\t({3:.3f}) times.".format(sc[0], lbl, sc[1], sc[1] / denominator))
-        else:
-            rest += sc[1]
-    if rest:
-        logging.info("Remainder:\t{0}\t({1:.3f}) times.".format(rest, rest / denominator))
-    for k,v in ignorevals:
-        countdict[k] = v
+                getattr(self, name)[ut] = counter.finish()
+
+        for ut in usertypes:
+            logging.info("{0}: {1} users with switches ({2} false alarms) out of {3} sessions.".format(
+                ut, sum([v for k,v in self.switch_counts[ut].items() if k > 0]), self.switch_counts[ut].get(0, -1),
+                self.num_sessions))
+
+        if self.args.sample_rate < 1:
+            self.report_sampled_estimates()
+
+        for ut in usertypes:
+            logging.info("{0}: {1} duplicate pageviews of the same article removed.".format(ut, self.duplicate_pvs[ut]))
+            logging.info("{0}: {1} sessions with more than {2} pageviews dropped as likely bots.".format(
+                ut, self.bot_sessions[ut], self.args.maxpvs))
+
+        report = Report(self.args.report_fn)
+        # print summary stats on sessions
+        if self.args.gap_seconds is not None:
+            # users with exactly n sessions = users with an n-th session - users with an (n+1)-th session
+            sessions_per_user = {n + 1: c - self.subsession_counts.get(n + 1, 0)
+                                 for n, c in self.subsession_counts.items()}
+            report.section("Sessions per userhash (split at gaps of more than {0}s)".format(self.args.gap_seconds))
+            report.print_stats(sessions_per_user, 10, "sessions")
+
+        report.section("PVs per userhash")
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(self.pv_counts[ut], 10, "pageviews")
+
+        report.section("Langs per userhash")
+        for ut in usertypes:
+            report.usertype(ut)
+            logging.info("Not included because 1 pageview: {0}".format(self.pv_counts[ut].get(1, 0)))
+            report.print_stats(self.lang_counts[ut], 10, "langs")
+
+        report.section("Switches per userhash")
+        for ut in usertypes:
+            report.usertype(ut)
+            logging.info("Not included because 1 pageview: {0}".format(self.pv_counts[ut].get(1, 0)))
+            logging.info("Not included because 2+ pageviews but 1 language: {0}".format(self.lang_counts[ut].get(1, 0)))
+            report.print_stats(self.switch_counts[ut], 10, "switches")
+
+        report.section("Top referral sources for first page in session")
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(self.ref_counts_pv[ut], 10, "pageviews")
+            report.print_stats(self.ref_counts_s[ut], 10, 'sessions')
+
+        # print summary stats on individual pages
+        # label printed wd-items w/ english title if available for easier interpretation
+        label = self.wd_label
+
+        report.section("{0} pages from".format(self.args.language_stats))
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(self.lang_from[ut], 20, "", label=label)
+
+        report.section("Weighted {0} pages from".format(self.args.language_stats))
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(weight_by_pvs(self.lang_from[ut], self.wd_pvs[ut]), 20, "",
+                               context_dict=self.wd_pvs[ut], label=label)
+
+        report.section("{0} pages to".format(self.args.language_stats))
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(self.lang_to[ut], 20, "", label=label)
 
+        report.section("Weighted {0} pages to".format(self.args.language_stats))
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(weight_by_pvs(self.lang_to[ut], self.wd_pvs[ut]), 20, "",
+                               context_dict=self.wd_pvs[ut], label=label)
+
+        report.section("Language pairs")
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(self.to_from[ut], 30, "")
+
+        report.section("Weighted language pairs")
+        for ut in usertypes:
+            report.usertype(ut)
+            weighted_to_from = weight_by_proj(self.to_from[ut], self.proj_pvs[ut])
+            report.print_stats(weighted_to_from, 20, "", context_dict=self.to_from[ut])
 
+        self.report_timing()
+
+        report.section("Top-viewed WD items")
+        for ut in usertypes:
+            report.usertype(ut)
+            report.print_stats(self.wd_pvs[ut], 40, "", label=label)
+
+        for ut in usertypes:
+            if self.wd_examples[ut]:
+                report.usertype(ut)
+                for wditem in self.wd_examples[ut]:
+                    logging.info('{0} ({1}):'.format(wditem, self.wd_to_entitle[wditem]))
+                    report.print_stats(self.wd_examples[ut][wditem], threshold=20, lbl="",
+                                       context_dict=self.to_from[ut], name=wditem)
+        report.write()
+
+        for counter in self.spill_counters.values():
+            counter.close()
+
+    def report_timing(self):
+        """Log quantiles of the seconds to switch (latency) and spent on the page before switching (dwell)."""
+        logging.info("\nSeconds from source to target page view (latency) and on the page before the target (dwell):")
+        for ut in usertypes:
+            logging.info("==={0}===".format(ut))
+            if self.untimed_sessions[ut]:
+                logging.info("{0} sessions with switches left out because of malformed datetimes.".format(
+                    self.untimed_sessions[ut]))
+            for kind in ('latency', 'dwell'):
+                pairs = self.switch_timing[ut][kind]
+                overall = LogHistogram()
+                for hist in pairs.values():
+                    overall.merge(hist)
+                top = top_k({tf: hist.count for tf, hist in pairs.items()}, 10)
+                for tf, hist in [('all pairs', overall)] + [(tf, pairs[tf]) for tf, _ in top]:
+                    if hist.count:
+                        logging.info("{0} {1}:\t{2} switches;\t{3}".format(tf, kind, hist.count, ';\t'.join(
+                            'p{0:.0f} {1:.0f}s'.format(q * 100, hist.quantile(q)) for q in QUANTILES)))
+        if self.args.timing_fn:
+            save_histograms(self.args.timing_fn, self.switch_timing)
+            write_quantiles(os.path.splitext(self.args.timing_fn)[0] + '.tsv', self.switch_timing)
+            logging.info("Switch timing histograms written to {0}".format(self.args.timing_fn))
+
+    def wd_label(self, wditem):
+        return '{0} ({1})'.format(wditem, self.wd_to_entitle.get(wditem, "UNK"))
+
+    def report_sampled_estimates(self):
+        """Scale sampled counts up to all users, with 95% intervals for switch rates and language-pair counts."""
+        sample_rate = self.args.sample_rate
+        logging.info("\nEstimates from a {0:.2%} sample of users:".format(sample_rate))
+        for ut in usertypes:
+            num_sessions = sum(self.pv_counts[ut].values())
+            num_switchers = sum([v for k,v in self.switch_counts[ut].items() if k > 0])
+            rate, low, high = wilson_interval(num_switchers, num_sessions)
+            logging.info("{0}: {1:.4f} [{2:.4f}, {3:.4f}] of sessions have switches.".format(ut, rate, low, high))
+            for lbl, count in [("sessions", num_sessions), ("sessions with switches", num_switchers)]:
+                estimate, low, high = scaled_count_interval(count, sample_rate)
+                logging.info("{0}: ~{1:.0f} [{2:.0f}, {3:.0f}] {4}.".format(ut, estimate, low, high, lbl))
+
+        logging.info("\nEstimated language pairs:")
+        for ut in usertypes:
+            logging.info("==={0}===".format(ut))
+            log_scaled_counts(self.to_from[ut], sample_rate, 30)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    main()
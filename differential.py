@@ -0,0 +1,390 @@
+"""Differential testing of the session code: every implementation of trim_session, get_lang_switch, get_nonlang_switch
+and tsv_to_sessions is run side by side with a plain reference implementation on randomized and adversarial inputs
+(repeated QIDs, many projects, missing QIDs, EDITATTEMPT rows, malformed lines and datetimes)."""
+
+from datetime import datetime, timezone
+import gzip
+import itertools
+import random
+import time
+
+from session_utils import CompactPageviews
+from session_utils import EDIT_STR
+from session_utils import get_lang_switch, get_nonlang_switch
+from session_utils import in_sample, sample_threshold_for
+from session_utils import Pageview
+from session_utils import ref_class
+from session_utils import trim_session
+from session_utils import tsv_to_sessions
+from session_utils import user_key
+from stream_switches import StreamingSession
+
+PROJECTS = ['enwiki', 'dewiki', 'eswiki', 'frwiki', 'jawiki', 'ruwiki', 'itwiki', 'zhwiki', 'arwiki', 'ptwiki']
+HEADER = ['user', 'project', 'page_title', 'page_id', 'dt', 'country', 'referer', 'item_id']
+START = 1550316713  # 2019-02-16T11:31:53
+
+
+# The reference implementations below are written for clarity, not speed, and are the specification: a faster
+# implementation ships when test_differential.py passes and `python benchmarks.py --bench differential` shows it is
+# actually faster.
+def ref_epoch(dt):
+    return int(datetime.fromisoformat(dt).replace(tzinfo=timezone.utc).timestamp())
+
+
+def ref_trim(pvs):
+    """First view of each (project, title) pair."""
+    kept = []
+    for pv in pvs:
+        if not any(k.proj == pv.proj and k.title == pv.title for k in kept):
+            kept.append(pv)
+    return kept
+
+
+def ref_lang_switch(pvs, wikidbs=(), ref_match=False):
+    """Each page view is paired with the first later view of the same (non-missing) Wikidata item on another project,
+    where one of the two projects is in wikidbs (if given). With ref_match, the pair only counts as a switch if the
+    later view's referer is the earlier view's project."""
+    switches = []
+    for i, pv in enumerate(pvs):
+        for j in range(i + 1, len(pvs)):
+            other = pvs[j]
+            if (pv.wd and pv.wd == other.wd and pv.proj != other.proj
+                    and (not wikidbs or pv.proj in wikidbs or other.proj in wikidbs)):
+                if not ref_match or other.referer == pv.proj:
+                    switches.append((i, j))
+                break
+    return switches
+
+
+def ref_nonlang_switch(pvs, wikidb, direction="from"):
+    """Views on wikidb that are not switched from (to), if the session has at least one such switch."""
+    side = 0 if direction == "from" else 1
+    switched = {s[side] for s in ref_lang_switch(pvs, [wikidb]) if pvs[s[side]].proj == wikidb}
+    if not switched:
+        return []
+    return [i for i, pv in enumerate(pvs) if pv.proj == wikidb and i not in switched]
+
+
+def ref_is_qid(wd):
+    return wd[:1] == 'Q' and len(wd) > 1 and all(c in '0123456789' for c in wd[1:])
+
+
+def ref_tsv_to_sessions(tsv, trim=False, sample_rate=1.0, gap_seconds=None, parse_epochs=False, parse_qids=False):
+    """Sessions as (usrhash, country, usertype, duplicates, subsession, page views): parse all lines, drop malformed
+    ones, group consecutive lines by user, split at gaps and only then look at edits and duplicates. With parse_qids,
+    lines with an item id that is not a Wikidata item id (e.g., 'P31') are malformed too."""
+    parse_epochs = parse_epochs or gap_seconds is not None
+    rows = []
+    with gzip.open(tsv, 'rt') as fin:
+        next(fin)
+        for line in fin:
+            fields = line.strip().split("\t")
+            if len(fields) < 7:
+                continue
+            epoch = None
+            if parse_epochs:
+                try:
+                    epoch = ref_epoch(fields[4])
+                except ValueError:
+                    continue
+            if parse_qids and len(fields) > 7 and fields[7] and not ref_is_qid(fields[7]):
+                continue
+            rows.append((fields, epoch))
+    threshold = sample_threshold_for(sample_rate)
+    sessions = []
+    for usr, user_rows in itertools.groupby(rows, key=lambda r: r[0][0]):
+        user_rows = list(user_rows)
+        if threshold is not None and not in_sample(usr, threshold):
+            continue
+        runs = [[user_rows[0]]]
+        for prev, row in zip(user_rows, user_rows[1:]):
+            if gap_seconds is not None and row[1] - prev[1] > gap_seconds:
+                runs.append([])
+            runs[-1].append(row)
+        for subsession, run in enumerate(runs):
+            usertype = 'editor' if any(fields[2] == EDIT_STR for fields, _ in run) else 'reader'
+            pvs = [Pageview(fields[4], fields[1], fields[2], fields[7] if len(fields) > 7 else None,
+                            ref_class(fields[6])) for fields, _ in run if fields[2] != EDIT_STR]
+            duplicates = 0
+            if trim:
+                kept = ref_trim(pvs)
+                duplicates = len(pvs) - len(kept)
+                pvs = kept
+            sessions.append((user_key(usr), user_rows[0][0][5], usertype, duplicates, subsession, pvs))
+    return sessions
+
+
+def pv_key(pv):
+    """Comparable page view: missing values are None (CompactPageviews does not distinguish None and '') and
+    datetimes are compared as epochs where they parse (CompactPageviews normalizes them)."""
+    try:
+        dt = ref_epoch(pv.dt)
+    except ValueError:
+        dt = pv.dt
+    return (dt, pv.proj, pv.title, pv.wd or None, pv.referer or None)
+
+
+def session_key(session):
+    if isinstance(session, tuple) and not hasattr(session, 'pageviews'):
+        usrhash, country, usertype, duplicates, subsession, pvs = session
+    else:
+        usrhash, country, usertype, duplicates, subsession, pvs = (
+            session.usrhash, session.country, session.usertype, session.duplicates, session.subsession,
+            session.pageviews)
+    return (usrhash, country, usertype, duplicates, subsession, [pv_key(pv) for pv in pvs])
+
+
+def streamed_lang_switch(pvs, wikidbs=(), ref_match=False):
+    """get_lang_switch via StreamingSession (for sessions without duplicates)."""
+    session = StreamingSession(0)
+    switches = []
+    for pv in pvs:
+        switches.extend((i, session.num_pvs - 1)
+                        for i, _ in session.add(pv.proj, pv.title, pv.wd, pv.referer, wikidbs, ref_match) or ())
+    return sorted(switches)
+
+
+def resumed_tsv_to_sessions(tsv, **kwargs):
+    """Read half of the sessions, then continue from the checkpoint position as scan_sessions(resume=True) does."""
+    positions = []
+    sessions = []
+    position = {}
+    for session in tsv_to_sessions(tsv, position=position, **kwargs):
+        sessions.append(session)
+        positions.append(dict(position))
+    resumable = [k for k, p in enumerate(positions) if p['line'] is not None]
+    if not resumable:
+        return sessions
+    k = resumable[len(resumable) // 2]
+    return sessions[:k + 1] + list(tsv_to_sessions(tsv, start_line=positions[k]['line'],
+                                                   skip_usr=positions[k]['usr'], **kwargs))
+
+
+def _trimmed(pvs):
+    trim_session(pvs)
+    return pvs
+
+
+def _trimmed_after_reading(tsv, kwargs):
+    if not kwargs.get('trim'):
+        return list(tsv_to_sessions(tsv, **kwargs))
+    return [s._replace(duplicates=trim_session(s.pageviews)) for s in tsv_to_sessions(tsv, **dict(kwargs, trim=False))]
+
+
+def _same_args(*case):
+    return case
+
+
+def _trimmed_args(pvs, *params):
+    return (ref_trim(pvs),) + params
+
+
+def _compact_trimmed_args(pvs, *params):
+    return (CompactPageviews(ref_trim(pvs)),) + params
+
+
+# function -> implementation -> (prepare, run): prepare turns a test case into the arguments of run (not timed) and
+# the result of run is compared with the reference implementation's (after RESULT_KEYS)
+IMPLEMENTATIONS = {
+    'trim_session': {
+        'reference': (_same_args, ref_trim),
+        'list': (lambda pvs: (list(pvs),), _trimmed),
+        'compact': (lambda pvs: (CompactPageviews(pvs),), _trimmed),
+    },
+    'get_lang_switch': {
+        'reference': (_trimmed_args, ref_lang_switch),
+        'list': (_trimmed_args, get_lang_switch),
+        'compact': (_compact_trimmed_args, get_lang_switch),
+        'streaming': (_trimmed_args, streamed_lang_switch),
+    },
+    'get_nonlang_switch': {
+        'reference': (_trimmed_args, ref_nonlang_switch),
+        'list': (_trimmed_args, lambda pvs, wikidb, direction: get_nonlang_switch(pvs, wikidb, direction=direction)),
+        'compact': (_compact_trimmed_args,
+                    lambda pvs, wikidb, direction: get_nonlang_switch(pvs, wikidb, direction=direction)),
+        'precomputed': (lambda pvs, wikidb, direction: (ref_trim(pvs), wikidb, direction,
+                                                          ref_lang_switch(ref_trim(pvs), [wikidb])),
+                        lambda pvs, wikidb, direction, switches: get_nonlang_switch(pvs, wikidb, switches, direction)),
+    },
+    'tsv_to_sessions': {
+        'reference': (_same_args, lambda tsv, kwargs: ref_tsv_to_sessions(tsv, **kwargs)),
+        'list': (_same_args, lambda tsv, kwargs: list(tsv_to_sessions(tsv, **kwargs))),
+        'compact': (_same_args, lambda tsv, kwargs: list(tsv_to_sessions(tsv, compact=True, **kwargs))),
+        'trim_session': (_same_args, _trimmed_after_reading),
+        'resumed': (_same_args, lambda tsv, kwargs: resumed_tsv_to_sessions(tsv, **kwargs)),
+    },
+}
+
+# comparable form of each function's results
+RESULT_KEYS = {
+    'trim_session': lambda pvs: [pv_key(pv) for pv in pvs],
+    'get_lang_switch': list,
+    'get_nonlang_switch': list,
+    'tsv_to_sessions': lambda sessions: [session_key(s) for s in sessions],
+}
+
+# implementations that parse every datetime and item id: for them, lines with malformed datetimes or item ids are
+# malformed, so they are compared with the reference implementation run with these options
+STRICT_OPTIONS = {('tsv_to_sessions', 'compact'): {'parse_epochs': True, 'parse_qids': True}}
+
+
+def compare(function, cases):
+    """Run all implementations of function on each case; returns [(implementation, case, expected, result)] for the
+    results that differ from the reference implementation."""
+    implementations = IMPLEMENTATIONS[function]
+    key = RESULT_KEYS[function]
+    mismatches = []
+    for case in cases:
+        expected = {}
+        for impl, (prepare, run) in implementations.items():
+            if impl == 'reference':
+                continue
+            strict = STRICT_OPTIONS.get((function, impl))
+            strict_key = tuple(sorted(strict.items())) if strict else ()
+            if strict_key not in expected:
+                ref_case = (case[0], dict(case[1], **strict)) if strict else case
+                ref_prepare, ref_run = implementations['reference']
+                expected[strict_key] = key(ref_run(*ref_prepare(*ref_case)))
+            result = key(run(*prepare(*case)))
+            if result != expected[strict_key]:
+                mismatches.append((impl, case, expected[strict_key], result))
+    return mismatches
+
+
+def time_implementations(function, cases, repeat=3):
+    """Best-of-repeat seconds each implementation of function takes for all cases (preparation not included)."""
+    timings = {}
+    for impl, (prepare, run) in IMPLEMENTATIONS[function].items():
+        best = None
+        for _ in range(repeat):
+            # prepared again for each repetition: trim_session modifies the page views in place
+            prepared = [prepare(*case) for case in cases]
+            start = time.perf_counter()
+            for args in prepared:
+                run(*args)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[impl] = best
+    return timings
+
+
+def random_pageviews(rand, num_pvs, num_projects=3, num_items=6, missing=0.2):
+    """A session with few projects, titles and items, so that duplicates and switches are common."""
+    pvs = []
+    epoch = START
+    for _ in range(num_pvs):
+        epoch += rand.choice([0, 1, 12, 300])
+        item = rand.randrange(num_items)
+        proj = rand.choice(PROJECTS[:num_projects])
+        wd = rand.choice(['', None]) if rand.random() < missing else 'Q{0}'.format(item + 1)
+        title = 'T{0}'.format(rand.randrange(num_items + 2))
+        referer = rand.choice(PROJECTS[:num_projects] + ['google', ''])
+        pvs.append(Pageview(datetime.fromtimestamp(epoch, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+                            proj, title, wd, referer))
+    return pvs
+
+
+def adversarial_pageviews():
+    """Sessions at the edges of the switch rules."""
+    def pvs(rows):
+        return [Pageview('2019-02-16T11:{0:02d}:00'.format(i % 60), proj, title, wd, referer)
+                for i, (proj, title, wd, referer) in enumerate(rows)]
+    many_projects = ['{0}wiki'.format(lang) for lang in ['en', 'de', 'es', 'fr', 'ja', 'ru', 'it', 'zh', 'ar', 'pt',
+                                                          'nl', 'pl', 'sv', 'uk', 'vi', 'fa', 'he', 'ko', 'id', 'tr']]
+    return [
+        [],
+        pvs([('enwiki', 'A', 'Q1', '')]),
+        # one item on many projects: switches chain from each project to the next
+        pvs([(p, 'A', 'Q1', prev) for p, prev in zip(many_projects, [''] + many_projects)]),
+        # one item going back and forth between two projects (different titles so trimming keeps them)
+        pvs([('enwiki' if i % 2 else 'dewiki', 'A{0}'.format(i), 'Q1', 'google') for i in range(30)]),
+        # the same pages over and over
+        pvs([('enwiki' if i % 3 else 'eswiki', 'A', 'Q1', 'enwiki') for i in range(30)]),
+        # missing items everywhere
+        pvs([(p, 'A', wd, '') for p in PROJECTS for wd in ('', None)]),
+        # a single project
+        pvs([('enwiki', 'A{0}'.format(i), 'Q{0}'.format(i % 3 + 1), 'enwiki') for i in range(20)]),
+        # many projects and few items, referers from other projects
+        pvs([(many_projects[i * 7 % 20], 'A{0}'.format(i), 'Q{0}'.format(i % 5 + 1), many_projects[i * 3 % 20])
+             for i in range(60)]),
+    ]
+
+
+def session_cases(seed=0, num_random=500, max_pvs=12):
+    """Page view lists: randomized (few and many projects) and adversarial."""
+    rand = random.Random(seed)
+    cases = adversarial_pageviews()
+    for _ in range(num_random):
+        num_projects = rand.choice([2, 3, len(PROJECTS)])
+        cases.append(random_pageviews(rand, rand.randrange(1, max_pvs + 1), num_projects=num_projects,
+                                      num_items=rand.choice([2, 6, 20]), missing=rand.choice([0, 0.2, 0.8])))
+    return cases
+
+
+# malformed lines (a {0} is replaced by the user hash)
+MALFORMED = [
+    '',
+    'garbage',
+    '{0}\tenwiki\tA',
+    # no referer and no item: the trailing tab is stripped and the line has too few fields
+    '{0}\tenwiki\tEDITATTEMPT\t1\t2019-02-16T11:31:53\tUS\t',
+    # datetimes: malformed where epochs are parsed, valid variants otherwise
+    '{0}\tenwiki\tA\t1\tnot-a-date\tUS\thttps://en.wikipedia.org/\tQ1',
+    '{0}\tenwiki\tA\t1\t2019-02-16T11:31:5x\tUS\thttps://en.wikipedia.org/\tQ1',
+    '{0}\tenwiki\tA\t1\t2019-02-16T11:31:99\tUS\thttps://en.wikipedia.org/\tQ1',
+    '{0}\tenwiki\tA\t1\t2019-02-16T11:31:-1\tUS\thttps://en.wikipedia.org/\tQ1',
+    '{0}\tenwiki\tA\t1\t2019-02-16T11:31:60\tUS\thttps://en.wikipedia.org/\tQ1',
+    '{0}\tdewiki\tA\t1\t2019-02-16T11:32\tUS\thttps://en.wikipedia.org/\tQ1',
+    '{0}\tdewiki\tB\t1\t2019-02-16T11:32:00Z\tUS\t\tQ2',
+    # item ids: malformed where they are stored as ints, kept as they are otherwise
+    '{0}\tenwiki\tC\t1\t2019-02-16T11:31:53\tUS\t\tfoo',
+    '{0}\tdewiki\tC\t1\t2019-02-16T11:31:54\tUS\t\tP31',
+    '{0}\tdewiki\tD\t1\t2019-02-16T11:31:55\tUS\t\tQ',
+    # no item column
+    '{0}\teswiki\tA\t1\t2019-02-16T11:31:53\tUS\thttps://www.google.com/',
+]
+
+
+def write_random_tsv(fn, num_users, seed=0, malformed=0.05):
+    """Page view TSV sorted by user and time: edits, duplicates, gaps around 1800 seconds, users sharing a compact
+    key and malformed lines."""
+    rand = random.Random(seed)
+    users = sorted('{0:0128x}'.format(rand.getrandbits(512)) for _ in range(num_users))
+    # distinct users with the same 64-bit key
+    if len(users) > 1:
+        users[1] = users[0][:16] + users[1][16:]
+        users.sort()
+    with gzip.open(fn, 'wt') as fout:
+        fout.write('\t'.join(HEADER) + '\n')
+        for usr in users:
+            country = rand.choice(['US', 'Norway', 'Unknown'])
+            epoch = START + rand.randrange(86400)
+            for _ in range(rand.randrange(1, 16)):
+                epoch += rand.choice([0, 5, 60, 1799, 1800, 1801, 4000])
+                dt = datetime.fromtimestamp(epoch, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+                if rand.random() < malformed:
+                    fout.write(rand.choice(MALFORMED).format(usr) + '\n')
+                item = rand.randrange(5)
+                proj = rand.choice(PROJECTS[:4])
+                title = EDIT_STR if rand.random() < 0.1 else 'T{0}'.format(item)
+                referer = rand.choice(['https://{0}.wikipedia.org/'.format(proj[:2]), 'https://www.google.com/',
+                                       'https://en.wikipedia.org/wiki/X', 'https://duckduckgo.com/'])
+                row = [usr, proj, title, str(item), dt, country, referer]
+                if rand.random() < 0.9:
+                    row.append('Q{0}'.format(item + 1) if rand.random() < 0.8 else '')
+                fout.write('\t'.join(row) + '\n')
+
+
+def tsv_cases(tsv):
+    """Reading options to compare tsv_to_sessions implementations with."""
+    return [(tsv, kwargs) for kwargs in [{}, {'trim': True}, {'trim': True, 'gap_seconds': 1800},
+                                         {'gap_seconds': 0}, {'trim': True, 'sample_rate': 0.5}]]
+
+
+def switch_cases(pvs_cases):
+    """(page views, wikidbs, ref_match) and (page views, wikidb, direction) parameter combinations."""
+    lang = [(pvs, wikidbs, ref_match) for pvs in pvs_cases
+            for wikidbs, ref_match in [((), False), (('enwiki',), False), (('dewiki', 'eswiki'), False), ((), True)]]
+    nonlang = [(pvs, wikidb, direction) for pvs in pvs_cases
+               for wikidb in ['enwiki', 'eswiki'] for direction in ['from', 'to']]
+    return lang, nonlang
@@ -1,20 +1,18 @@
 import argparse
-import csv
 import gzip
-import json
 import os
 import time
 import traceback
 
-import mwapi
-import pandas as pd
+from dataset_io import read_dataset
+from revid_cache import RevidCache
 
 """
 Steps:
  1) Get mapping of all QIDs -> titles in English Wikipedia
  2) Loop through language switches dataset, gathering all the QIDs and their associated English article titles (where possible)
  3) Get the most recent revision ID on English Wikipedia for these QIDs
- 4) In a later step, query ORES for drafttopic, which can then be applied to that QID
+ 4) In a later step (ores_scoring.py), query ORES for drafttopic, which can then be applied to that QID
 """
 
 def get_qid_to_enwikititle():
@@ -32,22 +30,20 @@ def get_qid_to_enwikititle():
     return qid_to_entitle
 
 
-def add_revids(langswitches_tsv, output_fn, include_nonswitches=False):
-    """Use this to generate the input for the ORES API"""
-    header = ['switch', 'country', 'qid', 'title', 'datetime', 'usertype']
-    qid_idx = header.index('qid')
-    title_idx = header.index('title')
-    switch_idx = header.index('switch')
-    qid_to_revid = {}
-    qid_to_entitle = get_qid_to_enwikititle()
+def add_revids(langswitches_tsv, output_fn, include_nonswitches=False, cache=None, qid_to_entitle=None):
+    """Use this to generate the input for the ORES API
+
+    Revision IDs are looked up in (and added to) cache, a RevidCache that can be shared across languages,
+    so only QIDs that are missing or stale are fetched. The dataset's QIDs are then exported to output_fn.
+    """
+    if cache is None:
+        cache = RevidCache(os.path.join(os.path.dirname(output_fn), 'qid_revids.sqlite'))
+    if qid_to_entitle is None:
+        qid_to_entitle = get_qid_to_enwikititle()
     if os.path.exists(output_fn):
-        with open(output_fn, 'r') as fin:
-            for line in fin:
-                record = json.loads(line)
-                try:
-                    qid_to_revid[record['qid']] = int(record['rev_id'])
-                except TypeError:
-                    qid_to_revid[record['qid']] = 0
+        print("Importing {0} existing revIDs from {1}".format(cache.import_json(output_fn), output_fn))
+
+    import mwapi
 
     max_titles_per_query = 50
     session = mwapi.Session(host='https://en.wikipedia.org',
@@ -60,41 +56,46 @@ def add_revids(langswitches_tsv, output_fn, include_nonswitches=False):
                        'rvslots': 'main',
                        'redirects':'true'}
 
-    with open(langswitches_tsv, 'r') as fin:
-        tsvreader = csv.reader(fin, delimiter='\t')
-        title_to_qid = {}
-        i = 0
-        for line in tsvreader:
-            if i % 1000 == 0:
-                print("{0} lines processed.\t{1} revIDs.".format(i, len(qid_to_revid) + len(title_to_qid)))
-            i += 1
-            if not include_nonswitches and line[switch_idx] == 'N\A' or line[switch_idx] == 'N/A':
-                continue
-            qid = line[qid_idx]
-            if qid and qid not in qid_to_revid:
-                # get canonical title from wikidata mapping, else title reported in dataset
-                title = qid_to_entitle.get(qid, line[title_idx])
-                if title and title not in title_to_qid:
-                    title_to_qid[title] = qid
-                    if len(title_to_qid) == max_titles_per_query:
-                        try:
-                            title_to_revid = get_revids_by_title(session, base_parameters, title_to_qid)
-                            qid_to_revid.update({title_to_qid[title]:revid for title,revid in title_to_revid.items()})
-                            title_to_qid = {}
-                        except Exception:
-                            traceback.print_exc()
-                            print("Breaking off at line {0}".format(i+1))
-                            title_to_qid = {}
-                            break
-        title_to_revid = get_revids_by_title(session, base_parameters, title_to_qid)
-        qid_to_revid.update({title_to_qid[title]:revid for title, revid in title_to_revid.items()})
-        print("Finished: {0} lines processed. {1} revIDs.".format(i, len(qid_to_revid)))
+    # non-switches only have to be read if they are included
+    rows = read_dataset(langswitches_tsv, columns=['qid', 'title'], switches_only=not include_nonswitches)
+    dataset_qids = set(qid for qid, _ in rows if qid)
+    to_fetch = cache.missing(dataset_qids)
+    print("{0} lines; {1} QIDs; {2} not in cache (or stale).".format(len(rows), len(dataset_qids), len(to_fetch)))
+
+    title_to_qid = {}
+    i = 0
+    fetched = 0
+    for qid, dataset_title in rows:
+        if i % 1000 == 0:
+            print("{0} lines processed.\t{1} revIDs fetched.".format(i, fetched))
+        i += 1
+        if qid in to_fetch:
+            to_fetch.discard(qid)
+            # get canonical title from wikidata mapping, else title reported in dataset
+            title = qid_to_entitle.get(qid, dataset_title)
+            if title and title not in title_to_qid:
+                title_to_qid[title] = qid
+                if len(title_to_qid) == max_titles_per_query:
+                    try:
+                        fetched += fetch_revids(session, base_parameters, title_to_qid, cache)
+                        title_to_qid = {}
+                    except Exception:
+                        traceback.print_exc()
+                        print("Breaking off at line {0}".format(i+1))
+                        title_to_qid = {}
+                        break
+    fetched += fetch_revids(session, base_parameters, title_to_qid, cache)
+    print("Finished: {0} lines processed. {1} revIDs fetched.".format(i, fetched))
 
     # dump in correct format
-    revid_df = pd.DataFrame([(qid, revid) for qid, revid in qid_to_revid.items()],
-                            columns=['qid', 'rev_id'])
-    revid_df['rev_id'] = revid_df['rev_id'].astype('int64')
-    revid_df.to_json(path_or_buf=output_fn, orient='records', lines=True)
+    print("{0} revIDs written to {1}".format(cache.export_json(output_fn, dataset_qids), output_fn))
+
+
+def fetch_revids(session, base_parameters, title_to_qid, cache):
+    """Get the most recent revision IDs for a batch of titles and add them to the cache."""
+    title_to_revid = get_revids_by_title(session, base_parameters, title_to_qid)
+    cache.put_many([(title_to_qid[title], title, revid) for title, revid in title_to_revid.items()])
+    return len(title_to_revid)
 
 
 def get_revids_by_title(session, base_parameters, titles):
@@ -118,12 +119,21 @@ def get_revids_by_title(session, base_parameters, titles):
                 title_to_revid[query_title] = 0
     return title_to_revid
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--switches_tsvs", nargs="+")
     parser.add_argument("--include_nonswitches", action="store_true", default=False)
+    parser.add_argument("--cache_db", default="qid_revids.sqlite",
+                        help="SQLite cache of QID -> revision ID shared by all switch datasets")
+    parser.add_argument("--ttl_days", type=float, default=None,
+                        help="Refetch revision IDs that were fetched more than this many days ago")
+    parser.add_argument("--export_json", default=None,
+                        help="If given, also write every cached QID -> revision ID to this JSON-lines file")
     args = parser.parse_args()
 
+    cache = RevidCache(args.cache_db, ttl_days=args.ttl_days)
+    qid_to_entitle = get_qid_to_enwikititle()
+
     for fn in args.switches_tsvs:
         if not os.path.exists(fn):
             print("{0} does not exist. Skipping.".format(fn))
@@ -133,6 +143,11 @@ if __name__ == "__main__":
             output_fn = os.path.join(dir, 'qid_revids.json')
             print("Processing {0}. From {1} to {2}".format(lang, fn, output_fn))
             time.sleep(3)
-            add_revids(fn, output_fn, args.include_nonswitches)
+            add_revids(fn, output_fn, args.include_nonswitches, cache=cache, qid_to_entitle=qid_to_entitle)
 
+    if args.export_json:
+        print("{0} revIDs written to {1}".format(cache.export_json(args.export_json), args.export_json))
+    cache.close()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Mergeable histograms in logarithmic bins (e.g., of seconds between two page views): with r bins per doubling,
+quantiles have a relative error of ~2^(1/r) - 1 (r=8: 9%), and histograms built by different processes, shards or days
+are merged by adding their bin counts."""
+
+import argparse
+import csv
+import json
+import math
+
+QUANTILES = (0.25, 0.5, 0.75, 0.9)
+
+class LogHistogram:
+    """Counts of non-negative values in log-spaced bins: bin 0 holds [0, 1); bin b > 0 holds
+    [2^((b-1)/resolution), 2^(b/resolution))."""
+
+    __slots__ = ('resolution', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, resolution=8):
+        self.resolution = resolution
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        """Count a value (negative values, e.g., from out-of-order timestamps, are counted as 0)."""
+        if value < 1:
+            b = 0
+            value = max(value, 0)
+        else:
+            b = 1 + int(math.log2(value) * self.resolution)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Fold another histogram (with the same resolution) into this one."""
+        if other.resolution != self.resolution:
+            raise ValueError("Cannot merge histograms with resolution {0} and {1}.".format(
+                self.resolution, other.resolution))
+        for b, n in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def bounds(self, b):
+        if b == 0:
+            return 0, 1
+        return 2 ** ((b - 1) / self.resolution), 2 ** (b / self.resolution)
+
+    def quantile(self, q):
+        """Approximate q-quantile: the geometric middle of the bin that holds it (at most the maximum)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                low, high = self.bounds(b)
+                return min((low * high) ** 0.5 if b else 0, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    def to_dict(self):
+        return {'resolution': self.resolution, 'counts': {str(b): n for b, n in sorted(self.counts.items())},
+                'count': self.count, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        hist = cls(d['resolution'])
+        hist.counts = {int(b): n for b, n in d['counts'].items()}
+        hist.count = d['count']
+        hist.total = d['total']
+        hist.max = d['max']
+        return hist
+
+
+def save_histograms(fn, histograms):
+    """Write nested dicts of histograms (e.g., {usertype: {'latency': {pair: LogHistogram}}}) to a JSON file."""
+    def encode(d):
+        if isinstance(d, LogHistogram):
+            return d.to_dict()
+        return {k: encode(v) for k, v in d.items()}
+    with open(fn, 'w') as fout:
+        json.dump(encode(histograms), fout)
+
+
+def load_histograms(fn):
+    def decode(d):
+        if 'resolution' in d and 'counts' in d:
+            return LogHistogram.from_dict(d)
+        return {k: decode(v) for k, v in d.items()}
+    with open(fn, 'r') as fin:
+        return decode(json.load(fin))
+
+
+def merge_histograms(into, other):
+    """Merge nested dicts of histograms in place (keys missing from into are added)."""
+    for k, v in other.items():
+        if k not in into:
+            into[k] = v
+        elif isinstance(v, LogHistogram):
+            into[k].merge(v)
+        else:
+            merge_histograms(into[k], v)
+    return into
+
+
+def write_quantiles(fn, histograms):
+    """Write summaries of desc_stats timing histograms ({usertype: {kind: {pair: LogHistogram}}}) as a TSV with one
+    row per usertype, kind (latency / dwell) and language pair."""
+    with open(fn, 'w') as fout:
+        csvwriter = csv.writer(fout, delimiter="\t")
+        csvwriter.writerow(['usertype', 'kind', 'pair', 'count', 'mean', 'max'] +
+                           ['p{0:.0f}'.format(q * 100) for q in QUANTILES])
+        for ut, kinds in histograms.items():
+            for kind, pairs in kinds.items():
+                for pair, hist in sorted(pairs.items(), key=lambda x: x[1].count, reverse=True):
+                    csvwriter.writerow([ut, kind, pair, hist.count, round(hist.mean(), 1), hist.max] +
+                                       [round(hist.quantile(q), 1) for q in QUANTILES])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--histograms", nargs="+", required=True,
+                        help="Histogram JSON files (desc_stats.py --timing_fn) to merge")
+    parser.add_argument("--output",
+                        help="Write the merged histograms to this JSON file")
+    parser.add_argument("--tsv",
+                        help="Write quantiles of the merged histograms to this TSV")
+    args = parser.parse_args()
+
+    merged = {}
+    for fn in args.histograms:
+        merge_histograms(merged, load_histograms(fn))
+    if args.output:
+        save_histograms(args.output, merged)
+    if args.tsv:
+        write_quantiles(args.tsv, merged)
+
+if __name__ == "__main__":
+    main()
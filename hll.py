@@ -0,0 +1,143 @@
+"""HyperLogLog sketches for approximate distinct counts (e.g., distinct QIDs, countries or users behind a language
+pair): 2^p one-byte registers with a relative standard error of ~1.04 / sqrt(2^p), hashed with blake2b so that sketches
+built by different processes, shards or days can be merged."""
+
+import argparse
+import base64
+import csv
+import hashlib
+import json
+import math
+
+HASH_BITS = 64
+
+class HyperLogLog:
+    """Mergeable distinct-count sketch with 2^precision registers."""
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=10, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError("HyperLogLog precision must be between 4 and 18.")
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        """Add a value (str, int or bytes); None is ignored."""
+        if value is None:
+            return
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        x = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+        rest_bits = HASH_BITS - self.precision
+        idx = x >> rest_bits
+        # position of the leftmost 1-bit in the remaining bits
+        rank = rest_bits - (x & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Fold another sketch (with the same precision) into this one."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches with precision {0} and {1}.".format(
+                self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Estimated number of distinct values added."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # small cardinalities: linear counting on the empty registers is more accurate
+        if estimate <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return estimate
+
+    def __len__(self):
+        return int(round(self.count()))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], data[1:])
+
+    def to_str(self):
+        """Compact text form (base64) for JSON files."""
+        return base64.b64encode(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def from_str(cls, data):
+        return cls.from_bytes(base64.b64decode(data))
+
+
+def save_sketches(fn, sketches):
+    """Write nested dicts of sketches (e.g., {usertype: {pair: {'qids': HyperLogLog}}}) to a JSON file."""
+    def encode(d):
+        if isinstance(d, HyperLogLog):
+            return d.to_str()
+        return {k: encode(v) for k, v in d.items()}
+    with open(fn, 'w') as fout:
+        json.dump(encode(sketches), fout)
+
+
+def load_sketches(fn):
+    def decode(d):
+        if isinstance(d, str):
+            return HyperLogLog.from_str(d)
+        return {k: decode(v) for k, v in d.items()}
+    with open(fn, 'r') as fin:
+        return decode(json.load(fin))
+
+
+def merge_sketches(into, other):
+    """Merge nested dicts of sketches in place (keys missing from into are added)."""
+    for k, v in other.items():
+        if k not in into:
+            into[k] = v
+        elif isinstance(v, HyperLogLog):
+            into[k].merge(v)
+        else:
+            merge_sketches(into[k], v)
+    return into
+
+
+def write_estimates(fn, sketches):
+    """Write the distinct-count estimates of reader_language_overlap sketches ({usertype: {kind: {key: {what: HLL}}}})
+    as a TSV with one row per usertype, kind (pair / project) and key."""
+    with open(fn, 'w') as fout:
+        csvwriter = csv.writer(fout, delimiter="\t")
+        csvwriter.writerow(['usertype', 'kind', 'key', 'distinct_qids', 'distinct_countries', 'distinct_users'])
+        for ut, kinds in sketches.items():
+            for kind, keys in kinds.items():
+                for key, by_what in sorted(keys.items()):
+                    csvwriter.writerow([ut, kind, key] + [len(by_what[w]) for w in ('qids', 'countries', 'users')])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sketches", nargs="+", required=True,
+                        help="Sketch JSON files (reader_language_overlap.py --hll_fn) to merge")
+    parser.add_argument("--output",
+                        help="Write the merged sketches to this JSON file")
+    parser.add_argument("--tsv",
+                        help="Write distinct-count estimates of the merged sketches to this TSV")
+    args = parser.parse_args()
+
+    merged = {}
+    for fn in args.sketches:
+        merge_sketches(merged, load_sketches(fn))
+    if args.output:
+        save_sketches(args.output, merged)
+    if args.tsv:
+        write_estimates(args.tsv, merged)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Single entry point for the language switching scripts: `python langswitch.py <command> [options]` runs the main() of
+the command's script with the remaining arguments, importing the script (and its heavy dependencies) only when it
+runs."""
+
+import importlib
+import logging
+import sys
+
+# command -> (module, description)
+COMMANDS = {
+    'stats': ('desc_stats', "descriptive statistics of sessions and language switching"),
+    'overlap': ('reader_language_overlap', "switching / co-occurrence counts between projects"),
+    'multi': ('multi_analysis', "several analyses in a single pass over the page view TSVs"),
+    'dataset': ('lda_predictive_model', "build the language switch dataset and fit the predictive model"),
+    'index': ('switch_index', "query a QID x project switch index"),
+    'cube': ('switch_cube', "query a usertype x country x project x project switch cube"),
+    'serve': ('query_service', "HTTP/JSON service over a switch index"),
+    'stream': ('stream_switches', "windowed switch statistics over a stream of page views"),
+    'hll': ('hll', "merge HyperLogLog sketch files"),
+    'histogram': ('histogram', "merge switch timing histogram files"),
+    'categories': ('get_categories', "revision IDs of the switched articles (input for ores)"),
+    'ores': ('ores_scoring', "ORES drafttopic predictions for revision IDs"),
+    'topics': ('switches_by_category', "topics most associated with switching"),
+    'benchmark': ('benchmarks', "memory / speed benchmarks"),
+}
+
+
+def usage():
+    lines = ["usage: langswitch <command> [options]", "", "commands:"]
+    lines.extend("  {0:<12}{1}".format(command, desc) for command, (_, desc) in COMMANDS.items())
+    lines.append("\nRun `langswitch <command> --help` for the options of a command.")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    command = argv[0]
+    if command not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        sys.exit("langswitch: unknown command '{0}'".format(command))
+    module = importlib.import_module(COMMANDS[command][0])
+    # the scripts parse sys.argv themselves; the program name shows up in their usage messages
+    sys.argv = ['langswitch {0}'.format(command)] + argv[1:]
+    module.main()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,4 +1,5 @@
 import argparse
+from array import array
 import csv
 import glob
 import logging
@@ -6,15 +7,20 @@ import os
 import pickle
 
 import numpy as np
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import cross_val_score
 
-from session_utils import tsv_to_sessions
+from dataset_io import NON_SWITCH_PLACEHOLDER
+from dataset_io import read_dataset
+from dataset_io import write_dataset
 from session_utils import get_lang_switch
 from session_utils import get_nonlang_switch
+from session_utils import qid_to_int
+from session_utils import scan_sessions
+from session_utils import SessionConsumer
+from session_utils import Vocab
+import topic_store
 
-NON_SWITCH_PLACEHOLDER = "N/A"
+# country ids are packed into the low bits of a single int64 key per (title, country)
+COUNTRY_BITS = 16
 
 def load_topic_model(lda_dir, lang):
     # load in topic model for selected language
@@ -55,134 +61,272 @@ def load_topic_model(lda_dir, lang):
 
     return (ndims, titles, topic_model, topic_descs)
 
-def build_dataset(args, wiki_db):
-    switches = []
-    non_switches = []
-    direction = args.direction
-    wd_to_entitle = {}
-    pvs_per_title = {}
-    # build balanced dataset
-    i = 0
-    for tsv in args.tsvs:
-        logging.info("Analyzing: {0}".format(tsv))
-        for session in tsv_to_sessions(tsv, trim=True):
-            if i == args.stopafter:
-                break
-            i += 1
-            if i % args.log_every == 0:
-                logging.info("{0} sessions analyzed.".format(i))
-
-            ut = session.usertype
-
-            # update country-pagetitle stats for filtering
-            pvs = session.pageviews
-            for pv in pvs:
-                if pv.proj == wiki_db:
-                    ttl = pv.title
-                    cntry = session.country
-                    if ttl not in pvs_per_title:
-                        pvs_per_title[ttl] = {}
-                    pvs_per_title[ttl][cntry] = pvs_per_title[ttl].get(cntry, 0) + 1
-
-            # filter out likely bots
-            num_pvs = len(pvs)
-            if num_pvs > args.maxpvs:
-                continue
-
-            # QID -> English title for more interpretable results
-            for pv in session.pageviews:
-                if pv.wd and pv.proj == 'enwiki':
-                    wd_to_entitle[pv.wd] = pv.title
-
-            # only analyze language switching when >1 pageview associated w/ device (~50% of sessions)
-            if num_pvs > 1:
-                unique_langs = set([p.proj for p in pvs])
-                # has language of interest and at least one potential switch
-                candidate = wiki_db in unique_langs and len(unique_langs) > 1
-                if candidate:
-                    user_switches = get_lang_switch(pvs, [wiki_db])
-                    # only include users with switches (even if they don't match the direction)
-                    if user_switches:
-                        user_non_switches = get_nonlang_switch(pvs, wiki_db, user_switches, direction=direction)
-                        if direction == "from":
-                            switches.extend(
-                                [(pvs[j].proj, session.country, pvs[i].wd, pvs[i].title, pvs[i].dt, ut) for i, j in
-                                 user_switches if pvs[i].proj == wiki_db])
-                        elif direction == "to":
-                            switches.extend(
-                                [(pvs[i].proj, session.country, pvs[j].wd, pvs[j].title, pvs[j].dt, ut) for i, j in
-                                 user_switches if pvs[j].proj == wiki_db])
-                        non_switches.extend(
-                            [(NON_SWITCH_PLACEHOLDER, session.country, pvs[i].wd, pvs[i].title, pvs[i].dt, ut) for i in
-                             user_non_switches if pvs[i].proj == wiki_db])
-                        logging.debug('{0} pvs:\t{1}'.format(len(pvs), pvs))
-                        logging.debug('    Switches:\t{0}'.format([(pvs[i], pvs[j]) for i, j in user_switches]))
-                        logging.debug('Non-switches:\t{0}'.format([pvs[i] for i in user_non_switches]))
-
-    logging.info("{0} sessions analyzed.".format(i))
-
-    logging.info("Before filtering:")
-    logging.info("{0} switches.".format(len(switches)))
-    logging.info("{0} non switches.".format(len(non_switches)))
-
-    if args.output_tsv:
-        with open(args.output_tsv, 'w') as fout:
-            csvwriter = csv.writer(fout, delimiter="\t")
-            kept = 0
-            under_filter = 0
-            np.random.shuffle(switches)
-            for s in switches:
-                pvs_to_country_article_pair = pvs_per_title[s[3]][s[1]]
-                if pvs_to_country_article_pair >= args.min_filtering:
-                    kept += 1
-                else:
-                    under_filter += 1
-                csvwriter.writerow([f for f in s] + [pvs_to_country_article_pair])
-            logging.info("{0} switches kept; {1} did not meet country-pagetitle filter of {2}".format(
-                kept, under_filter, args.min_filtering))
-            kept = 0
-            under_filter = 0
-            np.random.shuffle(non_switches)
-            for n in non_switches:
-                pvs_to_country_article_pair = pvs_per_title[n[3]][n[1]]
-                if pvs_to_country_article_pair >= args.min_filtering:
-                    kept += 1
-                else:
-                    under_filter += 1
-                csvwriter.writerow([f for f in n] + [pvs_to_country_article_pair])
-            logging.info("{0} non-switches kept; {1} did not meet country-pagetitle filter of {2}".format(
-                kept, under_filter, args.min_filtering))
+def get_topic_model(args, lang):
+    """Same as load_topic_model, but attached from the shared topic store in args.topic_store (if given).
+
+    The first run publishes the model to the store; later runs and parallel workers memory-map it instead of
+    each parsing and holding a private copy.
+    """
+    if not args.topic_store:
+        return load_topic_model(args.lda_dir, lang)
+    if not topic_store.exists(args.topic_store, lang):
+        ndims, titles, topic_model, topic_descs = load_topic_model(args.lda_dir, lang)
+        if not ndims:
+            return (ndims, titles, topic_model, topic_descs)
+        logging.info("Publishing {0} topic model to {1}".format(lang, args.topic_store))
+        topic_store.publish(args.topic_store, lang, titles, topic_model, topic_descs)
+    store = topic_store.TopicStore.attach(args.topic_store, lang)
+    return (store.ndims, store.titles, store.topic_model, store.topic_descs)
+
+class TitleFeatures:
+    """Topic vectors for dataset rows from a single language's topic model, looked up by article title."""
+
+    def __init__(self, titles, topic_model):
+        self.titles = titles
+        self.topic_model = topic_model
+
+    def found(self, rows):
+        return np.array([r[3] in self.titles for r in rows], dtype=bool)
+
+    def features(self, rows):
+        return np.asarray(self.topic_model[[self.titles[r[3]] for r in rows]], dtype=np.float32)
+
+
+class QidFeatures:
+    """Topic vectors for dataset rows looked up by QID in one or more languages' topic models (see QidEmbeddings)."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    @staticmethod
+    def _qid(qid):
+        # item ids that are not QIDs (e.g., 'P31') are treated as missing: 0 is never in a QID index
+        try:
+            return qid_to_int(qid)
+        except ValueError:
+            return 0
+
+    @classmethod
+    def qids(cls, rows):
+        return np.fromiter((cls._qid(r[2]) for r in rows), dtype=np.int64, count=len(rows))
+
+    def found(self, rows):
+        return self.embeddings.found(self.qids(rows))
+
+    def features(self, rows):
+        return self.embeddings.features(self.qids(rows))
+
+
+def get_features(args, lang):
+    """Get (ndims, topic descriptions, featurizer) for the dataset of a language.
+
+    With --topic_store, features are gathered by QID from the shared store: lang's topic model followed by those of
+    --embedding_langs (models and QID indices are published on first use). Otherwise, lang's topic model is loaded
+    from --lda_dir and features are gathered by title.
+    """
+    if not args.topic_store:
+        ndims, titles, topic_model, topic_descs = load_topic_model(args.lda_dir, lang)
+        return ndims, topic_descs, TitleFeatures(titles, topic_model)
+    langs = [lang] + [l for l in args.embedding_langs if l != lang]
+    for l in langs:
+        if not get_topic_model(args, l)[0]:
+            logging.info("No topic model for {0}.".format(l))
+            return 0, [], None
+    missing = [l for l in langs if not topic_store.has_qid_index(args.topic_store, l)]
+    if missing:
+        logging.info("Indexing {0} topic models by QID with {1}".format(missing, args.qid_to_pid))
+        qid_titles = topic_store.read_qid_titles(args.qid_to_pid, ['{0}wiki'.format(l) for l in missing])
+        for l in missing:
+            num_qids = topic_store.publish_qid_index(args.topic_store, l, qid_titles['{0}wiki'.format(l)])
+            logging.info("{0}: {1} QIDs with topics.".format(l, num_qids))
+    embeddings = topic_store.QidEmbeddings.attach(args.topic_store, langs)
+    return embeddings.ndims, embeddings.topic_descs, QidFeatures(embeddings)
+
+
+class SortedCounter:
+    """Counts of int64 keys kept as sorted (keys, counts) arrays: 16 bytes per distinct key.
+
+    New keys are appended to a buffer that is merged in with np.unique once it holds buffer_size keys.
+    """
+
+    def __init__(self, buffer_size=1 << 20):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.buffer = array('q')
+        self.buffer_size = buffer_size
+
+    def add(self, key):
+        self.buffer.append(key)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        new_keys, new_counts = np.unique(np.frombuffer(self.buffer, dtype=np.int64), return_counts=True)
+        keys = np.concatenate([self.keys, new_keys])
+        counts = np.concatenate([self.counts, new_counts])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        counts = counts[order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        self.keys = keys[starts]
+        self.counts = np.add.reduceat(counts, starts)
+        self.buffer = array('q')
+
+    def lookup(self, keys):
+        """Counts for an array of keys (0 for keys never added)."""
+        self.flush()
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[idx] == keys, self.counts[idx], 0)
+
+    def __len__(self):
+        self.flush()
+        return len(self.keys)
+
+
+class DatasetBuilder(SessionConsumer):
+    """Collects language switches and non-switches for a single wiki to build a balanced dataset."""
+
+    def __init__(self, args, wiki_db):
+        self.args = args
+        self.wiki_db = wiki_db
+        self.switches = []
+        self.non_switches = []
+        self.wd_to_entitle = {}
+        # page views per (title, country) on wiki_db, keyed by title id << COUNTRY_BITS | country id
+        self.titles = Vocab()
+        self.countries = Vocab()
+        self.title_country_pvs = SortedCounter()
+
+    def consume(self, session):
+        wiki_db = self.wiki_db
+        direction = self.args.direction
+        ut = session.usertype
+
+        # update country-pagetitle stats for filtering
+        pvs = session.pageviews
+        country_id = self.countries.id(session.country)
+        for pv in pvs:
+            if pv.proj == wiki_db:
+                self.title_country_pvs.add((self.titles.id(pv.title) << COUNTRY_BITS) | country_id)
+
+        # filter out likely bots
+        num_pvs = len(pvs)
+        if num_pvs > self.args.maxpvs:
+            return
+
+        # QID -> English title for more interpretable results
+        for pv in session.pageviews:
+            if pv.wd and pv.proj == 'enwiki':
+                self.wd_to_entitle[pv.wd] = pv.title
+
+        # only analyze language switching when >1 pageview associated w/ device (~50% of sessions)
+        if num_pvs > 1:
+            unique_langs = set([p.proj for p in pvs])
+            # has language of interest and at least one potential switch
+            candidate = wiki_db in unique_langs and len(unique_langs) > 1
+            if candidate:
+                user_switches = get_lang_switch(pvs, [wiki_db])
+                # only include users with switches (even if they don't match the direction)
+                if user_switches:
+                    user_non_switches = get_nonlang_switch(pvs, wiki_db, user_switches, direction=direction)
+                    if direction == "from":
+                        self.switches.extend(
+                            [(pvs[j].proj, session.country, pvs[i].wd, pvs[i].title, pvs[i].dt, ut) for i, j in
+                             user_switches if pvs[i].proj == wiki_db])
+                    elif direction == "to":
+                        self.switches.extend(
+                            [(pvs[i].proj, session.country, pvs[j].wd, pvs[j].title, pvs[j].dt, ut) for i, j in
+                             user_switches if pvs[j].proj == wiki_db])
+                    self.non_switches.extend(
+                        [(NON_SWITCH_PLACEHOLDER, session.country, pvs[i].wd, pvs[i].title, pvs[i].dt, ut) for i in
+                         user_non_switches if pvs[i].proj == wiki_db])
+                    logging.debug('{0} pvs:\t{1}'.format(len(pvs), pvs))
+                    logging.debug('    Switches:\t{0}'.format([(pvs[i], pvs[j]) for i, j in user_switches]))
+                    logging.debug('Non-switches:\t{0}'.format([pvs[i] for i in user_non_switches]))
+
+    def report(self):
+        switches = self.switches
+        non_switches = self.non_switches
+        args = self.args
 
-    return switches, non_switches
+        logging.info("Before filtering:")
+        logging.info("{0} switches.".format(len(switches)))
+        logging.info("{0} non switches.".format(len(non_switches)))
+
+        if args.output_tsv:
+            rows = []
+            for lbl, dataset in [("switches", switches), ("non-switches", non_switches)]:
+                np.random.shuffle(dataset)
+                # unknown titles / countries (id -1) give negative keys that are not found and get a count of 0
+                keys = np.fromiter(
+                    ((self.titles.get(s[3]) << COUNTRY_BITS) | self.countries.get(s[1]) for s in dataset),
+                    dtype=np.int64, count=len(dataset))
+                pvs_to_country_article_pair = self.title_country_pvs.lookup(keys)
+                kept = int(np.count_nonzero(pvs_to_country_article_pair >= args.min_filtering))
+                under_filter = len(dataset) - kept
+                rows.extend([f for f in s] + [count] for s, count in zip(dataset, pvs_to_country_article_pair.tolist()))
+                logging.info("{0} {1} kept; {2} did not meet country-pagetitle filter of {3}".format(
+                    kept, lbl, under_filter, args.min_filtering))
+            write_dataset(args.output_tsv, rows, self.wiki_db, args.direction)
+
+        return switches, non_switches
+
+def build_dataset(args, wiki_db):
+    builder = DatasetBuilder(args, wiki_db)
+    scan_sessions(args.tsvs, [builder], stopafter=args.stopafter, log_every=args.log_every,
+                  sample_rate=args.sample_rate, gap_seconds=args.gap_seconds, checkpoint=args.checkpoint,
+                  checkpoint_every=args.checkpoint_every, resume=args.resume, max_pvs=args.early_maxpvs,
+                  max_per_minute=args.max_per_minute)
+    return builder.report()
 
 def load_dataset(args):
-    switches = []
-    non_switches = []
-    with open(args.output_tsv, 'r') as fin:
-        tsvreader = csv.reader(fin, delimiter="\t")
-        for line in tsvreader:
-            if line[0] == NON_SWITCH_PLACEHOLDER:
-                non_switches.append(line)
-            elif line[0]:
-                switches.append(line)
+    switches = [line for line in read_dataset(args.output_tsv, switches_only=True) if line[0]]
+    non_switches = read_dataset(args.output_tsv, non_switches_only=True)
     return switches, non_switches
 
 
 def filter_dataset(args):
     pass
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--tsvs", nargs="+",
                         help=".tsv files with anonymized page views ordered by user/datetime")
     parser.add_argument("--lda_dir", default="/home/flemmerich/wikimotifs2/data/text/",
                         help="directory holding LDA topic models and metadata")
+    parser.add_argument("--topic_store", default=None,
+                        help="directory of memory-mapped topic models shared by runs / processes (topic_store.py)")
+    parser.add_argument("--embedding_langs", nargs="*", default=[],
+                        help="with --topic_store: also use these languages' topic vectors of the same QID, e.g., en")
+    parser.add_argument("--qid_to_pid", default="resources/qid_to_pid.tsv.gz",
+                        help="QID <-> page title mapping used to index topic models by QID")
     parser.add_argument("--lang", default="eswiki",
                         help="Language to build dataset for -- e.g., eswiki")
     parser.add_argument("--direction", default="from",
                         help="Either to or from depending on if switch should be from lang or to lang")
     parser.add_argument("--stopafter", type=int, default=-1,
                         help="Process only this many sessions.")
+    parser.add_argument("--sample_rate", type=float, default=1.0,
+                        help="Only analyze this fraction of users (selected deterministically by user hash).")
+    parser.add_argument("--gap_seconds", type=int, default=None,
+                        help="Split users' page views into sessions at gaps of more than n seconds (e.g., 1800).")
+    parser.add_argument("--checkpoint",
+                        help="Save counts and input position to this file after each TSV (to --resume from).")
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="With --checkpoint: also checkpoint after every n sessions.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from --checkpoint (same --tsvs and options).")
+    parser.add_argument("--early_maxpvs", type=int, default=None,
+                        help="Drop users while reading as soon as a session has more than n pageviews (likely bots; "
+                             "their remaining lines are not parsed).")
+    parser.add_argument("--max_per_minute", type=int, default=None,
+                        help="Drop users while reading as soon as they have more than n page views in one minute "
+                             "(likely bots).")
     parser.add_argument("--debug", action="store_true",
                         help="More verbose logging")
     parser.add_argument("--maxpvs", type=int, default=100,
@@ -192,12 +336,15 @@ def main():
     parser.add_argument("--numfolds", type=int, default=10,
                         help="number of folds for new train/test of logistic regression model")
     parser.add_argument("--output_tsv", default=None,
-                        help=".tsv file to write balanced dataset to for future analyses")
+                        help=".tsv (or typed, columnar .parquet) file to write balanced dataset to for future analyses")
     parser.add_argument("--results_tsv", default=None,
                         help=".tsv file to write model results to")
     parser.add_argument("--log_every", type=int, default=500000,
                         help="Log after processing every n sessions.")
-    args = parser.parse_args()
+    return parser
+
+def main():
+    args = get_parser().parse_args()
 
     logging.info(("Assumptions:\n"
                    "\t*only Wikipedia projects considered (.wikipedia; mobile/desktop/app aggregated)\n"
@@ -231,17 +378,17 @@ def main():
         logging.info("Building balanced dataset of switches / non-switches")
         switches, non_switches = build_dataset(args, wiki_db)
 
-    ndims, titles, topic_model, topic_descs = load_topic_model(args.lda_dir, wiki_lang)
+    ndims, topic_descs, featurizer = get_features(args, wiki_lang)
     if ndims:
-        # make sure we have LDA vectors for the titles
-        logging.info("After filtering to only titles with LDA topics:")
+        # make sure we have LDA vectors for the articles
+        logging.info("After filtering to only articles with LDA topics:")
         removed = set()
-        for idx in range(len(switches)-1, -1, -1):
-            if switches[idx][2] not in titles:
-                removed.add(switches.pop(idx)[2])
-        for idx in range(len(non_switches)-1, -1, -1):
-            if non_switches[idx][2] not in titles:
-                removed.add(non_switches.pop(idx)[2])
+        has_topics = featurizer.found(switches)
+        removed.update(s[2] for s, keep in zip(switches, has_topics) if not keep)
+        switches = [s for s, keep in zip(switches, has_topics) if keep]
+        has_topics = featurizer.found(non_switches)
+        removed.update(s[2] for s, keep in zip(non_switches, has_topics) if not keep)
+        non_switches = [s for s, keep in zip(non_switches, has_topics) if keep]
         logging.info("{0} switches.".format(len(switches)))
         logging.info("{0} non switches.".format(len(non_switches)))
         logging.debug("{0} removed: {1}".format(len(removed), removed))
@@ -254,14 +401,7 @@ def main():
         logging.info("{0} switches.".format(len(switches)))
         logging.info("{0} non switches.".format(len(non_switches)))
 
-        X = np.zeros(shape=(len(switches) + len(non_switches), ndims))
-        i = 0
-        for s in switches:
-            X[i] = topic_model[titles[s[2]]]
-            i += 1
-        for n in non_switches:
-            X[i] = topic_model[titles[n[2]]]
-            i += 1
+        X = featurizer.features(switches + non_switches)
         y = [1] * len(switches) + [0] * len(non_switches)
 
         if args.numfolds > 0:
@@ -276,6 +416,11 @@ def main():
                     tsvwriter.writerow([wiki_lang, 'baseline', len(X), baseline_scores])
 
 def predictive_model(X, y, num_folds=5, topic_descs=None):
+    # scikit-learn takes about a second to import, so only when a model is actually fit
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import cross_val_score
+    from sklearn.model_selection import train_test_split
+
     clf = LogisticRegression(solver='lbfgs', penalty='l2', C=0.1)
     if num_folds > 1:
         scores = cross_val_score(estimator=clf, X=X, y=y, cv=num_folds)
@@ -298,4 +443,5 @@ def predictive_model(X, y, num_folds=5, topic_descs=None):
     return scores
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     main()
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""Run several analyses over the same page view TSVs with a single decompress-and-sessionize pass; each analysis parses
+the full command line with its own script's parser, so options keep the names and defaults of the individual scripts."""
+
+import argparse
+import glob
+import logging
+import os
+
+import desc_stats
+import reader_language_overlap
+from session_utils import scan_sessions
+
+# the dataset, switch_index and switch_cube analyses need numpy / scipy, so their modules are only imported
+# when requested
+def dataset_parser():
+    import lda_predictive_model
+    return lda_predictive_model.get_parser()
+
+def dataset_consumer(args):
+    import lda_predictive_model
+    if not args.output_tsv:
+        raise Exception("The dataset analysis needs --output_tsv to write the dataset to.")
+    if args.direction not in ("to", "from"):
+        raise Exception("Invalid direction. Should be either 'to' or 'from'")
+    return lda_predictive_model.DatasetBuilder(args, args.lang)
+
+def switch_index_consumer(args):
+    import switch_index
+    if not args.switch_index_dir:
+        raise Exception("The switch_index analysis needs --switch_index_dir to write the index to.")
+    return switch_index.SwitchIndexBuilder(args)
+
+def switch_cube_consumer(args):
+    import switch_cube
+    if not args.cube_dir:
+        raise Exception("The switch_cube analysis needs --cube_dir to write the cube to.")
+    return switch_cube.SwitchCubeBuilder(args)
+
+ANALYSES = {'desc_stats': (desc_stats.get_parser, desc_stats.DescStats),
+            'overlap': (reader_language_overlap.get_parser, reader_language_overlap.LanguageOverlap),
+            'dataset': (dataset_parser, dataset_consumer),
+            'switch_index': (desc_stats.get_parser, switch_index_consumer),
+            'switch_cube': (reader_language_overlap.get_parser, switch_cube_consumer)}
+
+def main():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--analyses", nargs="+", default=['desc_stats', 'overlap', 'dataset'], choices=list(ANALYSES),
+                        help="Analyses to run over the shared session stream.")
+    parser.add_argument("--tsvs", nargs="+",
+                        help=".tsv files with anonymized page views ordered by user/datetime")
+    parser.add_argument("--stopafter", type=int, default=-1,
+                        help="Process only this many sessions.")
+    parser.add_argument("--sample_rate", type=float, default=1.0,
+                        help="Only analyze this fraction of users (selected deterministically by user hash).")
+    parser.add_argument("--gap_seconds", type=int, default=None,
+                        help="Split users' page views into sessions at gaps of more than n seconds (e.g., 1800).")
+    parser.add_argument("--checkpoint",
+                        help="Save counts and input position to this file after each TSV (to --resume from).")
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="With --checkpoint: also checkpoint after every n sessions.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from --checkpoint (same --tsvs and options).")
+    parser.add_argument("--early_maxpvs", type=int, default=None,
+                        help="Drop users while reading as soon as a session has more than n pageviews (likely bots; "
+                             "their remaining lines are not parsed).")
+    parser.add_argument("--max_per_minute", type=int, default=None,
+                        help="Drop users while reading as soon as they have more than n page views in one minute "
+                             "(likely bots).")
+    parser.add_argument("--debug", action="store_true",
+                        help="More verbose logging")
+    parser.add_argument("--log_every", type=int, default=500000,
+                        help="Log after processing every n sessions.")
+    args, _ = parser.parse_known_args()
+
+    if len(args.tsvs) == 1:
+        args.tsvs = glob.glob(args.tsvs[0])
+    logging.info(args)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    consumers = []
+    for analysis in args.analyses:
+        get_parser, make_consumer = ANALYSES[analysis]
+        analysis_parser = get_parser()
+        # options meant for another analysis (e.g., --lang) must not be taken as abbreviations (e.g., of --langs)
+        analysis_parser.allow_abbrev = False
+        analysis_args, _ = analysis_parser.parse_known_args()
+        analysis_args.tsvs = args.tsvs
+        if getattr(analysis_args, 'report_fn', None):
+            # analyses sharing --report_fn each get their own file, e.g., report_overlap.json
+            base, ext = os.path.splitext(analysis_args.report_fn)
+            analysis_args.report_fn = '{0}_{1}{2}'.format(base, analysis, ext)
+        logging.info("{0}: {1}".format(analysis, analysis_args))
+        consumers.append(make_consumer(analysis_args))
+
+    scan_sessions(args.tsvs, consumers, stopafter=args.stopafter, log_every=args.log_every,
+                  sample_rate=args.sample_rate, gap_seconds=args.gap_seconds, checkpoint=args.checkpoint,
+                  checkpoint_every=args.checkpoint_every, resume=args.resume, max_pvs=args.early_maxpvs,
+                  max_per_minute=args.max_per_minute)
+
+    for analysis, consumer in zip(args.analyses, consumers):
+        logging.info("\n====== {0} ======".format(analysis))
+        consumer.report()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,131 @@
+"""Final step of the pipeline in get_categories.py: score the revision IDs gathered by add_revids (qid_revids.json) with
+ORES drafttopic, appending JSON-lines records as batches finish so that an interrupted run resumes where it stopped."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+USER_AGENT = 'language-switching (python) -- m:Research:Language_switching_behavior_on_Wikipedia'
+
+class RateLimiter:
+    """Thread-safe limiter allowing at most `rate` calls to wait() per second (evenly spaced)."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+def read_revids(revids_fn):
+    """Get (qid, rev_id) pairs that have a revision to score."""
+    pairs = []
+    with open(revids_fn, 'r') as fin:
+        for line in fin:
+            record = json.loads(line)
+            if record.get('rev_id'):
+                pairs.append((record['qid'], int(record['rev_id'])))
+    return pairs
+
+
+def read_scored(output_fn):
+    """Get QIDs already in output_fn, dropping a partially written last line left by an interrupted run."""
+    scored = set()
+    if not os.path.exists(output_fn):
+        return scored
+    valid_bytes = 0
+    with open(output_fn, 'rb') as fin:
+        for line in fin:
+            try:
+                scored.add(json.loads(line)['qid'])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(output_fn):
+        with open(output_fn, 'r+b') as fout:
+            fout.truncate(valid_bytes)
+    return scored
+
+
+def score_batch(host, wiki, batch, limiter, max_retries=3, retry_wait=1, timeout=60):
+    """Request drafttopic scores for a batch of (qid, rev_id) pairs in a single ORES request."""
+    query = urllib.parse.urlencode({'models': 'drafttopic', 'revids': '|'.join(str(r) for _, r in batch)})
+    url = '{0}/v3/scores/{1}/?{2}'.format(host.rstrip('/'), wiki, query)
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                scores = json.load(response)[wiki]['scores']
+            break
+        except (OSError, ValueError, KeyError):
+            if attempt == max_retries:
+                raise
+            time.sleep(retry_wait * 2 ** attempt)
+    return [{'qid': qid, 'rev_id': rev_id, 'score': scores.get(str(rev_id), {})} for qid, rev_id in batch]
+
+
+def score_revids(revids_fn, output_fn, host='https://ores.wikimedia.org', wiki='enwiki', batch_size=50,
+                 workers=4, requests_per_second=5, retry_wait=1):
+    """Score every revision in revids_fn that is not yet in output_fn, appending results to output_fn."""
+    scored = read_scored(output_fn)
+    to_score = [(qid, rev_id) for qid, rev_id in read_revids(revids_fn) if qid not in scored]
+    print("{0} revisions already scored; {1} to go.".format(len(scored), len(to_score)))
+    batches = [to_score[i:i + batch_size] for i in range(0, len(to_score), batch_size)]
+    limiter = RateLimiter(requests_per_second)
+    num_written = 0
+    with open(output_fn, 'a') as fout:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map keeps input order while requests run concurrently; each batch is written (and flushed) as soon
+            # as it and all batches before it are done
+            results = executor.map(lambda b: score_batch(host, wiki, b, limiter, retry_wait=retry_wait), batches)
+            for i, records in enumerate(results, start=1):
+                for record in records:
+                    fout.write(json.dumps(record) + '\n')
+                fout.flush()
+                num_written += len(records)
+                if i % 20 == 0:
+                    print("{0} / {1} revisions scored.".format(num_written, len(to_score)))
+    print("Finished: {0} revisions scored.".format(num_written))
+    return num_written
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--revids_jsons", nargs="+",
+                        help="qid_revids.json files written by get_categories.py")
+    parser.add_argument("--output_fn", default="ores_drafttopic.json",
+                        help="JSON-lines output written next to each input (--ores_output for switches_by_category.py)")
+    parser.add_argument("--ores_host", default="https://ores.wikimedia.org")
+    parser.add_argument("--wiki", default="enwiki")
+    parser.add_argument("--batch_size", type=int, default=50,
+                        help="Revisions per ORES request.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Concurrent requests.")
+    parser.add_argument("--requests_per_second", type=float, default=5,
+                        help="Maximum request rate across all workers.")
+    args = parser.parse_args()
+
+    for fn in args.revids_jsons:
+        if not os.path.exists(fn):
+            print("{0} does not exist. Skipping.".format(fn))
+            continue
+        output_fn = os.path.join(os.path.dirname(fn), args.output_fn)
+        print("Scoring {0} to {1}".format(fn, output_fn))
+        score_revids(fn, output_fn, host=args.ores_host, wiki=args.wiki, batch_size=args.batch_size,
+                     workers=args.workers, requests_per_second=args.requests_per_second)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Local HTTP service answering switching questions from a memory-mapped switch index (desc_stats.py --switch_index_dir)
+instead of re-running desc_stats.py; responses are JSON and cached in-process since the index never changes."""
+
+import argparse
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import time
+import urllib.parse
+
+from session_utils import qid_to_int
+from session_utils import usertypes
+
+class BadRequest(Exception):
+    pass
+
+
+class QueryService:
+    """Answers queries against a SwitchIndex, with an LRU cache of encoded responses.
+
+    Endpoints take GET query parameters:
+
+        /pairs?src=enwiki&dst=dewiki[&usertype=reader]         switches between two projects (either may be omitted)
+        /top_pairs?k=30[&usertype=..][&weighted=1][&min_views=500][&langs=enwiki,dewiki]
+                                                                top language pairs (see reporting.weight_by_proj)
+        /qid?qid=Q42                                            per-project views / switches for an article
+        /top_switched?wiki=enwiki[&k=20][&count=switch_in][&min_views=100][&rate=1]
+                                                                most-switched articles on a wiki
+        /stats                                                  index size and response cache statistics
+    """
+
+    def __init__(self, index, cache_size=4096):
+        self.index = index
+        self.started = time.time()
+        self.endpoints = {'/pairs': self.pairs,
+                          '/top_pairs': self.top_pairs,
+                          '/qid': self.qid,
+                          '/top_switched': self.top_switched}
+        self.response = functools.lru_cache(maxsize=cache_size)(self._response)
+
+    def _response(self, path, query):
+        """JSON-encoded response body for an endpoint and its (sorted) query parameters."""
+        params = dict(query)
+        return json.dumps(self.endpoints[path](params)).encode('utf-8')
+
+    def handle(self, path, query_string):
+        """Get (HTTP status, body) for a request."""
+        if path == '/stats':
+            return 200, json.dumps(self.stats()).encode('utf-8')
+        if path not in self.endpoints:
+            return 404, json.dumps({'error': 'Unknown endpoint: {0}'.format(path)}).encode('utf-8')
+        query = tuple(sorted(urllib.parse.parse_qsl(query_string)))
+        try:
+            return 200, self.response(path, query)
+        except BadRequest as e:
+            return 400, json.dumps({'error': str(e)}).encode('utf-8')
+
+    def stats(self):
+        cache = self.response.cache_info()
+        return {'qids': len(self.index.qids), 'projects': len(self.index.projects),
+                'uptime_seconds': time.time() - self.started,
+                'cache': {'hits': cache.hits, 'misses': cache.misses, 'size': cache.currsize}}
+
+    @staticmethod
+    def _usertype(params):
+        usertype = params.get('usertype')
+        if usertype is not None and usertype not in usertypes:
+            raise BadRequest("usertype must be one of {0}".format(usertypes))
+        return usertype
+
+    @staticmethod
+    def _int(params, name, default):
+        try:
+            return int(params.get(name, default))
+        except ValueError:
+            raise BadRequest("{0} must be an integer".format(name))
+
+    def _k(self, params, default, num_entries):
+        """Number of top entries asked for: at least 1, at most the number of entries there are."""
+        k = self._int(params, 'k', default)
+        if k < 1:
+            raise BadRequest("k must be at least 1")
+        return min(k, num_entries)
+
+    @staticmethod
+    def _flag(params, name):
+        return params.get(name, '0').lower() in ('1', 'true', 'yes')
+
+    def pairs(self, params):
+        src = params.get('src')
+        dst = params.get('dst')
+        usertype = self._usertype(params)
+        if not src and not dst:
+            raise BadRequest("src and/or dst are required")
+        if src and dst:
+            return {'src': src, 'dst': dst, 'usertype': usertype,
+                    'switches': self.index.pair_count(src, dst, usertype),
+                    'src_views': self.index.project_views(src, usertype)}
+        return {'src': src, 'dst': dst, 'usertype': usertype,
+                'switches': {'{0}-{1}'.format(s, d): c for s, d, c in self.index.pair_counts(src, dst, usertype)}}
+
+    def top_pairs(self, params):
+        usertype = self._usertype(params)
+        weighted = self._flag(params, 'weighted')
+        langs = params['langs'].split(',') if params.get('langs') else None
+        k = self._k(params, 30, len(self.index.projects) ** 2)
+        top = self.index.top_pairs(k=k, usertype=usertype, weighted=weighted,
+                                   minpv_threshold=self._int(params, 'min_views', 500), langs=langs)
+        return {'usertype': usertype, 'weighted': weighted,
+                'pairs': [{'pair': '{0}-{1}'.format(src, dst), 'value': value, 'switches': switches}
+                          for src, dst, value, switches in top]}
+
+    def qid(self, params):
+        if not params.get('qid'):
+            raise BadRequest("qid is required")
+        try:
+            qid_to_int(params['qid'])
+        except ValueError:
+            raise BadRequest("qid must be a Wikidata item ID (e.g., Q42)")
+        return self.index.qid_stats(params['qid'])
+
+    def top_switched(self, params):
+        if 'wiki' not in params:
+            raise BadRequest("wiki is required")
+        count = params.get('count', 'switch_out')
+        if count not in ('switch_out', 'switch_in'):
+            raise BadRequest("count must be switch_out or switch_in")
+        rate = self._flag(params, 'rate')
+        top = self.index.top_switched(params['wiki'], k=self._k(params, 20, len(self.index.qids)), count=count,
+                                      min_views=self._int(params, 'min_views', 0), rate=rate)
+        return {'wiki': params['wiki'], 'count': count, 'rate': rate,
+                'articles': [{'qid': qid, 'value': value, 'views': views} for qid, value, views in top]}
+
+
+class Server(ThreadingHTTPServer):
+    # the default listen backlog (5) makes bursts of concurrent clients wait for TCP retransmits
+    request_queue_size = 128
+
+
+def make_server(service, host='127.0.0.1', port=8000):
+    """Threaded HTTP server for a QueryService (port 0 picks a free port)."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            status, body = service.handle(url.path, url.query)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Server((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", required=True,
+                        help="Directory written by desc_stats.py --switch_index_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache_size", type=int, default=4096,
+                        help="Number of responses to keep in the in-process cache.")
+    parser.add_argument("--debug", action="store_true",
+                        help="More verbose logging")
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    # numpy / scipy are only needed once an index is loaded
+    from switch_index import SwitchIndex
+
+    start = time.perf_counter()
+    service = QueryService(SwitchIndex.load(args.index_dir), cache_size=args.cache_size)
+    server = make_server(service, args.host, args.port)
+    logging.info("Loaded {0} QIDs x {1} projects in {2:.3f}s. Serving on http://{3}:{4}/".format(
+        len(service.index.qids), len(service.index.projects), time.perf_counter() - start,
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
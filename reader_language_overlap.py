@@ -1,28 +1,64 @@
 import argparse
-from copy import deepcopy
 import csv
 import glob
 import logging
+import os
 
-import pandas as pd
-
-from session_utils import tsv_to_sessions
+from hll import HyperLogLog
+from hll import save_sketches
+from hll import write_estimates
+from reporting import Report
+from reporting import top_k
+from reporting import weight_by_proj
 from session_utils import get_lang_switch
+from session_utils import log_scaled_counts
+from session_utils import scan_sessions
+from session_utils import SessionConsumer
 from session_utils import usertypes
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--tsvs", nargs="+",
                         help=".tsv files with anonymized page views ordered by user/datetime")
     parser.add_argument("--stopafter", type=int, default=-1,
                         help="Process only this many sessions.")
+    parser.add_argument("--sample_rate", type=float, default=1.0,
+                        help="Only analyze this fraction of users (selected deterministically by user hash).")
+    parser.add_argument("--gap_seconds", type=int, default=None,
+                        help="Split users' page views into sessions at gaps of more than n seconds (e.g., 1800).")
+    parser.add_argument("--checkpoint",
+                        help="Save counts and input position to this file after each TSV (to --resume from).")
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="With --checkpoint: also checkpoint after every n sessions.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from --checkpoint (same --tsvs and options).")
+    parser.add_argument("--early_maxpvs", type=int, default=None,
+                        help="Drop users while reading as soon as a session has more than n pageviews (likely bots; "
+                             "their remaining lines are not parsed).")
+    parser.add_argument("--max_per_minute", type=int, default=None,
+                        help="Drop users while reading as soon as they have more than n page views in one minute "
+                             "(likely bots).")
     parser.add_argument("--debug", action="store_true",
                         help="More verbose logging")
     parser.add_argument("--maxpvs", type=int, default=500,
                         help="Max pageviews in a session to still be included in analysis.")
+    parser.add_argument("--report_fn",
+                        help="If given, also write the reported tables to this .json or .tsv file")
+    parser.add_argument("--hll", action="store_true",
+                        help="Also estimate distinct QIDs, countries and users per switch pair and project (HyperLogLog)")
+    parser.add_argument("--hll_precision", type=int, default=10,
+                        help="HyperLogLog precision p: 2^p bytes per sketch, ~1.04/sqrt(2^p) relative error")
+    parser.add_argument("--hll_fn", default="distinct_by_proj.json",
+                        help="With --hll: mergeable sketches are written here and estimates to the same name as .tsv")
     parser.add_argument("--switch_fn", default="switches_by_proj.tsv")
     parser.add_argument("--cooc_fn", default="cooc_by_proj.tsv")
-    args = parser.parse_args()
+    parser.add_argument("--cube_dir",
+                        help="If given, also save usertype x country x project x project counts of switches and "
+                             "co-occurrence here (see switch_cube.py)")
+    return parser
+
+def main():
+    args = get_parser().parse_args()
 
     if len(args.tsvs) == 1:
         args.tsvs = glob.glob(args.tsvs[0])
@@ -31,115 +67,184 @@ def main():
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    logging.info(("Filtering of statistics:\n"
-                  "\t*only Wikipedia projects considered (.wikipedia; mobile/desktop/app aggregated)\n"
-                  "\t*only namespace = 0 considered\n"
-                  "\t*only first pageview of a given article retained (e.g. enwiki+Chicago)\n"
-                  "\t*language switching defined as same wikidata item, different project\n"
-                  "\t*devices w/ greater than {0} pageviews dropped as likely bots.".format(args.maxpvs)))
-
-    # count of language pairs involved in switches (directional)
-    switch_to_from = {}
-    # count of languages co-occurring in same session (whether switch or not)
-    lang_cooccurrence = {}
-    # number of unique language projects per session
-    lang_counts = {}
-    # number of views per language project
-    proj_pvs = {}
-
-    for d in [switch_to_from, lang_cooccurrence, lang_counts, proj_pvs]:
+    consumers = [LanguageOverlap(args)]
+    if args.cube_dir:
+        # needs numpy, so only imported when requested
+        from switch_cube import SwitchCubeBuilder
+        consumers.append(SwitchCubeBuilder(args))
+    # this only includes the first page view for a given QID-project so a user repeatedly viewing a page doesn't skew the statistics
+    scan_sessions(args.tsvs, consumers, stopafter=args.stopafter, sample_rate=args.sample_rate,
+                  gap_seconds=args.gap_seconds, checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                  resume=args.resume, max_pvs=args.early_maxpvs, max_per_minute=args.max_per_minute)
+    for consumer in consumers:
+        consumer.report()
+
+
+class LanguageOverlap(SessionConsumer):
+    """Language switches and co-occurrence between pairs of projects within sessions."""
+
+    def __init__(self, args):
+        self.args = args
+        logging.info(("Filtering of statistics:\n"
+                      "\t*only Wikipedia projects considered (.wikipedia; mobile/desktop/app aggregated)\n"
+                      "\t*only namespace = 0 considered\n"
+                      "\t*only first pageview of a given article retained (e.g. enwiki+Chicago)\n"
+                      "\t*language switching defined as same wikidata item, different project\n"
+                      "\t*devices w/ greater than {0} pageviews dropped as likely bots.".format(args.maxpvs)))
+
+        # count of language pairs involved in switches (directional)
+        self.switch_to_from = {}
+        # count of languages co-occurring in same session (whether switch or not)
+        self.lang_cooccurrence = {}
+        # number of unique language projects per session
+        self.lang_counts = {}
+        # number of views per language project
+        self.proj_pvs = {}
+
+        # if args.hll, distinct QIDs / countries / users per switch pair (e.g., 'enwiki-dewiki') and per project
+        self.sketches = {}
+
+        for d in [self.switch_to_from, self.lang_cooccurrence, self.lang_counts, self.proj_pvs]:
+            for ut in usertypes:
+                d[ut] = {}
+        for ut in usertypes:
+            self.sketches[ut] = {'pair': {}, 'project': {}}
+
+    def consume(self, session):
+        ut = session.usertype
+
+        # filter out likely bots
+        pvs = session.pageviews
+        num_pvs = len(pvs)
+        if not num_pvs or num_pvs > self.args.maxpvs:
+            return
+
+        unique_langs = set([p.proj for p in pvs])
+        for proj in unique_langs:
+            self.proj_pvs[ut][proj] = self.proj_pvs[ut].get(proj, 0) + 1
+
+        num_langs = len(unique_langs)
+        self.lang_counts[ut][num_langs] = self.lang_counts[ut].get(num_langs, 0) + 1
+        if num_langs > 1:
+            lang_switches = get_lang_switch(pvs)
+            tfs = set()
+            for ls_pair in lang_switches:
+                frompv = pvs[ls_pair[0]]
+                topv = pvs[ls_pair[1]]
+                tf = '{0}-{1}'.format(frompv.proj, topv.proj)
+                tfs.add(tf)
+            for tf in tfs:
+                self.switch_to_from[ut][tf] = self.switch_to_from[ut].get(tf, 0) + 1
+            if self.args.hll:
+                self.sketch_switches(session, [(pvs[i].proj, pvs[j].proj, pvs[i].wd) for i, j in lang_switches])
+            sorted_langs = sorted(unique_langs)
+            for li in range(0, num_langs - 1):
+                for lj in range(li+1, num_langs):
+                    tf = '{0}-{1}'.format(sorted_langs[li], sorted_langs[lj])
+                    self.lang_cooccurrence[ut][tf] = self.lang_cooccurrence[ut].get(tf, 0) + 1
+        else:
+            single_lang = pvs[0].proj
+            tf = '{0}-{0}'.format(single_lang)
+            self.lang_cooccurrence[ut][tf] = self.lang_cooccurrence[ut].get(tf, 0) + 1
+            self.switch_to_from[ut][tf] = self.switch_to_from[ut].get(tf, 0) + 1
+        if self.args.hll:
+            self.sketch_projects(session, unique_langs)
+
+    def _sketch(self, ut, kind, key):
+        sketches = self.sketches[ut][kind].get(key)
+        if sketches is None:
+            sketches = {w: HyperLogLog(self.args.hll_precision) for w in ('qids', 'countries', 'users')}
+            self.sketches[ut][kind][key] = sketches
+        return sketches
+
+    def sketch_projects(self, session, unique_langs):
+        for pv in session.pageviews:
+            self._sketch(session.usertype, 'project', pv.proj)['qids'].add(pv.wd)
+        for proj in unique_langs:
+            sketches = self._sketch(session.usertype, 'project', proj)
+            sketches['countries'].add(session.country)
+            sketches['users'].add(session.usrhash)
+
+    def sketch_switches(self, session, switches):
+        """Add the switched articles, country and user of a session to the sketches of its switch pairs."""
+        for fromproj, toproj, wd in switches:
+            self._sketch(session.usertype, 'pair', '{0}-{1}'.format(fromproj, toproj))['qids'].add(wd)
+        for tf in set('{0}-{1}'.format(f, t) for f, t, _ in switches):
+            sketches = self._sketch(session.usertype, 'pair', tf)
+            sketches['countries'].add(session.country)
+            sketches['users'].add(session.usrhash)
+
+    def report(self):
+        report = Report(self.args.report_fn)
+        report.section("Langs per userhash")
         for ut in usertypes:
-            d[ut] = {}
-
-    i = 0
-    for tsv in args.tsvs:
-        logging.info("Processing: {0}".format(tsv))
-        # this only includes the first page view for a given QID-project so a user repeatedly viewing a page doesn't skew the statistics
-        for session in tsv_to_sessions(tsv, trim=True):
-            if i == args.stopafter:
-                break
-            i += 1
-            if i % 500000 == 0:
-                logging.info("{0} sessions analyzed.".format(i))
-
-            ut = session.usertype
-
-            # filter out likely bots
-            pvs = session.pageviews
-            num_pvs = len(pvs)
-            if not num_pvs or num_pvs > args.maxpvs:
-                continue
-
-            unique_langs = set([p.proj for p in pvs])
-            for proj in unique_langs:
-                proj_pvs[ut][proj] = proj_pvs[ut].get(proj, 0) + 1
-
-            num_langs = len(unique_langs)
-            lang_counts[ut][num_langs] = lang_counts[ut].get(num_langs, 0) + 1
-            if num_langs > 1:
-                lang_switches = get_lang_switch(pvs)
-                tfs = set()
-                for ls_pair in lang_switches:
-                    frompv = pvs[ls_pair[0]]
-                    topv = pvs[ls_pair[1]]
-                    tf = '{0}-{1}'.format(frompv.proj, topv.proj)
-                    tfs.add(tf)
-                for tf in tfs:
-                    switch_to_from[ut][tf] = switch_to_from[ut].get(tf, 0) + 1
-                sorted_langs = sorted(unique_langs)
-                for li in range(0, num_langs - 1):
-                    for lj in range(li+1, num_langs):
-                        tf = '{0}-{1}'.format(sorted_langs[li], sorted_langs[lj])
-                        lang_cooccurrence[ut][tf] = lang_cooccurrence[ut].get(tf, 0) + 1
-            else:
-                single_lang = pvs[0].proj
-                tf = '{0}-{0}'.format(single_lang)
-                lang_cooccurrence[ut][tf] = lang_cooccurrence[ut].get(tf, 0) + 1
-                switch_to_from[ut][tf] = switch_to_from[ut].get(tf, 0) + 1
-
-
-    logging.info("\nLangs per userhash:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(lang_counts[ut], 10, "langs")
-
-    logging.info("\nLanguage pairs:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        print_stats(switch_to_from[ut], 30, "")
-
-    logging.info("\nWeighted language pairs:")
-    for ut in usertypes:
-        logging.info("==={0}===".format(ut))
-        weighted_to_from = weight_by_proj(switch_to_from[ut], proj_pvs[ut])
-        print_stats(weighted_to_from, 20, "", context_dict=switch_to_from[ut])
-
-    if args.switch_fn:
+            report.usertype(ut)
+            report.print_stats(self.lang_counts[ut], 10, "langs")
+
+        report.section("Language pairs")
         for ut in usertypes:
-            with open(args.switch_fn.replace('.tsv', '_{0}.tsv'.format(ut)), "w") as fout:
-                csvwriter = csv.writer(fout, delimiter="\t")
-                csvwriter.writerow(['to', 'from', 'count_switches', 'to_lang_totalsessions', 'from_lang_totalsessions'])
-                for tf in switch_to_from[ut]:
-                    tolang, fromlang = tf.split("-")
-                    count = switch_to_from[ut].get(tf)
-                    csvwriter.writerow([tolang, fromlang, count, proj_pvs[ut][tolang], proj_pvs[ut][fromlang]])
-#        lang_coocurrence_csv(switch_to_from, proj_pvs)
-
-    if args.cooc_fn:
+            report.usertype(ut)
+            report.print_stats(self.switch_to_from[ut], 30, "")
+
+        if self.args.sample_rate < 1:
+            logging.info("\nEstimated language pairs from a {0:.2%} sample of users:".format(self.args.sample_rate))
+            for ut in usertypes:
+                logging.info("==={0}===".format(ut))
+                log_scaled_counts(self.switch_to_from[ut], self.args.sample_rate, 30)
+
+        report.section("Weighted language pairs")
+        for ut in usertypes:
+            report.usertype(ut)
+            weighted_to_from = weight_by_proj(self.switch_to_from[ut], self.proj_pvs[ut])
+            report.print_stats(weighted_to_from, 20, "", context_dict=self.switch_to_from[ut])
+        report.write()
+
+        if self.args.hll:
+            self.report_distinct()
+
+        if self.args.switch_fn:
+            for ut in usertypes:
+                with open(self.args.switch_fn.replace('.tsv', '_{0}.tsv'.format(ut)), "w") as fout:
+                    csvwriter = csv.writer(fout, delimiter="\t")
+                    csvwriter.writerow(['to', 'from', 'count_switches', 'to_lang_totalsessions', 'from_lang_totalsessions'])
+                    for tf in self.switch_to_from[ut]:
+                        tolang, fromlang = tf.split("-")
+                        count = self.switch_to_from[ut].get(tf)
+                        csvwriter.writerow([tolang, fromlang, count,
+                                            self.proj_pvs[ut][tolang], self.proj_pvs[ut][fromlang]])
+#            lang_coocurrence_csv(self.switch_to_from[ut], self.proj_pvs[ut])
+
+        if self.args.cooc_fn:
+            for ut in usertypes:
+                with open(self.args.cooc_fn.replace('.tsv', '_{0}.tsv'.format(ut)), "w") as fout:
+                    csvwriter = csv.writer(fout, delimiter="\t")
+                    csvwriter.writerow(['to', 'from', 'count_cooc', 'to_lang_totalsessions', 'from_lang_totalsessions'])
+                    for lc in self.lang_cooccurrence[ut]:
+                        l1, l2 = lc.split("-")
+                        count = self.lang_cooccurrence[ut].get(lc)
+                        csvwriter.writerow([l1, l2, count, self.proj_pvs[ut][l1], self.proj_pvs[ut][l2]])
+                        if l1 != l2:
+                            csvwriter.writerow([l2, l1, count, self.proj_pvs[ut][l2], self.proj_pvs[ut][l1]])
+#            lang_coocurrence_csv(self.lang_cooccurrence[ut], self.proj_pvs[ut])
+
+
+    def report_distinct(self):
+        logging.info("\nDistinct articles / countries / users behind top switch pairs (HyperLogLog estimates):")
         for ut in usertypes:
-            with open(args.cooc_fn.replace('.tsv', '_{0}.tsv'.format(ut)), "w") as fout:
-                csvwriter = csv.writer(fout, delimiter="\t")
-                csvwriter.writerow(['to', 'from', 'count_cooc', 'to_lang_totalsessions', 'from_lang_totalsessions'])
-                for lc in lang_cooccurrence[ut]:
-                    l1, l2 = lc.split("-")
-                    count = lang_cooccurrence[ut].get(lc)
-                    csvwriter.writerow([l1, l2, count, proj_pvs[ut][l1], proj_pvs[ut][l2]])
-                    if l1 != l2:
-                        csvwriter.writerow([l2, l1, count, proj_pvs[ut][l2], proj_pvs[ut][l1]])
-#       lang_coocurrence_csv(lang_cooccurrence, proj_pvs)
+            logging.info("==={0}===".format(ut))
+            pairs = self.sketches[ut]['pair']
+            for tf, count in top_k({tf: self.switch_to_from[ut].get(tf, 0) for tf in pairs}, 30):
+                logging.info("{0}:\t{1} sessions;\t~{2} articles,\t~{3} countries,\t~{4} users.".format(
+                    tf, count, len(pairs[tf]['qids']), len(pairs[tf]['countries']), len(pairs[tf]['users'])))
+        if self.args.hll_fn:
+            save_sketches(self.args.hll_fn, self.sketches)
+            write_estimates(os.path.splitext(self.args.hll_fn)[0] + '.tsv', self.sketches)
+            logging.info("HyperLogLog sketches written to {0}".format(self.args.hll_fn))
 
 
 def lang_coocurrence_csv(switches, lang_counts, fn=None):
+    import pandas as pd
+
     lang_sorted_by_popularity = sorted(lang_counts, key=lang_counts.get, reverse=True)
     lang_overlap = pd.DataFrame(index=lang_sorted_by_popularity, columns=lang_sorted_by_popularity, dtype="float32")
     for l_to in lang_sorted_by_popularity:
@@ -153,55 +258,7 @@ def lang_coocurrence_csv(switches, lang_counts, fn=None):
     else:
         print(lang_overlap)
 
-def weight_by_proj(countdict, pvs_by_proj, minpv_threshold=500):
-    """Normalize count stats by how many page views occurred on a project"""
-    # have to deep copy otherwise, this will change in-place and affect other statistics
-    countdict = deepcopy(countdict)
-    for pi_to_pj in list(countdict.keys()):
-        count = countdict.pop(pi_to_pj)
-        pi = pi_to_pj.split("-")[0]
-        norm = pvs_by_proj[pi]
-        # only compute proportion for projects w/ enough traffic that the pattern MIGHT be real
-        if norm > minpv_threshold:
-            countdict[pi_to_pj] = count / norm
-        else:
-            countdict[pi_to_pj] = 0
-    return countdict
-
-
-def weight_by_pvs(countdict, pvs_by_wd, minpv_threshold=50):
-    """Normalize count stats by how often a page was viewed"""
-    for wd_title in list(countdict.keys()):
-        count = countdict.pop(wd_title)
-        norm = pvs_by_wd[wd_title]
-        # only compute proportion for pages w/ enough traffic that the pattern MIGHT be real
-        if norm > minpv_threshold:
-            countdict[wd_title] = count / norm
-        else:
-            countdict[wd_title] = 0
-
-def print_stats(countdict, threshold, lbl, ignore=(), context_dict=None):
-    """Print limited statistics for count dictionaries."""
-    rest = 0
-    ignorevals = []
-    for k in ignore:
-        ignorevals.append((k, countdict.pop(k)))
-    denominator = sum(countdict.values())
-    for topk, sc in enumerate([(k, countdict[k]) for k in sorted(countdict, key=countdict.get, reverse=True)]):
-        if topk <= threshold:
-            if context_dict:
-                logging.info("{0} {1}:\t{2}\t({3}) times.".format(sc[0], lbl, sc[1], context_dict.get(sc[0], "N/A")))
-            else:
-                logging.info("{0} {1}:\t{2}\t({3:.3f}) times.".format(sc[0], lbl, sc[1], sc[1] / denominator))
-        else:
-            rest += sc[1]
-    if rest:
-        logging.info("Remainder:\t{0}\t({1:.3f}) times.".format(rest, rest / denominator))
-    for k,v in ignorevals:
-        countdict[k] = v
-
-
-
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    main()
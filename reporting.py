@@ -0,0 +1,185 @@
+"""Top-k reporting shared by desc_stats.py and reader_language_overlap.py: tables are built with heapq.nlargest and
+read-only normalized views instead of sorting or copying count dictionaries, and labels are only looked up for the rows
+that are printed."""
+
+import csv
+import heapq
+import json
+import logging
+from itertools import repeat
+from operator import itemgetter
+
+from spill_counter import SpillCounter
+
+TSV_COLUMNS = ['section', 'usertype', 'lbl', 'name', 'rank', 'key', 'label', 'value', 'share', 'context']
+
+def top_k(countdict, k):
+    """The k largest (key, value) items of a count dict (or WeightedCounts), largest first.
+
+    Equivalent to sorted(countdict.items(), key=value, reverse=True)[:k], so ties keep dictionary order.
+    """
+    return heapq.nlargest(k, countdict.items(), key=itemgetter(1))
+
+
+class WeightedCounts:
+    """Read-only view of a count dict with each count divided by a normalizing count, computed on access.
+
+    norm_key maps a key to its key in norms (default: the same key). Keys whose norm is no more than minpv_threshold
+    get a weight of 0 as there is too little traffic for the pattern to possibly be real.
+
+    Norms spilled to disk (a finished SpillCounter, e.g., desc_stats.py --max_counter_items) are read in one pass in
+    key order, merged with the counts sorted by key, instead of one block read per key.
+    """
+
+    def __init__(self, countdict, norms, minpv_threshold, norm_key=None):
+        self.countdict = countdict
+        self.norms = norms
+        self.minpv_threshold = minpv_threshold
+        self.norm_key = norm_key
+
+    def _norm(self, key):
+        return self.norms.get(self.norm_key(key) if self.norm_key else key, 0)
+
+    def __len__(self):
+        return len(self.countdict)
+
+    def __iter__(self):
+        return iter(self.countdict)
+
+    def __contains__(self, key):
+        return key in self.countdict
+
+    def __getitem__(self, key):
+        return _ratio(self.countdict[key], self._norm(key), self.minpv_threshold)
+
+    def get(self, key, default=None):
+        if key in self.countdict:
+            return self[key]
+        return default
+
+    def values(self):
+        return map(itemgetter(1), self.items())
+
+    def items(self):
+        if isinstance(self.norms, SpillCounter) and not self.norm_key:
+            items = self.countdict.items()
+            if not isinstance(self.countdict, SpillCounter):
+                # a spilled countdict is already sorted; one that is not holds at most max_items keys
+                items = sorted(items, key=itemgetter(0))
+            return ((key, _ratio(count, norm, self.minpv_threshold))
+                    for key, count, norm in _merge_norms(items, self.norms.items()))
+        norm_keys = map(self.norm_key, self.countdict) if self.norm_key else iter(self.countdict)
+        return zip(self.countdict, map(_ratio, self.countdict.values(), map(self.norms.get, norm_keys, repeat(0)),
+                                       repeat(self.minpv_threshold)))
+
+
+def _ratio(count, norm, minpv_threshold):
+    # only compute proportion for keys w/ enough traffic that the pattern MIGHT be real
+    if norm > minpv_threshold:
+        return count / norm
+    return 0
+
+
+def _merge_norms(items, norm_items):
+    """(key, count, norm) for (key, count) items and (key, norm) norm_items, both sorted by key (norm 0 if missing)."""
+    norm_items = iter(norm_items)
+    norm_key, norm = next(norm_items, (None, 0))
+    for key, count in items:
+        while norm_key is not None and norm_key < key:
+            norm_key, norm = next(norm_items, (None, 0))
+        yield key, count, (norm if norm_key == key else 0)
+
+
+def _tally(items, totals):
+    """Pass items through while summing their values into totals[0]."""
+    for item in items:
+        totals[0] += item[1]
+        yield item
+
+
+def weight_by_proj(countdict, pvs_by_proj, minpv_threshold=500):
+    """Normalize count stats (keyed by '<from project>-<to project>') by how many page views occurred on a project"""
+    return WeightedCounts(countdict, pvs_by_proj, minpv_threshold, norm_key=lambda pi_to_pj: pi_to_pj.split("-")[0])
+
+
+def weight_by_pvs(countdict, pvs_by_wd, minpv_threshold=50):
+    """Normalize count stats by how often a page was viewed"""
+    return WeightedCounts(countdict, pvs_by_wd, minpv_threshold)
+
+
+class Report:
+    """Logs top-k tables grouped by section and usertype and collects them for an optional report file.
+
+    Report files are .json (a list of tables {section, usertype, lbl, name, total, remainder,
+    rows: [{rank, key, label, value, share or context}]}) or anything else for TSV (one row per table row).
+    """
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.tables = []
+        self.current_section = None
+        self.current_usertype = None
+
+    def section(self, title):
+        logging.info("\n{0}:".format(title))
+        self.current_section = title
+        self.current_usertype = None
+
+    def usertype(self, ut):
+        logging.info("==={0}===".format(ut))
+        self.current_usertype = ut
+
+    def print_stats(self, countdict, threshold, lbl, ignore=(), context_dict=None, label=None, name=None):
+        """Log the top threshold + 1 items of a count dict and the remainder.
+
+        Items are shown with their share of the total or, if context_dict is given, with their value in context_dict.
+        label (optional) maps a key to the name that is shown. name (optional) identifies the table in the report file
+        if there are several with the same section, usertype and lbl.
+        """
+        items = countdict.items()
+        num_items = len(countdict)
+        if ignore:
+            ignore = set(ignore)
+            items = ((k, v) for k, v in items if k not in ignore)
+            num_items -= sum(1 for k in ignore if k in countdict)
+        if isinstance(countdict, dict) and not ignore:
+            denominator = sum(countdict.values())
+            top = top_k(countdict, threshold + 1)
+        else:
+            # values are computed (or filtered) on the fly, so get the total in the same pass as the top items
+            totals = [0]
+            top = heapq.nlargest(threshold + 1, _tally(items, totals), key=itemgetter(1))
+            denominator = totals[0]
+        rows = []
+        for rank, (k, v) in enumerate(top, start=1):
+            shown = label(k) if label else k
+            row = {'rank': rank, 'key': k, 'label': shown, 'value': v}
+            if context_dict:
+                row['context'] = context_dict.get(k, "N/A")
+                logging.info("{0} {1}:\t{2}\t({3}) times.".format(shown, lbl, v, row['context']))
+            else:
+                row['share'] = v / denominator
+                logging.info("{0} {1}:\t{2}\t({3:.3f}) times.".format(shown, lbl, v, row['share']))
+            rows.append(row)
+        rest = denominator - sum(v for _, v in top) if num_items > len(top) else 0
+        if rest:
+            logging.info("Remainder:\t{0}\t({1:.3f}) times.".format(rest, rest / denominator))
+        self.tables.append({'section': self.current_section, 'usertype': self.current_usertype, 'lbl': lbl,
+                            'name': name, 'total': denominator, 'remainder': rest, 'rows': rows})
+
+    def write(self):
+        """Write the collected tables to the report file (if any) as JSON or TSV depending on the extension."""
+        if not self.fn:
+            return
+        if self.fn.endswith('.json'):
+            with open(self.fn, 'w') as fout:
+                json.dump(self.tables, fout, indent=1)
+        else:
+            with open(self.fn, 'w') as fout:
+                csvwriter = csv.writer(fout, delimiter="\t")
+                csvwriter.writerow(TSV_COLUMNS)
+                for table in self.tables:
+                    for row in table['rows']:
+                        csvwriter.writerow([table['section'], table['usertype'], table['lbl'], table['name']] +
+                                           [row.get(c, '') for c in TSV_COLUMNS[4:]])
+        logging.info("Report with {0} tables written to {1}".format(len(self.tables), self.fn))
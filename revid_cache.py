@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import time
+
+class RevidCache:
+    """Persistent QID -> (English title, most recent revision ID, fetch time) cache backed by SQLite.
+
+    One cache can be shared by every language's switch dataset so a QID is only fetched once.
+    Entries older than ttl_days (if given) count as missing so they are refreshed on the next run.
+    """
+
+    def __init__(self, db_path, ttl_days=None):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_days * 86400 if ttl_days is not None else None
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS revids ("
+                          "qid TEXT PRIMARY KEY, title TEXT, rev_id INTEGER, fetched_at INTEGER)")
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM revids").fetchone()[0]
+
+    def _with_qids(self, qids):
+        """Load qids into a temporary table so lookups are a single indexed join instead of one query per QID."""
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (qid TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM lookup")
+        self.conn.executemany("INSERT OR IGNORE INTO lookup VALUES (?)", ((q,) for q in qids))
+
+    def missing(self, qids):
+        """Get the subset of qids that are not cached or whose revision is older than the TTL."""
+        self._with_qids(qids)
+        query = "SELECT l.qid FROM lookup l LEFT JOIN revids r ON l.qid = r.qid WHERE r.qid IS NULL"
+        params = ()
+        if self.ttl_seconds is not None:
+            query += " OR r.fetched_at < ?"
+            params = (int(time.time() - self.ttl_seconds),)
+        return set(row[0] for row in self.conn.execute(query, params))
+
+    def get_many(self, qids):
+        """Get {qid: rev_id} for the cached subset of qids (0 if no revision could be found)."""
+        self._with_qids(qids)
+        return dict(self.conn.execute("SELECT r.qid, r.rev_id FROM lookup l JOIN revids r ON l.qid = r.qid"))
+
+    def put_many(self, records, fetched_at=None):
+        """Insert or refresh (qid, title, rev_id) records and commit, so progress survives interruptions."""
+        if fetched_at is None:
+            fetched_at = int(time.time())
+        self.conn.executemany("INSERT OR REPLACE INTO revids VALUES (?, ?, ?, ?)",
+                              ((qid, title, rev_id, fetched_at) for qid, title, rev_id in records))
+        self.conn.commit()
+
+    def import_json(self, fn):
+        """Import a JSON-lines file of {qid, rev_id} records (e.g., an old qid_revids.json) for QIDs not cached yet."""
+        records = []
+        with open(fn, 'r') as fin:
+            for line in fin:
+                record = json.loads(line)
+                try:
+                    rev_id = int(record['rev_id'])
+                except TypeError:
+                    rev_id = 0
+                records.append((record['qid'], None, rev_id))
+        # unknown fetch time: treat as stale as soon as any TTL applies
+        before = len(self)
+        self.conn.executemany("INSERT OR IGNORE INTO revids VALUES (?, ?, ?, 0)", records)
+        self.conn.commit()
+        return len(self) - before
+
+    def export_json(self, fn, qids=None):
+        """Write JSON-lines {qid, rev_id} records (for all cached QIDs or only qids) in the format ORES input expects."""
+        if qids is None:
+            rows = self.conn.execute("SELECT qid, rev_id FROM revids ORDER BY qid")
+        else:
+            self._with_qids(qids)
+            rows = self.conn.execute("SELECT r.qid, r.rev_id FROM lookup l JOIN revids r ON l.qid = r.qid "
+                                     "ORDER BY r.qid")
+        num_records = 0
+        with open(fn, 'w') as fout:
+            for qid, rev_id in rows:
+                fout.write(json.dumps({'qid': qid, 'rev_id': rev_id}, separators=(',', ':')) + '\n')
+                num_records += 1
+        return num_records
+
+    def close(self):
+        self.conn.close()
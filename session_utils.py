@@ -1,20 +1,231 @@
+from array import array
 from collections import namedtuple
 import csv
+from datetime import datetime, timezone
+import functools
 import gzip
+import hashlib
+import heapq
+import itertools
 import logging
+from operator import itemgetter
+import os
+import pickle
 import sys
 import urllib.parse
 
 csv.field_size_limit(sys.maxsize)
-logging.basicConfig(level=logging.INFO)
 
 Switch = namedtuple("Switch", ['srclang', 'targetlang', 'country', 'qid', 'title', 'datetime', 'usertype', 'title_country_src_count'])
-Session = namedtuple('Session', ['usrhash', 'country', 'pageviews', 'usertype'])
-Pageview = namedtuple('Pageview', ['dt', 'proj', 'title', 'wd', 'referer'])
+Session = namedtuple('Session', ['usrhash', 'country', 'pageviews', 'usertype', 'duplicates', 'subsession'],
+                     defaults=(0, 0))
+Pageview = namedtuple('Pageview', ['dt', 'proj', 'title', 'wd', 'referer'], defaults=(None,))
 EDIT_STR = "EDITATTEMPT"
 usertypes = ['reader', 'editor']
 
-def tsv_to_sessions(tsv, trim=False):
+
+class Vocab:
+    """Bidirectional mapping between strings and dense integer ids.
+
+    Id 0 is reserved for missing values (None / empty string) so that it is falsy like the strings it replaces.
+    """
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = {None: 0, '': 0}
+        self.values = [None]
+
+    def id(self, value):
+        try:
+            return self.ids[value]
+        except KeyError:
+            idx = len(self.values)
+            self.ids[value] = idx
+            self.values.append(value)
+            return idx
+
+    def get(self, value, default=-1):
+        return self.ids.get(value, default)
+
+    def value(self, idx):
+        return self.values[idx]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class PageviewVocab:
+    """The string vocabularies of CompactPageviews: projects and referers (shared so that ref_match can compare ids
+    directly) and titles.
+
+    Vocabularies only grow, so they are scoped to the page views that use them instead of the process: each
+    tsv_to_sessions(compact=True) call (and each CompactPageviews built on its own) gets a new one, which is freed with
+    the last session read in it. Passing the same vocab to several calls keeps ids comparable across them at the cost
+    of holding every title seen in all of them.
+    """
+    __slots__ = ('projects', 'titles')
+
+    def __init__(self):
+        self.projects = Vocab()
+        self.titles = Vocab()
+
+
+def qid_to_int(qid):
+    """Convert Wikidata ID (e.g., 'Q10856') to int (e.g., 10856). Missing IDs become 0.
+
+    Raises ValueError for anything else (e.g., 'P31' or 'foo'), which would otherwise be taken for another item.
+    """
+    if qid:
+        digits = qid[1:]
+        if qid[0] != 'Q' or not (digits.isascii() and digits.isdigit()):
+            raise ValueError("Not a Wikidata item ID: {0!r}".format(qid))
+        return int(digits)
+    return 0
+
+
+def int_to_qid(qid_id):
+    if qid_id:
+        return 'Q{0}'.format(qid_id)
+    return None
+
+
+# epoch seconds of the minutes (e.g., '2019-02-16T11:31') seen so far: a day of page views has at most 1440
+_MINUTE_EPOCHS = {}
+_MAX_CACHED_MINUTES = 1 << 16
+
+
+def _parse_epoch(dt):
+    return int(datetime.fromisoformat(dt).replace(tzinfo=timezone.utc).timestamp())
+
+
+def dt_to_epoch(dt):
+    """Convert webrequest datetime string (e.g., '2019-02-16T11:31:53') to UTC epoch seconds.
+
+    Only the first page view in a minute goes through datetime parsing; the others add their seconds to the cached
+    minute, which is several times faster for the large number of rows in a webrequest file.
+    """
+    seconds = dt[17:19]
+    # anything but 'YYYY-MM-DDTHH:MM:SS' with valid seconds gets (and is validated by) full parsing
+    if len(dt) != 19 or dt[16] != ':' or not (seconds.isascii() and seconds.isdigit()) or seconds > '59':
+        return _parse_epoch(dt)
+    minute = _MINUTE_EPOCHS.get(dt[:16])
+    if minute is None:
+        if len(_MINUTE_EPOCHS) >= _MAX_CACHED_MINUTES:
+            _MINUTE_EPOCHS.clear()
+        minute = _MINUTE_EPOCHS[dt[:16]] = _parse_epoch(dt[:16])
+    return minute + int(seconds)
+
+
+def pageview_epochs(pvs):
+    """Epoch seconds of a session's page views (CompactPageviews already store them)."""
+    if isinstance(pvs, CompactPageviews):
+        return pvs.epochs
+    return array('q', [dt_to_epoch(pv.dt) for pv in pvs])
+
+
+def epoch_to_dt(epoch):
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class CompactPageviews:
+    """Struct-of-arrays alternative to a list of Pageview namedtuples.
+
+    Each field is stored as a typed array column of ids (see PageviewVocab / qid_to_int) so a page view costs
+    ~32 bytes instead of a namedtuple plus five strings. Indexing returns a Pageview so pvs[i].proj still works.
+    """
+    COLUMNS = ('epochs', 'proj_ids', 'title_ids', 'qids', 'referer_ids')
+    __slots__ = COLUMNS + ('vocab',)
+
+    def __init__(self, pvs=(), vocab=None):
+        self.vocab = PageviewVocab() if vocab is None else vocab
+        self.epochs = array('q')
+        self.proj_ids = array('l')
+        self.title_ids = array('q')
+        self.qids = array('q')
+        self.referer_ids = array('l')
+        for pv in pvs:
+            self.append(pv)
+
+    def append(self, pv):
+        self.add(dt_to_epoch(pv.dt), pv.proj, pv.title, qid_to_int(pv.wd), pv.referer)
+
+    def add(self, epoch, proj, title, qid, referer):
+        """Append a page view from already parsed fields (qid as returned by qid_to_int)."""
+        vocab = self.vocab
+        self.epochs.append(epoch)
+        self.proj_ids.append(vocab.projects.id(proj))
+        self.title_ids.append(vocab.titles.id(title))
+        self.qids.append(qid)
+        self.referer_ids.append(vocab.projects.id(referer))
+
+    def select(self, indices):
+        """Keep only the page views at the given (sorted) indices."""
+        for col in self.COLUMNS:
+            values = getattr(self, col)
+            setattr(self, col, array(values.typecode, [values[i] for i in indices]))
+
+    def pop(self, i=-1):
+        pv = self[i]
+        for col in (self.epochs, self.proj_ids, self.title_ids, self.qids, self.referer_ids):
+            col.pop(i)
+        return pv
+
+    def __len__(self):
+        return len(self.proj_ids)
+
+    def __getitem__(self, i):
+        vocab = self.vocab
+        return Pageview(epoch_to_dt(self.epochs[i]),
+                        vocab.projects.value(self.proj_ids[i]),
+                        vocab.titles.value(self.title_ids[i]),
+                        int_to_qid(self.qids[i]),
+                        vocab.projects.value(self.referer_ids[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class CompactSession:
+    """Same fields as Session, but with CompactPageviews and without a per-instance __dict__."""
+    __slots__ = ('usrhash', 'country', 'pageviews', 'usertype', 'duplicates', 'subsession')
+
+    def __init__(self, usrhash, country, pageviews, usertype, duplicates=0, subsession=0):
+        self.usrhash = usrhash
+        self.country = country
+        self.pageviews = pageviews
+        self.usertype = usertype
+        self.duplicates = duplicates
+        self.subsession = subsession
+
+    def __repr__(self):
+        return ('CompactSession(usrhash={0!r}, country={1!r}, pageviews={2!r}, usertype={3!r}, duplicates={4!r}, '
+                'subsession={5!r})'.format(self.usrhash, self.country, self.pageviews, self.usertype, self.duplicates,
+                                           self.subsession))
+
+
+def _columns(pvs):
+    """Get (projects, wikidata items, referers) columns for a session's page views.
+
+    For CompactPageviews these are integer id arrays, so comparisons never materialize Pageview objects.
+    """
+    if isinstance(pvs, CompactPageviews):
+        return pvs.proj_ids, pvs.qids, pvs.referer_ids
+    return [p.proj for p in pvs], [p.wd for p in pvs], [p.referer for p in pvs]
+
+
+def _proj_keys(pvs, wikidbs):
+    """Translate project names into the representation used by _columns."""
+    if isinstance(pvs, CompactPageviews):
+        return [pvs.vocab.projects.get(w) for w in wikidbs]
+    return list(wikidbs)
+
+
+def tsv_to_sessions(tsv, trim=False, compact=False, sample_rate=1.0, gap_seconds=None, start_line=0, skip_usr=None,
+                    position=None, max_pvs=None, max_per_minute=None, stats=None, vocab=None):
     """Convert TSV file of pageviews to reader sessions.
 
     Each line corresponds to a pageview and the file is sorted by user and then time.
@@ -24,11 +235,43 @@ def tsv_to_sessions(tsv, trim=False):
     00000a5795ba512...  enwiki  Anarchism   12      2019-02-16T11:32:05 Norway  https://en.wikipedia.org/   Q6199
 
     This yields a Session object where:
-    session.usrhash = '00000a5795ba512...'
+    session.usrhash = 0x00000a5795ba512.. (first 64 bits of the hash as an int; see user_key)
     session.country = 'Norway'
     session.pageviews = [(dt='2019-02-16T11:31:53', proj='enwiki', title='Columbidae', wd='Q10856', referer='google'),
                          (dt='2019-02-16T11:32:05', proj='enwiki', title='Anarchism', wd='Q6199', referer='enwiki')]
+
+    If trim is True, only the first view of a given page title on a given project is kept (see trim_session).
+    Duplicates are dropped while reading and their number is available as session.duplicates.
+    If compact is True, CompactSession objects with CompactPageviews are yielded instead. Their page views share vocab
+    (a PageviewVocab), by default a new one for this call.
+    Lines whose datetime cannot be parsed are malformed when it is needed (compact or gap_seconds); otherwise the
+    string is kept as is.
+    If sample_rate < 1, only users whose hash falls below sample_rate (see in_sample) are kept. This is checked on
+    the raw line before any parsing so skipped users are cheap, and it selects the same users in every file and run.
+    If gap_seconds is given, a user's page views are split into separate sessions wherever there are more than
+    gap_seconds between two consecutive lines (e.g., 1800 for 30 minutes of inactivity). These sessions share the
+    usrhash and are numbered by session.subsession (0, 1, ...); usertype, trimming and duplicates are per session.
+
+    Likely bots can be dropped while reading: once a session has more than max_pvs page views (after trimming, i.e.,
+    the same count as len(session.pageviews)) or a user has more than max_per_minute lines (page views, duplicates and
+    edit attempts) within one clock minute, no more page views are built and the user's remaining lines are skipped
+    without parsing. The user's current session is not yielded (earlier sessions split off by gap_seconds are). If
+    stats is a dict, stats['bots'][usertype] counts the users dropped and stats['bot_lines'] the lines skipped.
+
+    For checkpoints (see scan_sessions): if position is a dict, position['line'] and position['usr'] are set before
+    each session is yielded to the number of data lines read up to the next session and the yielded user's hash.
+    Reading can then resume with start_line=position['line']; skip_usr=position['usr'] checks that the line there
+    does not belong to the same user (i.e., that the file matches the checkpoint). Sessions split off by gap_seconds
+    end in the middle of a user, so position['line'] is None for them (no consistent point to resume from).
     """
+    if compact:
+        if vocab is None:
+            vocab = PageviewVocab()
+        new_pvs = functools.partial(CompactPageviews, vocab=vocab)
+        new_session = CompactSession
+    else:
+        new_pvs = list
+        new_session = Session
     expected_header = ['user', 'project', 'page_title', 'page_id', 'dt', 'country', 'referer', 'item_id']
     usr_idx = expected_header.index('user')
     proj_idx = expected_header.index('project')
@@ -38,52 +281,355 @@ def tsv_to_sessions(tsv, trim=False):
     referer_idx = expected_header.index('referer')
     wd_idx = expected_header.index("item_id")
     malformed_lines = 0
-    i = 0
+    num_users = 0
+    key_collisions = 0
+    gap_splits = 0
+    sample_threshold = sample_threshold_for(sample_rate)
+    parse_epochs = compact or gap_seconds is not None
+    if stats is None:
+        stats = {}
+    bots = stats.setdefault('bots', dict.fromkeys(usertypes, 0))
+    stats.setdefault('bot_lines', 0)
+    # counts before this file (stats are kept up to date while reading, e.g., for checkpoints)
+    num_bots = sum(bots.values())
+    num_bot_lines = stats['bot_lines']
+    i = start_line
     with gzip.open(tsv, 'rt') as fin:
         assert next(fin).strip().split("\t") == expected_header
+        if start_line:
+            # skipped lines are only decompressed, not parsed
+            for _ in itertools.islice(fin, start_line):
+                pass
+        if skip_usr is not None:
+            first_line = next(fin, '')
+            if first_line.split("\t", 1)[0] == skip_usr:
+                raise ValueError("{0} line {1} continues the session of the last checkpointed user.".format(
+                    tsv, start_line))
+            fin = itertools.chain([first_line] if first_line else [], fin)
+        if position is None:
+            position = {}
+        # hash prefix of last line seen and whether that user is in the sample
+        last_prefix = None
+        keep_usr = True
         curr_usr = None
+        # compact key (hex prefix) of the current user
+        curr_key = None
         country = None
         usertype = 'reader'
-        session = []
-        for i, line in enumerate(fin):
-            line = line.strip().split("\t")
+        session = new_pvs()
+        # (project, title) pairs already in the session; duplicates are skipped before building page views
+        seen = set()
+        duplicates = 0
+        # index of the current session among the user's sessions and time of the user's last line (with gap_seconds)
+        subsession = 0
+        last_epoch = 0
+        # clock minute of the user's last line and number of lines in it (with max_per_minute)
+        curr_minute = None
+        minute_lines = 0
+        # '<user hash>\t' of a user found to be a bot: their remaining lines are skipped
+        bot_prefix = None
+        for i, line in enumerate(fin, start=start_line):
+            if sample_threshold is not None:
+                prefix = line[:SAMPLE_PREFIX_CHARS]
+                if prefix != last_prefix:
+                    last_prefix = prefix
+                    keep_usr = in_sample(prefix, sample_threshold)
+                if not keep_usr:
+                    continue
+            if bot_prefix is not None:
+                if line.startswith(bot_prefix):
+                    stats['bot_lines'] += 1
+                    continue
+                bot_prefix = None
+            fields = line.strip().split("\t")
             try:
-                usr = line[usr_idx]
-                proj = line[proj_idx]
-                title = line[title_idx]
-                dt = line[dt_idx]
-                ref = ref_class(line[referer_idx])
-            except IndexError:
+                usr = fields[usr_idx]
+                proj = fields[proj_idx]
+                title = fields[title_idx]
+                dt = fields[dt_idx]
+                referer = fields[referer_idx]
+                epoch = dt_to_epoch(dt) if parse_epochs else 0
+                wd_item = fields[wd_idx] if len(fields) > wd_idx else None
+                # compact sessions store item ids as ints: lines with other item ids are malformed
+                qid = qid_to_int(wd_item) if compact else 0
+            except (IndexError, ValueError):
                 malformed_lines += 1
                 continue
-            try:
-                wd_item = line[wd_idx]
-            except IndexError:
-                wd_item = None
-            pv = Pageview(dt, proj, title, wd_item, ref)
+            # splitting the line already materializes the hash and comparing it is a single memcmp,
+            # which is cheaper in Python than slicing out the compact key for every line
             if usr == curr_usr:
+                if max_per_minute is not None:
+                    minute = dt[:16]
+                    if minute == curr_minute:
+                        minute_lines += 1
+                        if minute_lines > max_per_minute:
+                            bots[usertype] += 1
+                            bot_prefix = usr + "\t"
+                            session = None
+                            continue
+                    else:
+                        curr_minute = minute
+                        minute_lines = 1
+                if gap_seconds is not None and epoch - last_epoch > gap_seconds:
+                    # inactivity gap: the user's next session starts with this line
+                    position['line'] = None
+                    position['usr'] = curr_usr
+                    yield(new_session(user_key(curr_key), country, session, usertype, duplicates, subsession))
+                    gap_splits += 1
+                    subsession += 1
+                    session = new_pvs()
+                    seen = set()
+                    duplicates = 0
+                    usertype = 'reader'
+                last_epoch = epoch
                 if title == EDIT_STR:
                     usertype = 'editor'
-                else:
-                    session.append(pv)
+                    continue
+                if trim:
+                    pv_id = (proj, title)
+                    if pv_id in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(pv_id)
             else:
-                if curr_usr:
-                    if trim:
-                        trim_session(session)
-                    yield(Session(curr_usr, country, session, usertype=usertype))
+                if session is not None and curr_usr:
+                    position['line'] = i
+                    position['usr'] = curr_usr
+                    yield(new_session(user_key(curr_key), country, session, usertype, duplicates, subsession))
+                # input is sorted by hash, so distinct users sharing a compact key are always adjacent
+                key = usr[:USER_KEY_HEX_CHARS]
+                if key == curr_key:
+                    key_collisions += 1
+                num_users += 1
                 curr_usr = usr
-                country = line[country_idx]
+                curr_key = key
+                country = fields[country_idx]
+                session = new_pvs()
+                seen = set()
+                duplicates = 0
+                subsession = 0
+                last_epoch = epoch
+                curr_minute = dt[:16]
+                minute_lines = 1
                 if title == EDIT_STR:
                     usertype = 'editor'
-                    session = []
-                else:
-                    usertype = 'reader'
-                    session = [pv]
-        if curr_usr:
-            if trim:
-                trim_session(session)
-            yield (Session(curr_usr, country, session, usertype=usertype))
-    print("{0} total lines. {1} malformed.".format(i, malformed_lines))
+                    continue
+                usertype = 'reader'
+                seen.add((proj, title))
+            if compact:
+                session.add(epoch, proj, title, qid, ref_class(referer))
+            else:
+                session.append(Pageview(dt, proj, title, wd_item, ref_class(referer)))
+            if max_pvs is not None and len(session) > max_pvs:
+                bots[usertype] += 1
+                bot_prefix = usr + "\t"
+                session = None
+        if session is not None and curr_usr:
+            position['line'] = i + 1
+            position['usr'] = curr_usr
+            yield (new_session(user_key(curr_key), country, session, usertype, duplicates, subsession))
+    print("{0} total lines. {1} malformed. {2} users; {3} {4}-bit user key collisions (~{5:.2g} expected).".format(
+        i, malformed_lines, num_users, key_collisions, USER_KEY_HEX_CHARS * 4, expected_key_collisions(num_users)))
+    if max_pvs is not None or max_per_minute is not None:
+        print("{0} users dropped as likely bots ({1} lines skipped without parsing).".format(
+            sum(bots.values()) - num_bots, stats['bot_lines'] - num_bot_lines))
+    if gap_seconds is not None:
+        print("{0} sessions after splitting at gaps of more than {1} seconds ({2} splits).".format(
+            num_users + gap_splits, gap_seconds, gap_splits))
+
+
+# number of leading hex characters of the (sha512) user hash kept as the compact user key (64 bits)
+USER_KEY_HEX_CHARS = 16
+
+
+def user_key(usrhash):
+    """Compact integer user key: the first 64 bits of the hex user hash.
+
+    Non-hex identifiers (e.g., in tests) are hashed to the same width instead.
+    """
+    usrhash = usrhash[:USER_KEY_HEX_CHARS]
+    try:
+        return int(usrhash, 16)
+    except ValueError:
+        return int.from_bytes(hashlib.blake2b(usrhash.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def expected_key_collisions(num_users):
+    """Expected number of colliding user pairs for uniformly distributed keys (birthday bound)."""
+    return num_users * (num_users - 1) / 2 ** (USER_KEY_HEX_CHARS * 4 + 1)
+
+
+# number of leading hex characters of the user hash used for sampling (32 bits)
+SAMPLE_PREFIX_CHARS = 8
+
+
+def sample_threshold_for(sample_rate):
+    """Hash prefix value below which users are kept for a given sample rate (None if no sampling)."""
+    if sample_rate >= 1:
+        return None
+    if sample_rate <= 0:
+        raise ValueError("Sample rate must be in (0, 1]: {0}".format(sample_rate))
+    return int(sample_rate * 16 ** SAMPLE_PREFIX_CHARS)
+
+
+def in_sample(usrhash, sample_threshold):
+    """Deterministically decide whether a user (hex hash) is in the sample."""
+    try:
+        return int(usrhash[:SAMPLE_PREFIX_CHARS], 16) < sample_threshold
+    except ValueError:
+        # not a hash (e.g., malformed line); leave it to the parser
+        return True
+
+
+def wilson_interval(successes, trials, z=1.96):
+    """Wilson score interval for a binomial proportion (e.g., share of sampled users who switch)."""
+    if not trials:
+        return (0.0, 0.0, 0.0)
+    p = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (p + z ** 2 / (2 * trials)) / denominator
+    margin = z * ((p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) ** 0.5) / denominator
+    return (p, max(0.0, center - margin), min(1.0, center + margin))
+
+
+def scaled_count_interval(count, sample_rate, z=1.96):
+    """Scale a count observed in a user sample up to the full population, with a normal-approximation interval.
+
+    Each user is kept independently with probability sample_rate, so count ~ Binomial(N, sample_rate) and
+    count / sample_rate is an unbiased estimate of N with variance ~ count * (1 - sample_rate) / sample_rate^2.
+    """
+    estimate = count / sample_rate
+    margin = z * (count * (1 - sample_rate)) ** 0.5 / sample_rate
+    return (estimate, max(0.0, estimate - margin), estimate + margin)
+
+
+def log_scaled_counts(countdict, sample_rate, threshold, lbl=""):
+    """Log the top counts from a user sample scaled up to the full population with 95% intervals."""
+    for k, count in heapq.nlargest(threshold, countdict.items(), key=itemgetter(1)):
+        estimate, low, high = scaled_count_interval(count, sample_rate)
+        logging.info("{0} {1}:\t~{2:.0f}\t[{3:.0f}, {4:.0f}]\t({5} sampled).".format(
+            k, lbl, estimate, low, high, count))
+
+
+class SessionConsumer:
+    """An analysis that is fed sessions one at a time by scan_sessions.
+
+    Subclasses hold their own counters, update them in consume and produce their output in report.
+    Several consumers can share a single pass over the data (see multi_analysis.py).
+    """
+
+    def consume(self, session):
+        raise NotImplementedError
+
+    def report(self):
+        pass
+
+    def get_state(self):
+        """Counter state saved in checkpoints (by default everything but the arguments)."""
+        return {k: v for k, v in self.__dict__.items() if k != 'args'}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+
+def save_checkpoint(fn, checkpoint):
+    """Atomically write a checkpoint: a crash while writing leaves the previous checkpoint intact."""
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as fout:
+        pickle.dump(checkpoint, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fn, fn)
+
+
+def load_checkpoint(fn):
+    with open(fn, 'rb') as fin:
+        return pickle.load(fin)
+
+
+def scan_sessions(tsvs, consumers, stopafter=-1, log_every=500000, trim=True, sample_rate=1.0, gap_seconds=None,
+                  checkpoint=None, checkpoint_every=0, resume=False, max_pvs=None, max_per_minute=None):
+    """Stream the sessions in each TSV once, passing every session to each consumer.
+
+    Parameters:
+        tsvs: list of .tsv.gz files with page views ordered by user/datetime
+        consumers: list of SessionConsumer objects
+        stopafter: process only this many sessions (-1 for all)
+        log_every: log progress after processing every n sessions
+        trim: retain only the first page view for a given title-project (see tsv_to_sessions)
+        sample_rate: keep only this fraction of users, selected by user hash (see tsv_to_sessions)
+        gap_seconds: split a user's page views into sessions at gaps of more than this many seconds
+        checkpoint: if given, file to save the consumers' state and input position to after each TSV
+        checkpoint_every: also checkpoint after every n sessions (at the next boundary between users)
+        resume: restore the consumers and continue from the checkpoint file (if it exists)
+        max_pvs, max_per_minute: drop likely bots while reading (see tsv_to_sessions); consumers never see them
+    Returns:
+        Number of sessions processed.
+    """
+    i = 0
+    start_tsv = 0
+    start_line = 0
+    skip_usr = None
+    tsvs = list(tsvs)
+    options = {'trim': trim, 'sample_rate': sample_rate, 'gap_seconds': gap_seconds, 'max_pvs': max_pvs,
+               'max_per_minute': max_per_minute}
+    # users dropped as likely bots while reading, per usertype
+    stats = {'bots': dict.fromkeys(usertypes, 0), 'bot_lines': 0}
+    if resume and checkpoint and os.path.exists(checkpoint):
+        state = load_checkpoint(checkpoint)
+        if (state['tsvs'] != tsvs or state['consumers_types'] != [type(c).__name__ for c in consumers] or
+                state['options'] != options):
+            raise ValueError("Checkpoint {0} was written for other input files, analyses or options.".format(
+                checkpoint))
+        for consumer, consumer_state in zip(consumers, state['consumers']):
+            consumer.set_state(consumer_state)
+        i = state['sessions']
+        stats = state['stats']
+        start_tsv = state['tsv_index']
+        start_line = state['line']
+        skip_usr = state['usr']
+        logging.info("Resuming from {0}: {1} sessions analyzed; continuing at file {2} line {3}.".format(
+            checkpoint, i, start_tsv, start_line))
+
+    def save(tsv_index, line, usr):
+        save_checkpoint(checkpoint, {'tsvs': tsvs, 'tsv_index': tsv_index, 'line': line, 'usr': usr, 'sessions': i,
+                                     'stats': stats, 'options': options,
+                                     'consumers_types': [type(c).__name__ for c in consumers],
+                                     'consumers': [c.get_state() for c in consumers]})
+        logging.debug("Checkpoint saved: {0} sessions; file {1} line {2}.".format(i, tsv_index, line))
+        return i
+
+    last_saved = i
+    for tsv_index in range(start_tsv, len(tsvs)):
+        tsv = tsvs[tsv_index]
+        if i == stopafter:
+            break
+        logging.info("Processing: {0}".format(tsv))
+        position = {}
+        if tsv_index != start_tsv:
+            start_line = 0
+            skip_usr = None
+        for session in tsv_to_sessions(tsv, trim=trim, sample_rate=sample_rate, gap_seconds=gap_seconds,
+                                       start_line=start_line, skip_usr=skip_usr, position=position, max_pvs=max_pvs,
+                                       max_per_minute=max_per_minute, stats=stats):
+            if i == stopafter:
+                break
+            i += 1
+            if i % log_every == 0:
+                logging.info("{0} sessions analyzed.".format(i))
+            for consumer in consumers:
+                consumer.consume(session)
+            # sessions split off by gap_seconds end mid-user: wait for the next user to start
+            if checkpoint and checkpoint_every and i - last_saved >= checkpoint_every and position['line'] is not None:
+                last_saved = save(tsv_index, position['line'], position['usr'])
+        else:
+            if checkpoint:
+                last_saved = save(tsv_index + 1, 0, None)
+    logging.info("{0} sessions analyzed.".format(i))
+    if max_pvs is not None or max_per_minute is not None:
+        for ut in usertypes:
+            logging.info("{0}: {1} users dropped as likely bots while reading (> {2} pageviews or > {3} lines in a "
+                         "minute).".format(ut, stats['bots'][ut], max_pvs, max_per_minute))
+        logging.info("{0} lines of likely bots skipped without parsing.".format(stats['bot_lines']))
+    return i
 
 
 def ref_class(referer):
@@ -101,27 +647,36 @@ def trim_session(pvs):
     """Remove duplicate page views (matching title and project).
 
     For a given session, this retains only the first view of a given page title on a given project.
+    tsv_to_sessions(trim=True) already does this while reading; this is for sessions built some other way.
     Parameters:
-        pvs: list of page view objects for a given reader's session
+        pvs: list of page view objects (or CompactPageviews) for a given reader's session
     Returns:
-        Nothing. The page views are modified in place.
+        Number of page views removed. The page views are modified in place.
     """
     # only report based on first pageview of page
     user_unique_pvs = set()
-    pvs_to_remove = []
-    for i in range(0, len(pvs)):
-        pv_id = '{0}-{1}'.format(pvs[i].proj, pvs[i].title)
-        if pv_id in user_unique_pvs:
-            pvs_to_remove.append(i)
-        user_unique_pvs.add(pv_id)
-    for i in range(len(pvs_to_remove)-1, -1, -1):
-        pvs.pop(pvs_to_remove[i])
+    keep = []
+    if isinstance(pvs, CompactPageviews):
+        pv_ids = zip(pvs.proj_ids, pvs.title_ids)
+    else:
+        pv_ids = ((pv.proj, pv.title) for pv in pvs)
+    for i, pv_id in enumerate(pv_ids):
+        if pv_id not in user_unique_pvs:
+            keep.append(i)
+            user_unique_pvs.add(pv_id)
+    removed = len(pvs) - len(keep)
+    if removed:
+        if isinstance(pvs, CompactPageviews):
+            pvs.select(keep)
+        else:
+            pvs[:] = [pvs[i] for i in keep]
+    return removed
 
 def get_lang_switch(pvs, wikidbs=(), ref_match=False):
     """Get pairs of page views that are language switches.
 
     Parameters:
-        pvs: list of page view objects for a given reader's session
+        pvs: list of page view objects (or CompactPageviews) for a given reader's session
         wikidbs: if empty, all language switches return. Otherwise, only language switches that involve languages
                     included in wikidbs will be retained.
     Returns:
@@ -134,18 +689,20 @@ def get_lang_switch(pvs, wikidbs=(), ref_match=False):
                     Then the switches would be of the form [(0, 2)]
     """
     switches = []
+    projs, wds, refs = _columns(pvs)
     # at least two different projects viewed in the session
-    if len(set([p.proj for p in pvs])) > 1:
+    if len(set(projs)) > 1:
+        wikidbs = _proj_keys(pvs, wikidbs)
         # find all wikidata items viewed in multiple languages
         # preserve which one was viewed first
         for i in range(0, len(pvs) - 1):
             for j in range(i+1, len(pvs)):
-                diff_proj = pvs[i].proj != pvs[j].proj
-                same_item = pvs[i].wd and pvs[i].wd == pvs[j].wd
+                diff_proj = projs[i] != projs[j]
+                same_item = wds[i] and wds[i] == wds[j]
                 if diff_proj and same_item:
-                    if not wikidbs or pvs[i].proj in wikidbs or pvs[j].proj in wikidbs:
+                    if not wikidbs or projs[i] in wikidbs or projs[j] in wikidbs:
                         if ref_match:
-                            if pvs[i].proj == pvs[j].referer:
+                            if projs[i] == refs[j]:
                                 switches.append((i, j))
                         else:
                             switches.append((i, j))
@@ -175,28 +732,30 @@ def get_nonlang_switch(pvs, wikidb, switches=(), direction="from"):
                 If direction was "to" or wikidb was "eswiki" then no page views would be returned.
     """
     no_switches = []
+    projs = _columns(pvs)[0]
     # at least two different projects viewed in the session
-    if len(set([p.proj for p in pvs])) > 1:
+    if len(set(projs)) > 1:
         if switches:
             all_switches = switches
         else:
             all_switches = get_lang_switch(pvs, [wikidb])
+        wikidb = _proj_keys(pvs, [wikidb])[0]
         # did user have any switches of form:
         # direction == "from": wikidb -> other language
         # direction == "to": other language -> wikidb
         dir_switches_in_lang = set()
         for f,t in all_switches:
             # switched from wikidb -> other project
-            if direction == "from" and pvs[f].proj == wikidb:
+            if direction == "from" and projs[f] == wikidb:
                 dir_switches_in_lang.add(f)
             # switched from other project -> wikidb
-            elif direction == "to" and pvs[t].proj == wikidb:
+            elif direction == "to" and projs[t] == wikidb:
                 dir_switches_in_lang.add(t)
 
         if dir_switches_in_lang:
             # find all wikidata items not viewed in multiple languages
             # preserve which one was viewed first
             for i in range(0, len(pvs)):
-                if pvs[i].proj == wikidb and i not in dir_switches_in_lang:
+                if projs[i] == wikidb and i not in dir_switches_in_lang:
                     no_switches.append(i)
     return no_switches
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""Exact string -> count dictionaries with a bound on the number of keys held in memory: the in-memory dict is spilled
+to disk as runs sorted by key, which finish() merges into one sorted run read as a read-only mapping."""
+
+import bisect
+import heapq
+import os
+import struct
+import tempfile
+from operator import itemgetter
+
+# records between entries of the index of a finished run
+INDEX_EVERY = 256
+# runs merged at once (more runs are first merged in groups)
+MERGE_FANIN = 64
+READ_SIZE = 1 << 20
+
+def sum_sorted(items):
+    """Combine consecutive items with the same key by summing their counts."""
+    items = iter(items)
+    for key, total in items:
+        break
+    else:
+        return
+    for k, count in items:
+        if k == key:
+            total += count
+        else:
+            yield key, total
+            key, total = k, count
+    yield key, total
+
+def last_sorted(items):
+    """Combine consecutive items with the same key by keeping the last value."""
+    items = iter(items)
+    for key, value in items:
+        break
+    else:
+        return
+    for k, v in items:
+        if k != key:
+            yield key, value
+            key = k
+        value = v
+    yield key, value
+
+
+class SpillCounter:
+    """Counts in a dict of at most max_items keys (checked by check()) plus sorted runs spilled to spill_dir."""
+
+    # record header: key length in bytes, count
+    RECORD = struct.Struct('<Iq')
+
+    def __init__(self, counts=None, max_items=1000000, spill_dir=None, name='counts'):
+        # the in-memory part; callers update it directly (e.g., counts[key] = counts.get(key, 0) + 1)
+        self.counts = {} if counts is None else counts
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        # files are numbered in the order they are written, so a resumed run overwrites the files an interrupted run
+        # wrote after its last checkpoint instead of leaving them behind; counters sharing a spill_dir need different
+        # names. Runs are never modified once written, so a checkpoint (which pickles the counter) stays valid.
+        self.name = name
+        self.num_files = 0
+        # a temporary directory made for this counter is removed by close()
+        self.temp_dir = None
+        self.runs = []
+        # set by finish(): the merged run and its sparse index
+        self.merged = None
+        self.index_keys = None
+        self.index_offsets = None
+        self.num_keys = None
+        self._block = (None, {})
+
+    # record format and how the values of equal keys are combined (overridden by SpillDict)
+    def _pack(self, key, value):
+        encoded = key.encode('utf-8')
+        return self.RECORD.pack(len(encoded), value) + encoded
+
+    def _unpack(self, data, pos):
+        """The record at pos as (key, value, end), or None if data ends before the record does."""
+        header_end = pos + self.RECORD.size
+        if header_end > len(data):
+            return None
+        key_len, count = self.RECORD.unpack_from(data, pos)
+        end = header_end + key_len
+        if end > len(data):
+            return None
+        return data[header_end:end].decode('utf-8'), count, end
+
+    def _combine(self, items):
+        return sum_sorted(items)
+
+    def write_run(self, fn, items):
+        """Write (key, value) items (sorted by key) as a binary run. Returns the sparse index: keys, offsets and the
+        number of records."""
+        index_keys = []
+        index_offsets = []
+        offset = 0
+        num_records = 0
+        with open(fn, 'wb') as fout:
+            chunk = []
+            for key, value in items:
+                if not isinstance(key, str):
+                    raise TypeError("{0} keys must be strings, got {1!r}.".format(type(self).__name__, key))
+                if num_records % INDEX_EVERY == 0:
+                    index_keys.append(key)
+                    index_offsets.append(offset)
+                record = self._pack(key, value)
+                chunk.append(record)
+                offset += len(record)
+                num_records += 1
+                if len(chunk) >= INDEX_EVERY:
+                    fout.write(b''.join(chunk))
+                    chunk = []
+            fout.write(b''.join(chunk))
+        index_offsets.append(offset)
+        return index_keys, index_offsets, num_records
+
+    def read_run(self, fn):
+        """Stream the (key, value) records of a run in key order."""
+        unpack = self._unpack
+        with open(fn, 'rb') as fin:
+            buffer = b''
+            while True:
+                data = fin.read(READ_SIZE)
+                if not data:
+                    break
+                buffer += data
+                # parse only whole records; the rest waits for the next read
+                pos = 0
+                while True:
+                    record = unpack(buffer, pos)
+                    if record is None:
+                        break
+                    key, value, pos = record
+                    yield key, value
+                buffer = buffer[pos:]
+
+    def _parse_records(self, data):
+        pos = 0
+        while pos < len(data):
+            key, value, pos = self._unpack(data, pos)
+            yield key, value
+
+    def check(self):
+        """Spill the in-memory counts to disk if they hold more than max_items keys."""
+        if len(self.counts) > self.max_items:
+            self.spill()
+
+    def _run_fn(self):
+        if self.spill_dir is None:
+            self.spill_dir = self.temp_dir = tempfile.mkdtemp(prefix='spill_')
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.num_files += 1
+        return os.path.join(self.spill_dir, '{0}_{1}.run'.format(self.name, self.num_files))
+
+    def spill(self):
+        if not self.counts:
+            return
+        fn = self._run_fn()
+        self.write_run(fn, sorted(self.counts.items(), key=itemgetter(0)))
+        self.runs.append(fn)
+        self.counts.clear()
+
+    def finish(self):
+        """The complete counts: the in-memory dict if nothing was spilled, else this counter as a read-only mapping
+        over the merged runs."""
+        if not self.runs:
+            return self.counts
+        if self.merged is None:
+            self.spill()
+            runs = self.runs
+            while len(runs) > MERGE_FANIN:
+                groups = [runs[i:i + MERGE_FANIN] for i in range(0, len(runs), MERGE_FANIN)]
+                runs = [self._merge(group)[0] for group in groups]
+            self.merged, (self.index_keys, self.index_offsets, self.num_keys) = self._merge(runs)
+            self.runs = []
+        return self
+
+    def _merge(self, runs):
+        """Merge runs (in the order they were written: heapq.merge keeps that order for equal keys) into a new run."""
+        fn = self._run_fn()
+        index = self.write_run(fn, self._combine(heapq.merge(*[self.read_run(run) for run in runs],
+                                                             key=itemgetter(0))))
+        for run in runs:
+            os.remove(run)
+        return fn, index
+
+    def close(self):
+        """Remove the counter's files."""
+        for fn in self.runs + ([self.merged] if self.merged else []):
+            if os.path.exists(fn):
+                os.remove(fn)
+        self.runs = []
+        self.merged = None
+        if self.temp_dir and os.path.isdir(self.temp_dir):
+            os.rmdir(self.temp_dir)
+
+    # read-only mapping over the merged counts (after finish())
+    def items(self):
+        return self.read_run(self.merged)
+
+    def __iter__(self):
+        return map(itemgetter(0), self.items())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return map(itemgetter(1), self.items())
+
+    def __len__(self):
+        return self.num_keys
+
+    def _read_block(self, i):
+        """Records of the i-th indexed block as a dict (the last block read is kept, so lookups in key order only read
+        each block once)."""
+        if self._block[0] != i:
+            with open(self.merged, 'rb') as fin:
+                fin.seek(self.index_offsets[i])
+                data = fin.read(self.index_offsets[i + 1] - self.index_offsets[i])
+            self._block = (i, dict(self._parse_records(data)))
+        return self._block[1]
+
+    def get(self, key, default=None):
+        if not isinstance(key, str):
+            return default
+        i = bisect.bisect_right(self.index_keys, key) - 1
+        if i < 0:
+            return default
+        return self._read_block(i).get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class SpillDict(SpillCounter):
+    """Like SpillCounter, for string values: the last value set for a key is kept (as in a dict)."""
+
+    # record header: key length, value length in bytes
+    RECORD = struct.Struct('<II')
+
+    def _pack(self, key, value):
+        encoded = key.encode('utf-8')
+        encoded_value = value.encode('utf-8')
+        return self.RECORD.pack(len(encoded), len(encoded_value)) + encoded + encoded_value
+
+    def _unpack(self, data, pos):
+        header_end = pos + self.RECORD.size
+        if header_end > len(data):
+            return None
+        key_len, value_len = self.RECORD.unpack_from(data, pos)
+        value_start = header_end + key_len
+        end = value_start + value_len
+        if end > len(data):
+            return None
+        return data[header_end:value_start].decode('utf-8'), data[value_start:end].decode('utf-8'), end
+
+    def _combine(self, items):
+        return last_sorted(items)
@@ -0,0 +1,330 @@
+"""Streaming language switch statistics: page view rows in the webrequest TSV format are read from stdin or a local TCP
+port as they arrive, and language pair / project counts over sliding windows are written as JSON lines."""
+
+import argparse
+from collections import Counter, OrderedDict
+import json
+import logging
+import socket
+import sys
+import time
+
+from reporting import top_k
+from session_utils import dt_to_epoch, epoch_to_dt
+from session_utils import EDIT_STR
+from session_utils import ref_class
+
+HEADER = ['user', 'project', 'page_title', 'page_id', 'dt', 'country', 'referer', 'item_id']
+
+class StreamingSession:
+    """A user's session as it arrives: get_lang_switch computed incrementally, one page view at a time.
+
+    Only what is needed to detect future switches is kept: for each Wikidata item, the page views that have not been
+    switched from yet (get_lang_switch pairs each page view with the first later view of the item on another project
+    that passes the wikidbs filter).
+    """
+
+    __slots__ = ('last_seen', 'usertype', 'num_pvs', 'seen', 'pending', 'bot')
+
+    def __init__(self, last_seen):
+        self.last_seen = last_seen
+        self.usertype = 'reader'
+        self.num_pvs = 0
+        # (project, title) pairs already viewed: only the first view is retained (as tsv_to_sessions(trim=True))
+        self.seen = set()
+        # wikidata item -> [(index, project)] of page views not yet matched to a switch
+        self.pending = {}
+        self.bot = False
+
+    def add(self, proj, title, wd, referer, wikidbs=(), ref_match=False):
+        """Add the next page view and return the switches it completes as [(index of the page view switched from,
+        project switched from)]. The new page view's index is num_pvs - 1; duplicates return None."""
+        pv_id = (proj, title)
+        if pv_id in self.seen:
+            return None
+        self.seen.add(pv_id)
+        j = self.num_pvs
+        self.num_pvs += 1
+        if not wd:
+            return []
+        switches = []
+        earlier = self.pending.get(wd)
+        if earlier:
+            still_pending = []
+            for i, proj_i in earlier:
+                if proj_i != proj and (not wikidbs or proj_i in wikidbs or proj in wikidbs):
+                    if not ref_match or proj_i == referer:
+                        switches.append((i, proj_i))
+                else:
+                    still_pending.append((i, proj_i))
+            earlier[:] = still_pending
+            earlier.append((j, proj))
+        else:
+            self.pending[wd] = [(j, proj)]
+        return switches
+
+
+class SlidingWindowCounts:
+    """Counts over sliding windows of window seconds advancing every slide seconds, kept as one Counter per slide.
+
+    Memory is bounded by the number of distinct keys in window / slide panes. Events older than the current window are
+    late and not counted.
+    """
+
+    def __init__(self, window, slide):
+        if slide <= 0 or window % slide:
+            raise ValueError("The window ({0}s) must be a positive multiple of the slide ({1}s).".format(window, slide))
+        self.window = window
+        self.slide = slide
+        self.num_panes = window // slide
+        self.panes = {}
+        self.totals = Counter()
+        self.current = None
+
+    def advance(self, epoch):
+        """Move the window forward to include epoch; returns the (start, end, counts) of the windows that closed."""
+        pane = epoch // self.slide
+        if self.current is None:
+            self.current = pane
+        closed = []
+        while self.current < pane:
+            closed.append(self._close())
+            if not self.totals:
+                # nothing left in the window: skip over gaps in the stream without emitting empty windows
+                self.current = pane
+        return closed
+
+    def _close(self):
+        end = (self.current + 1) * self.slide
+        closed = (end - self.window, end, +self.totals)
+        expired = self.panes.pop(self.current - self.num_panes + 1, None)
+        if expired:
+            self.totals.subtract(expired)
+            self.totals = +self.totals
+        self.current += 1
+        return closed
+
+    def add(self, epoch, key, n=1):
+        """Count key at epoch (after advance); returns False if the event is too late to be counted."""
+        pane = epoch // self.slide
+        if self.current is None:
+            self.current = pane
+        if pane <= self.current - self.num_panes or pane > self.current:
+            return False
+        self.panes.setdefault(pane, Counter())[key] += n
+        self.totals[key] += n
+        return True
+
+    def flush(self):
+        """Close the current window (at the end of the stream)."""
+        if self.current is None or not self.totals:
+            return []
+        return [self._close()]
+
+
+class LatencyStats:
+    """Constant-memory latency distribution: counts in power-of-two nanosecond bins."""
+
+    def __init__(self):
+        self.bins = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.bins[ns.bit_length()] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def quantile(self, q):
+        """Upper bound of the bin holding the q-quantile (in ns)."""
+        rank = q * self.count
+        seen = 0
+        for b, n in enumerate(self.bins):
+            seen += n
+            if n and seen >= rank:
+                return min(1 << b, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'events': 0}
+        return {'events': self.count, 'mean_us': round(self.total / self.count / 1000, 2),
+                'p50_us': round(self.quantile(0.5) / 1000, 2), 'p99_us': round(self.quantile(0.99) / 1000, 2),
+                'max_us': round(self.max / 1000, 2)}
+
+
+class SwitchStream:
+    """Consumes page view rows one at a time and emits windowed language pair / project counts.
+
+    Rows should arrive roughly in time order but not sorted by user. Switches are detected incrementally per user (same
+    result as session_utils.get_lang_switch on the trimmed session). A user's session ends after idle_seconds without
+    page views (event time) or when max_users sessions are open (least recently active first), and sessions longer
+    than maxpvs are treated as bots and stop being counted. Unlike the batch scripts, a session's usertype changes to
+    editor from the first edit attempt on and a bot's switches before it reached maxpvs stay counted.
+    """
+
+    def __init__(self, window=3600, slide=300, idle_seconds=1800, max_users=1000000, maxpvs=500, langs=(),
+                 k=20, emit=None):
+        self.counts = SlidingWindowCounts(window, slide)
+        self.idle_seconds = idle_seconds
+        self.max_users = max_users
+        self.maxpvs = maxpvs
+        self.wikidbs = set(langs or ())
+        self.k = k
+        self.emit = emit if emit else print
+        # user hash -> StreamingSession, least recently active first
+        self.users = OrderedDict()
+        self.now = None
+        self.latency = LatencyStats()
+        self.stats = Counter()
+
+    def process_line(self, line):
+        start = time.perf_counter_ns()
+        fields = line.rstrip("\n").split("\t")
+        if fields[:len(HEADER)] == HEADER:
+            return
+        try:
+            usr, proj, title, _, dt, _, referer = fields[:7]
+            epoch = dt_to_epoch(dt)
+        except ValueError:
+            self.stats['malformed'] += 1
+            return
+        wd = fields[7] if len(fields) > 7 else None
+        self.process(usr, proj, title, epoch, referer, wd)
+        self.latency.add(time.perf_counter_ns() - start)
+
+    def process(self, usr, proj, title, epoch, referer, wd):
+        if self.now is None or epoch > self.now:
+            self.now = epoch
+            for start, end, counts in self.counts.advance(epoch):
+                self.emit_window(start, end, counts)
+
+        session = self.users.get(usr)
+        if session is None or session.last_seen < self.now - self.idle_seconds:
+            session = StreamingSession(epoch)
+            self.users[usr] = session
+            self.stats['sessions'] += 1
+        else:
+            session.last_seen = max(session.last_seen, epoch)
+        self.users.move_to_end(usr)
+        self.evict()
+        if session.bot:
+            return
+        if title == EDIT_STR:
+            session.usertype = 'editor'
+            return
+        switches = session.add(proj, title, wd, ref_class(referer), self.wikidbs)
+        if switches is None:
+            return
+        if session.num_pvs > self.maxpvs:
+            # likely a bot: stop counting and drop the state
+            session.bot = True
+            session.seen = None
+            session.pending = None
+            self.stats['bots'] += 1
+            return
+        ut = session.usertype
+        if not self.counts.add(epoch, ('views', ut, proj)):
+            self.stats['late'] += 1
+            return
+        for _, src in switches:
+            self.counts.add(epoch, ('pairs', ut, '{0}-{1}'.format(src, proj)))
+
+    def evict(self):
+        """End sessions that have been idle too long or that exceed the user budget (least recently active first)."""
+        users = self.users
+        while users:
+            usr, session = next(iter(users.items()))
+            if len(users) > self.max_users:
+                self.stats['evicted_full'] += 1
+            elif session.last_seen < self.now - self.idle_seconds:
+                self.stats['evicted_idle'] += 1
+            else:
+                break
+            users.popitem(last=False)
+
+    def emit_window(self, start, end, counts):
+        by_kind = {'pairs': {}, 'views': {}}
+        for (kind, ut, key), n in counts.items():
+            by_kind[kind].setdefault(ut, {})[key] = n
+        window = {'start': epoch_to_dt(start), 'end': epoch_to_dt(end)}
+        for kind, by_ut in by_kind.items():
+            window['total_' + kind] = {ut: sum(c.values()) for ut, c in by_ut.items()}
+            window[kind] = {ut: top_k(c, self.k) for ut, c in by_ut.items()}
+        window['open_sessions'] = len(self.users)
+        window['latency'] = self.latency.summary()
+        window['stats'] = dict(self.stats)
+        self.latency = LatencyStats()
+        self.emit(json.dumps(window))
+
+    def close(self):
+        for start, end, counts in self.counts.flush():
+            self.emit_window(start, end, counts)
+
+
+def socket_lines(host, port):
+    """Lines from each connection to a local TCP port, one connection after the other."""
+    with socket.create_server((host, port)) as server:
+        logging.info("Listening on {0}:{1}".format(host, port))
+        while True:
+            conn, addr = server.accept()
+            logging.debug("Connection from {0}".format(addr))
+            with conn, conn.makefile('r', encoding='utf-8') as fin:
+                for line in fin:
+                    yield line
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int,
+                        help="Read page views from connections to this local port instead of stdin")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--output",
+                        help="Append one JSON line per window to this file (default: stdout)")
+    parser.add_argument("--window", type=int, default=3600,
+                        help="Window length in seconds")
+    parser.add_argument("--slide", type=int, default=300,
+                        help="Emit a window every n seconds (= --window for tumbling windows)")
+    parser.add_argument("--idle_seconds", type=int, default=1800,
+                        help="End a user's session after this many seconds without page views")
+    parser.add_argument("--max_users", type=int, default=1000000,
+                        help="Maximum number of open sessions (least recently active are ended first)")
+    parser.add_argument("--maxpvs", type=int, default=500,
+                        help="Max pageviews in a session to still be included in analysis.")
+    parser.add_argument("--langs", nargs="*",
+                        help="if included, specific languages to only track switching statistics for")
+    parser.add_argument("--top_k", type=int, default=20,
+                        help="Number of language pairs / projects per usertype in each window")
+    parser.add_argument("--debug", action="store_true",
+                        help="More verbose logging")
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    fout = open(args.output, 'a') if args.output else sys.stdout
+
+    def emit(line):
+        fout.write(line + '\n')
+        fout.flush()
+
+    stream = SwitchStream(window=args.window, slide=args.slide, idle_seconds=args.idle_seconds,
+                          max_users=args.max_users, maxpvs=args.maxpvs, langs=args.langs, k=args.top_k, emit=emit)
+    lines = socket_lines(args.host, args.port) if args.port else sys.stdin
+    try:
+        for line in lines:
+            stream.process_line(line)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
+        logging.info("{0} sessions; {1}".format(stream.stats['sessions'], dict(stream.stats)))
+        if fout is not sys.stdout:
+            fout.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,224 @@
+"""(usertype x country x source project x target project) counts of sessions with language switches and of projects
+viewed in the same session, saved as memory-mapped .npy arrays so that per-country breakdowns are reductions instead of
+new scans."""
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from session_utils import get_lang_switch
+from session_utils import SessionConsumer
+from session_utils import usertypes
+
+# kind -> axes of its cube
+KINDS = {'switches': ('usertype', 'country', 'src', 'dst'),
+         'cooccurrence': ('usertype', 'country', 'src', 'dst'),
+         'sessions': ('usertype', 'country', 'project')}
+
+class SwitchCubeBuilder(SessionConsumer):
+    """Accumulates (usertype, country, project(s)) session counts while scanning sessions.
+
+    Counts follow reader_language_overlap.py: sessions with at least one switch from src to dst, sessions in which both
+    projects were viewed (co-occurrence, with src < dst alphabetically) and sessions per project. Single-project
+    sessions are counted on the diagonal (src == dst) of both.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.countries = {}
+        self.projects = {}
+        # kind -> {(usertype, country, ...) ids: number of sessions}
+        self.counts = {kind: {} for kind in KINDS}
+
+    def consume(self, session):
+        pvs = session.pageviews
+        # filter out likely bots
+        if not pvs or len(pvs) > self.args.maxpvs:
+            return
+        ut = usertypes.index(session.usertype)
+        country = self.countries.setdefault(session.country, len(self.countries))
+        projects = self.projects
+        proj_ids = {proj: projects.setdefault(proj, len(projects)) for proj in set(pv.proj for pv in pvs)}
+
+        sessions = self.counts['sessions']
+        for p in proj_ids.values():
+            key = (ut, country, p)
+            sessions[key] = sessions.get(key, 0) + 1
+
+        switches = self.counts['switches']
+        cooccurrence = self.counts['cooccurrence']
+        if len(proj_ids) > 1:
+            for key in {(ut, country, proj_ids[pvs[i].proj], proj_ids[pvs[j].proj]) for i, j in get_lang_switch(pvs)}:
+                switches[key] = switches.get(key, 0) + 1
+            sorted_projs = sorted(proj_ids)
+            for i, src in enumerate(sorted_projs):
+                for dst in sorted_projs[i + 1:]:
+                    key = (ut, country, proj_ids[src], proj_ids[dst])
+                    cooccurrence[key] = cooccurrence.get(key, 0) + 1
+        else:
+            p = next(iter(proj_ids.values()))
+            key = (ut, country, p, p)
+            switches[key] = switches.get(key, 0) + 1
+            cooccurrence[key] = cooccurrence.get(key, 0) + 1
+
+    def report(self):
+        if self.args.cube_dir:
+            self.build().save(self.args.cube_dir)
+            logging.info("Switch cube saved to {0}".format(self.args.cube_dir))
+
+    def build(self):
+        countries = sorted(self.countries, key=self.countries.get)
+        projects = sorted(self.projects, key=self.projects.get)
+        labels = {'usertype': list(usertypes), 'country': countries, 'src': projects, 'dst': projects,
+                  'project': projects}
+        keys = {}
+        counts = {}
+        for kind, axes in KINDS.items():
+            shape = tuple(len(labels[axis]) for axis in axes)
+            cells = self.counts[kind]
+            coords = np.array(list(cells.keys()), dtype=np.int64).reshape(-1, len(axes))
+            kind_keys = np.ravel_multi_index(coords.T, shape).astype(np.int64) if len(coords) else np.zeros(0, np.int64)
+            order = np.argsort(kind_keys, kind='stable')
+            keys[kind] = kind_keys[order]
+            counts[kind] = np.fromiter(cells.values(), dtype=np.int64, count=len(cells))[order]
+        return SwitchCube(labels, keys, counts)
+
+
+class SwitchCube:
+    """Sparse count cubes: per kind, the sorted row-major indices of the non-zero cells and their counts.
+
+    Because the indices are sorted, fixing the leading axes (usertype, then country, ...) selects a contiguous range
+    found by binary search; other filters and reductions are vectorized over the selected cells. Filters are a label
+    or a list of labels per axis, e.g., cube.reduce('switches', ['country'], src='enwiki', dst='dewiki').
+    """
+
+    def __init__(self, labels, keys, counts):
+        # axis -> labels (e.g., 'country' -> ['Norway', 'Chile', ...]); an axis' ids are positions in its labels
+        self.labels = labels
+        self.index = {axis: {label: i for i, label in enumerate(axis_labels)} for axis, axis_labels in labels.items()}
+        self.keys = keys
+        self.counts = counts
+
+    def shape(self, kind):
+        return tuple(len(self.labels[axis]) for axis in KINDS[kind])
+
+    def save(self, cube_dir):
+        os.makedirs(cube_dir, exist_ok=True)
+        for kind in KINDS:
+            np.save(os.path.join(cube_dir, '{0}_keys.npy'.format(kind)), self.keys[kind])
+            np.save(os.path.join(cube_dir, '{0}_counts.npy'.format(kind)), self.counts[kind])
+        # written last: its presence marks a complete cube
+        with open(os.path.join(cube_dir, 'labels.json'), 'w') as fout:
+            json.dump(self.labels, fout)
+
+    @classmethod
+    def load(cls, cube_dir, mmap=True):
+        """Load a saved cube. With mmap, arrays are memory-mapped and only the selected ranges are read."""
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(cube_dir, 'labels.json'), 'r') as fin:
+            labels = json.load(fin)
+        keys = {}
+        counts = {}
+        for kind in KINDS:
+            keys[kind] = np.load(os.path.join(cube_dir, '{0}_keys.npy'.format(kind)), mmap_mode=mmap_mode)
+            counts[kind] = np.load(os.path.join(cube_dir, '{0}_counts.npy'.format(kind)), mmap_mode=mmap_mode)
+        return cls(labels, keys, counts)
+
+    def _ids(self, axis, value):
+        """Ids of a label or list of labels (unknown labels are left out)."""
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        return [self.index[axis][v] for v in values if v in self.index[axis]]
+
+    def select(self, kind, **filters):
+        """Coordinates (one id array per axis of kind) and counts of the non-zero cells matching the filters."""
+        axes = KINDS[kind]
+        unknown = set(filters) - set(axes)
+        if unknown:
+            raise ValueError("{0} has no axes {1} (axes: {2}).".format(kind, sorted(unknown), axes))
+        shape = self.shape(kind)
+        filter_ids = {axis: self._ids(axis, value) for axis, value in filters.items() if value is not None}
+        keys = self.keys[kind]
+        counts = self.counts[kind]
+        if any(not ids for ids in filter_ids.values()):
+            return tuple(np.zeros(0, np.int64) for _ in axes), np.zeros(0, np.int64)
+        # leading axes fixed to a single label: a contiguous range of the sorted keys
+        prefix = []
+        for axis in axes:
+            if len(filter_ids.get(axis, ())) != 1:
+                break
+            prefix.append(filter_ids[axis][0])
+        if prefix:
+            stride = int(np.prod(shape[len(prefix):], dtype=np.int64))
+            start = int(np.ravel_multi_index(prefix, shape[:len(prefix)])) * stride
+            lo, hi = np.searchsorted(keys, [start, start + stride])
+            keys = keys[lo:hi]
+            counts = counts[lo:hi]
+        coords = np.unravel_index(np.asarray(keys), shape)
+        mask = None
+        for a, axis in enumerate(axes[len(prefix):], start=len(prefix)):
+            if axis in filter_ids:
+                axis_mask = np.isin(coords[a], filter_ids[axis])
+                mask = axis_mask if mask is None else mask & axis_mask
+        if mask is not None:
+            coords = tuple(c[mask] for c in coords)
+            counts = counts[mask]
+        return coords, np.asarray(counts)
+
+    def reduce(self, kind, by=(), **filters):
+        """Dense array of the counts matching the filters summed over all axes but those in by (in that order)."""
+        axes = KINDS[kind]
+        if set(by) - set(axes):
+            raise ValueError("{0} has no axes {1} (axes: {2}).".format(kind, sorted(set(by) - set(axes)), axes))
+        coords, counts = self.select(kind, **filters)
+        shape = tuple(len(self.labels[axis]) for axis in by)
+        if not by:
+            return int(counts.sum())
+        flat = np.ravel_multi_index([coords[axes.index(axis)] for axis in by], shape)
+        size = int(np.prod(shape, dtype=np.int64))
+        return np.bincount(flat, weights=counts, minlength=size).astype(np.int64).reshape(shape)
+
+    def table(self, kind, by, k=None, **filters):
+        """Non-zero reduced counts as (labels..., count) tuples, largest first (top k if given)."""
+        reduced = self.reduce(kind, by, **filters)
+        nonzero = np.flatnonzero(reduced)
+        order = nonzero[np.argsort(-reduced.ravel()[nonzero], kind='stable')][:k]
+        cells = np.unravel_index(order, reduced.shape)
+        return [tuple(self.labels[axis][cells[a][i]] for a, axis in enumerate(by)) + (int(reduced.flat[order[i]]),)
+                for i in range(len(order))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cube_dir", required=True,
+                        help="Directory written by reader_language_overlap.py / desc_stats.py --cube_dir")
+    parser.add_argument("--kind", default="switches", choices=list(KINDS))
+    parser.add_argument("--by", nargs="+",
+                        help="Axes to break the counts down by (others are summed over): usertype, country, src, dst "
+                             "(project for --kind sessions). Default: src dst (project for --kind sessions)")
+    parser.add_argument("--usertype")
+    parser.add_argument("--country", nargs="*")
+    parser.add_argument("--src", nargs="*")
+    parser.add_argument("--dst", nargs="*")
+    parser.add_argument("--project", nargs="*")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    axes = KINDS[args.kind]
+    if args.by is None:
+        args.by = ['project'] if args.kind == 'sessions' else ['src', 'dst']
+    filters = {axis: getattr(args, axis) for axis in ('usertype', 'country', 'src', 'dst', 'project')
+               if getattr(args, axis)}
+    for axis in args.by + list(filters):
+        if axis not in axes:
+            parser.error("--kind {0} has no axis {1} (axes: {2})".format(args.kind, axis, ', '.join(axes)))
+
+    cube = SwitchCube.load(args.cube_dir)
+    for row in cube.table(args.kind, args.by, args.top, **filters):
+        print("\t".join(str(v) for v in row))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
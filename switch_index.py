@@ -0,0 +1,300 @@
+"""Sparse (QID x project) index of page views and switches out of / into each article, plus per-usertype language pair
+and project counts, saved as .npy arrays so that per-article questions are answered without a rescan."""
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+from scipy import sparse
+
+from session_utils import get_lang_switch
+from session_utils import qid_to_int
+from session_utils import SessionConsumer
+from session_utils import usertypes
+
+COUNTS = ('views', 'switch_out', 'switch_in')
+# project ids are packed into the low bits of a single int key per (QID, project)
+PROJ_BITS = 16
+
+class SwitchIndexBuilder(SessionConsumer):
+    """Accumulates (QID, project) counts while scanning sessions."""
+
+    def __init__(self, args):
+        self.args = args
+        self.projects = {}
+        self.counts = {c:{} for c in COUNTS}
+        # (usertype, project) -> page views (incl. pages without a QID) and (usertype, src, dst) -> switches
+        self.proj_views = {}
+        self.pairs = {}
+        # page views whose item id is not a QID (e.g., 'P31'): counted in proj_views / pairs but not indexed
+        self.invalid_qids = 0
+
+    def _proj_id(self, proj):
+        return self.projects.setdefault(proj, len(self.projects))
+
+    def _key(self, pv):
+        """Key of a page view's (QID, project) or None if its item id is not a QID."""
+        try:
+            return (qid_to_int(pv.wd) << PROJ_BITS) | self._proj_id(pv.proj)
+        except ValueError:
+            return None
+
+    def consume(self, session):
+        pvs = session.pageviews
+        # filter out likely bots
+        if not pvs or len(pvs) > self.args.maxpvs:
+            return
+        ut = usertypes.index(session.usertype)
+        views = self.counts['views']
+        # keys of the page views, reused for their switches
+        keys = []
+        for pv in pvs:
+            proj_key = (ut, self._proj_id(pv.proj))
+            self.proj_views[proj_key] = self.proj_views.get(proj_key, 0) + 1
+            key = None
+            if pv.wd:
+                key = self._key(pv)
+                if key is None:
+                    self.invalid_qids += 1
+                else:
+                    views[key] = views.get(key, 0) + 1
+            keys.append(key)
+        if len(pvs) > 1:
+            switch_out = self.counts['switch_out']
+            switch_in = self.counts['switch_in']
+            for i, j in get_lang_switch(pvs):
+                # both page views have the same item id, so both keys are None if it is not a QID
+                if keys[i] is not None:
+                    switch_out[keys[i]] = switch_out.get(keys[i], 0) + 1
+                    switch_in[keys[j]] = switch_in.get(keys[j], 0) + 1
+                pair = (ut, self.projects[pvs[i].proj], self.projects[pvs[j].proj])
+                self.pairs[pair] = self.pairs.get(pair, 0) + 1
+
+    def report(self):
+        if self.invalid_qids:
+            logging.info("{0} page views with item ids that are not QIDs left out of the index.".format(
+                self.invalid_qids))
+        if self.args.switch_index_dir:
+            self.build().save(self.args.switch_index_dir)
+            logging.info("Switch index saved to {0}".format(self.args.switch_index_dir))
+
+    def build(self):
+        """Convert the accumulated counts into a SwitchIndex of sparse matrices."""
+        keys = np.array(list(set().union(*[self.counts[c] for c in COUNTS])), dtype=np.int64)
+        qids = np.unique(keys >> PROJ_BITS)
+        projects = sorted(self.projects, key=self.projects.get)
+        shape = (len(qids), len(projects))
+        matrices = {}
+        for c in COUNTS:
+            count_keys = np.fromiter(self.counts[c].keys(), dtype=np.int64, count=len(self.counts[c]))
+            values = np.fromiter(self.counts[c].values(), dtype=np.int64, count=len(self.counts[c]))
+            rows = np.searchsorted(qids, count_keys >> PROJ_BITS)
+            cols = count_keys & ((1 << PROJ_BITS) - 1)
+            matrices[c] = sparse.coo_matrix((values, (rows, cols)), shape=shape)
+        pairs = np.zeros((len(usertypes), len(projects), len(projects)), dtype=np.int64)
+        for (ut, src, dst), count in self.pairs.items():
+            pairs[ut, src, dst] = count
+        proj_views = np.zeros((len(usertypes), len(projects)), dtype=np.int64)
+        for (ut, proj), count in self.proj_views.items():
+            proj_views[ut, proj] = count
+        return SwitchIndex(qids, projects, matrices, pairs, proj_views)
+
+
+class SwitchIndex:
+    """Per-article view / switch counts: one sparse matrix per count with a row per QID and a column per project.
+
+    Each matrix is kept both row-major (CSR; per-article queries) and column-major (CSC; per-wiki queries)
+    so both kinds of queries are slices of the underlying arrays. Language pairs are few enough to keep dense:
+    pairs[usertype, src, dst] switches and proj_views[usertype, project] page views, with usertypes in
+    session_utils.usertypes order.
+    """
+
+    def __init__(self, qids, projects, matrices, pairs, proj_views):
+        # sorted int QIDs (row labels) and project names (column labels)
+        self.qids = qids
+        self.projects = projects
+        self.proj_idx = {p:i for i, p in enumerate(projects)}
+        self.csr = {c: m.tocsr() for c, m in matrices.items()}
+        self.csc = {c: m.tocsc() for c, m in matrices.items()}
+        self.pairs = pairs
+        self.proj_views = proj_views
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, 'qids.npy'), self.qids)
+        np.save(os.path.join(index_dir, 'pairs.npy'), self.pairs)
+        np.save(os.path.join(index_dir, 'proj_views.npy'), self.proj_views)
+        with open(os.path.join(index_dir, 'projects.json'), 'w') as fout:
+            json.dump(self.projects, fout)
+        for fmt, matrices in (('csr', self.csr), ('csc', self.csc)):
+            for c, m in matrices.items():
+                m.sort_indices()
+                for part in ('data', 'indices', 'indptr'):
+                    np.save(os.path.join(index_dir, '{0}_{1}_{2}.npy'.format(c, fmt, part)), getattr(m, part))
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """Load a saved index. With mmap, arrays are memory-mapped so loading is near-instant regardless of size."""
+        mmap_mode = 'r' if mmap else None
+        qids = np.load(os.path.join(index_dir, 'qids.npy'), mmap_mode=mmap_mode)
+        with open(os.path.join(index_dir, 'projects.json'), 'r') as fin:
+            projects = json.load(fin)
+        index = cls.__new__(cls)
+        index.qids = qids
+        index.projects = projects
+        index.pairs = np.load(os.path.join(index_dir, 'pairs.npy'), mmap_mode=mmap_mode)
+        index.proj_views = np.load(os.path.join(index_dir, 'proj_views.npy'), mmap_mode=mmap_mode)
+        index.proj_idx = {p:i for i, p in enumerate(projects)}
+        index.csr = {}
+        index.csc = {}
+        shape = (len(qids), len(projects))
+        for fmt, matrix_type, matrices in (('csr', sparse.csr_matrix, index.csr),
+                                           ('csc', sparse.csc_matrix, index.csc)):
+            for c in COUNTS:
+                data, indices, indptr = [
+                    np.load(os.path.join(index_dir, '{0}_{1}_{2}.npy'.format(c, fmt, part)), mmap_mode=mmap_mode)
+                    for part in ('data', 'indices', 'indptr')]
+                matrices[c] = matrix_type((data, indices, indptr), shape=shape, copy=False)
+        return index
+
+    def row(self, qid):
+        """Row of a QID (e.g., 'Q42' or 42) or None if it was never seen."""
+        if isinstance(qid, str):
+            qid = qid_to_int(qid)
+        idx = np.searchsorted(self.qids, qid)
+        if idx < len(self.qids) and self.qids[idx] == qid:
+            return idx
+        return None
+
+    @staticmethod
+    def _slice(m, i):
+        """Indices and counts of the non-zero entries in row (CSR) or column (CSC) i."""
+        start, end = m.indptr[i], m.indptr[i + 1]
+        return m.indices[start:end], m.data[start:end]
+
+    def qid_stats(self, qid):
+        """Views / switches out / switches in per project for an article, plus its switch-out rate from any wiki."""
+        idx = self.row(qid)
+        stats = {'qid': qid, 'projects': {}, 'views': 0, 'switch_out': 0, 'switch_in': 0, 'switch_rate': 0.0}
+        if idx is None:
+            return stats
+        for c in COUNTS:
+            cols, counts = self._slice(self.csr[c], idx)
+            for col, count in zip(cols, counts):
+                proj_stats = stats['projects'].setdefault(self.projects[col], {k: 0 for k in COUNTS})
+                proj_stats[c] = int(count)
+                stats[c] += int(count)
+        for proj_stats in stats['projects'].values():
+            proj_stats['switch_rate'] = proj_stats['switch_out'] / proj_stats['views'] if proj_stats['views'] else 0.0
+        if stats['views']:
+            stats['switch_rate'] = stats['switch_out'] / stats['views']
+        return stats
+
+    def _by_usertype(self, counts, usertype=None):
+        """Counts for one usertype, or summed over all usertypes if None."""
+        if usertype is None:
+            return counts.sum(axis=0)
+        return counts[usertypes.index(usertype)]
+
+    def pair_count(self, src, dst, usertype=None):
+        """Number of switches from project src to project dst."""
+        if src not in self.proj_idx or dst not in self.proj_idx:
+            return 0
+        return int(self._by_usertype(self.pairs, usertype)[self.proj_idx[src], self.proj_idx[dst]])
+
+    def pair_counts(self, src=None, dst=None, usertype=None):
+        """Non-zero switch counts from src (to any project) or to dst (from any project), largest first."""
+        counts = self._by_usertype(self.pairs, usertype)
+        if src is not None:
+            if src not in self.proj_idx:
+                return []
+            counts = counts[self.proj_idx[src], :]
+        else:
+            if dst not in self.proj_idx:
+                return []
+            counts = counts[:, self.proj_idx[dst]]
+        order = np.argsort(-counts, kind='stable')
+        return [(src or self.projects[i], dst or self.projects[i], int(counts[i])) for i in order if counts[i]]
+
+    def project_views(self, proj, usertype=None):
+        if proj not in self.proj_idx:
+            return 0
+        return int(self._by_usertype(self.proj_views, usertype)[self.proj_idx[proj]])
+
+    def top_pairs(self, k=30, usertype=None, weighted=False, minpv_threshold=500, langs=None):
+        """Top-k language pairs by number of switches or, if weighted, by switches per page view of the source project.
+
+        Weighting follows reporting.weight_by_proj: pairs whose source project has no more than minpv_threshold
+        page views get a weight of 0. With langs, only pairs involving at least one of langs are considered.
+        Returns a list of (src, dst, value, switches) tuples.
+        """
+        counts = self._by_usertype(self.pairs, usertype)
+        values = counts.astype(np.float64)
+        if weighted:
+            norm = self._by_usertype(self.proj_views, usertype)[:, np.newaxis]
+            values = np.divide(values, norm, out=np.zeros_like(values), where=norm > minpv_threshold)
+        if langs:
+            keep = np.isin(self.projects, langs)
+            values[~(keep[:, np.newaxis] | keep[np.newaxis, :])] = 0
+        values = values.ravel()
+        k = min(k, np.count_nonzero(values))
+        if k < 1:
+            return []
+        top = np.argpartition(-values, k - 1)[:k]
+        top = top[np.argsort(-values[top], kind='stable')]
+        num_projects = len(self.projects)
+        return [(self.projects[i // num_projects], self.projects[i % num_projects], float(values[i]),
+                 int(counts.flat[i])) for i in top]
+
+    def top_switched(self, wiki, k=10, count='switch_out', min_views=0, rate=False):
+        """Top-k articles on a wiki by number (or, with rate, share of views) of switches out (or in).
+
+        Returns a list of (QID, value, views) tuples.
+        """
+        if wiki not in self.proj_idx:
+            return []
+        j = self.proj_idx[wiki]
+        rows, values = self._slice(self.csc[count], j)
+        view_rows, view_counts = self._slice(self.csc['views'], j)
+        # views for the rows with switches (both index arrays are sorted)
+        pos = np.minimum(np.searchsorted(view_rows, rows), max(len(view_rows) - 1, 0))
+        views = np.where(view_rows[pos] == rows, view_counts[pos], 0) if len(view_rows) else np.zeros(len(rows))
+        values = values.astype(np.float64)
+        if rate:
+            values = np.divide(values, views, out=np.zeros_like(values), where=views > 0)
+        values[views < min_views] = 0
+        k = min(k, len(values))
+        if k < 1:
+            return []
+        top = np.argpartition(-values, k - 1)[:k]
+        top = top[np.argsort(-values[top], kind='stable')]
+        return [('Q{0}'.format(self.qids[rows[i]]), float(values[i]), int(views[i])) for i in top if values[i] > 0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", required=True,
+                        help="Directory written by desc_stats.py --switch_index_dir")
+    parser.add_argument("--qids", nargs="*", default=[],
+                        help="Print per-project statistics for these Wikidata IDs")
+    parser.add_argument("--wiki",
+                        help="Print most-switched articles on this wiki")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--count", default="switch_out", choices=['switch_out', 'switch_in'])
+    parser.add_argument("--min_views", type=int, default=0)
+    parser.add_argument("--rate", action="store_true",
+                        help="Rank by switches per view instead of number of switches")
+    args = parser.parse_args()
+
+    index = SwitchIndex.load(args.index_dir)
+    for qid in args.qids:
+        print(json.dumps(index.qid_stats(qid), indent=2))
+    if args.wiki:
+        for qid, value, views in index.top_switched(args.wiki, args.top, args.count, args.min_views, args.rate):
+            print("{0}\t{1}\t({2} views)".format(qid, value, views))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
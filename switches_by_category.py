@@ -1,10 +1,15 @@
 import argparse
+import csv
 import json
+import logging
+import multiprocessing
+import os
 
-import numpy as np
-import pandas as pd
+from dataset_io import is_parquet, parquet_metadata
+from dataset_io import NON_SWITCH_VALUES
+from dataset_io import read_dataset
 
-NON_SWITCHES = ('N\A', 'N/A')
+NON_SWITCHES = NON_SWITCH_VALUES
 
 def get_pred_topic_naive(input_json):
     try:
@@ -14,6 +19,8 @@ def get_pred_topic_naive(input_json):
     return topic
 
 def get_pred_topic_rand(input_json):
+    import numpy as np
+
     try:
         topic = np.random.choice(input_json['score']['drafttopic']['score']['prediction'])
     except (KeyError, ValueError) as error:
@@ -35,64 +42,188 @@ def get_pred_topic_best(input_json):
         best = None
     return best
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--ores_output")
-    parser.add_argument("--switches_tsv")
-    parser.add_argument("--approach", default='best', help="How to count topics: one of naive, rand, all, best.")
-    args = parser.parse_args()
+APPROACHES = {'naive': get_pred_topic_naive,
+              'rand': get_pred_topic_rand,
+              'all': get_pred_topic_all,
+              'best': get_pred_topic_best}
 
-    approaches = {'naive': get_pred_topic_naive,
-                  'rand': get_pred_topic_rand,
-                  'all': get_pred_topic_all,
-                  'best': get_pred_topic_best}
-    get_pred_topic = approaches[args.approach]
+# long-format output of the batch mode: one row per dataset and topic (level: 'topic' or its top-level 'toptopic')
+LONG_HEADER = ['lang', 'direction', 'level', 'topic', 'switch_count', 'nonswitch_count', 'switch_proportion',
+               'nonswitch_proportion']
 
-    print("==== {0} ====".format(args.approach))
+def read_qid_topics(ores_output, approach):
+    """Get {qid: topic} (a tuple of topics for the 'all' approach) from ORES output.
+
+    Equal topics (and topic tuples) share one object, which keeps the map small when it is copied to workers."""
+    get_pred_topic = APPROACHES[approach]
+    shared = {}
     qid_to_topic = {}
-    with open(args.ores_output, 'r') as fin:
+    with open(ores_output, 'r') as fin:
         for line in fin:
             record = json.loads(line)
-            qid = record['qid']
             topic = get_pred_topic(record)
-            qid_to_topic[qid] = topic
+            if approach == 'all':
+                topic = tuple(topic)
+            qid_to_topic[record['qid']] = shared.setdefault(topic, topic)
+    return qid_to_topic
+
+def load_qid_topics(ores_output, approach, topic_cache=None):
+    """Get the QID -> topic map for an approach, from topic_cache if it was built from the same (unchanged) ORES
+    output, otherwise by parsing the ORES output (and saving it to topic_cache). For the 'rand' approach, the cache
+    keeps the topics that were drawn when it was built."""
+    if topic_cache and os.path.exists(topic_cache) and os.path.getmtime(topic_cache) >= os.path.getmtime(ores_output):
+        with open(topic_cache, 'r') as fin:
+            cached = json.load(fin)
+        if cached['ores_output'] == os.path.abspath(ores_output) and cached['approach'] == approach:
+            logging.info("Loaded {0} QID topics from {1}".format(len(cached['topics']), topic_cache))
+            if approach == 'all':
+                shared = {}
+                return {qid: shared.setdefault(tuple(t), tuple(t)) for qid, t in cached['topics'].items()}
+            return cached['topics']
+    qid_to_topic = read_qid_topics(ores_output, approach)
+    if topic_cache:
+        tmp_fn = topic_cache + '.tmp'
+        with open(tmp_fn, 'w') as fout:
+            json.dump({'ores_output': os.path.abspath(ores_output), 'approach': approach, 'topics': qid_to_topic}, fout)
+        os.replace(tmp_fn, topic_cache)
+        logging.info("Saved {0} QID topics to {1}".format(len(qid_to_topic), topic_cache))
+    return qid_to_topic
+
+def count_topics(switches_fn, qid_to_topic, approach):
+    """Count the topics of switches and non-switches in a dataset.
 
+    Returns:
+        switch_topics, noswitch_topics: {topic: count}
+        s_no_topic, n_no_topic: number of switches / non-switches whose QID has no topic
+    """
     s_no_topic = 0
     n_no_topic = 0
     switch_topics = {}
     noswitch_topics = {}
-    with open(args.switches_tsv, 'r') as fin:
-        header = ['switch', 'country', 'qid', 'title', 'datetime', 'usertype']
-        switch_idx = header.index('switch')
-        qid_idx = header.index('qid')
-        for line in fin:
-            line = line.strip().split('\t')
-            qid = line[qid_idx]
-            try:
-                topic = qid_to_topic[qid]
-            except KeyError:
-                if line[switch_idx] in NON_SWITCHES:
-                    n_no_topic += 1
-                else:
-                    s_no_topic += 1
-                continue
-            if args.approach == 'all':
-                for t in topic:
-                    if line[switch_idx] in NON_SWITCHES:
-                        noswitch_topics[t] = noswitch_topics.get(t, 0) + 1
-                    else:
-                        switch_topics[t] = switch_topics.get(t, 0) + 1
+    for switch, qid in read_dataset(switches_fn, columns=['switch', 'qid']):
+        try:
+            topic = qid_to_topic[qid]
+        except KeyError:
+            if switch in NON_SWITCHES:
+                n_no_topic += 1
             else:
-                if line[switch_idx] in NON_SWITCHES:
-                    noswitch_topics[topic] = noswitch_topics.get(topic, 0) + 1
-                else:
-                    switch_topics[topic] = switch_topics.get(topic, 0) + 1
-    total_switches = sum(switch_topics.values())
-    total_nonswitches = sum(noswitch_topics.values())
+                s_no_topic += 1
+            continue
+        counts = noswitch_topics if switch in NON_SWITCHES else switch_topics
+        if approach == 'all':
+            for t in topic:
+                counts[t] = counts.get(t, 0) + 1
+        else:
+            counts[topic] = counts.get(topic, 0) + 1
+    return switch_topics, noswitch_topics, s_no_topic, n_no_topic
+
+def top_level(topic_counts):
+    """Aggregate topic counts to top-level topics (e.g., 'Culture' for 'Culture.Biography.Biography*')."""
+    toptopics = {}
+    for t, count in topic_counts.items():
+        toptopic = t.split('.')[0] if t else 'None'
+        toptopics[toptopic] = toptopics.get(toptopic, 0) + count
+    return toptopics
+
+def print_totals(switch_topics, noswitch_topics, s_no_topic, n_no_topic):
     print("    Switches:\t{0} different topics;\t{1} w/ topics;\t{2} w/o topics.".format(
-        len(switch_topics), total_switches, s_no_topic))
+        len(switch_topics), sum(switch_topics.values()), s_no_topic))
     print("Non-switches:\t{0} different topics;\t{1} w/ topics;\t{2} w/o topics.".format(
-        len(noswitch_topics), total_nonswitches, n_no_topic))
+        len(noswitch_topics), sum(noswitch_topics.values()), n_no_topic))
+
+# QID -> topic map and approach of a batch worker process (set once per worker by init_worker)
+_QID_TO_TOPIC = None
+_APPROACH = None
+
+def init_worker(qid_to_topic, approach):
+    global _QID_TO_TOPIC, _APPROACH
+    _QID_TO_TOPIC = qid_to_topic
+    _APPROACH = approach
+
+def dataset_topics(dataset):
+    """Batch worker: topic counts of one (lang, direction, path) dataset."""
+    lang, direction, switches_fn = dataset
+    return (lang, direction) + count_topics(switches_fn, _QID_TO_TOPIC, _APPROACH)
+
+def parse_dataset(spec):
+    """'eswiki:from:eswiki_from_switches.tsv' -> ('eswiki', 'from', path); Parquet datasets can be given as just
+    the path (language and direction are stored in the file)."""
+    parts = spec.split(':', 2)
+    if len(parts) == 3 and parts[1] in ('to', 'from'):
+        return tuple(parts)
+    if is_parquet(spec):
+        metadata = parquet_metadata(spec)
+        return (metadata['lang'], metadata['direction'], spec)
+    raise ValueError("Dataset {0} should be given as <wiki_db>:<to|from>:<path> (or be a .parquet file).".format(spec))
+
+def long_rows(lang, direction, switch_topics, noswitch_topics):
+    """LONG_HEADER rows for a dataset's topic and top-level topic counts."""
+    total_switches = sum(switch_topics.values())
+    total_nonswitches = sum(noswitch_topics.values())
+    rows = []
+    for level, s_counts, n_counts in [('topic', switch_topics, noswitch_topics),
+                                      ('toptopic', top_level(switch_topics), top_level(noswitch_topics))]:
+        for topic in sorted(set(s_counts) | set(n_counts), key=lambda t: (-s_counts.get(t, 0), str(t))):
+            s_count = s_counts.get(topic, 0)
+            n_count = n_counts.get(topic, 0)
+            rows.append([lang, direction, level, topic if topic else 'None', s_count, n_count,
+                         s_count / total_switches if total_switches else 0,
+                         n_count / total_nonswitches if total_nonswitches else 0])
+    return rows
+
+def run_batch(datasets, qid_to_topic, approach, output_tsv, workers=4):
+    """Count topics of many switch datasets in parallel and write them to one long-format TSV (LONG_HEADER)."""
+    datasets = [parse_dataset(spec) for spec in datasets]
+    workers = max(1, min(workers, len(datasets)))
+    if workers == 1:
+        init_worker(qid_to_topic, approach)
+        results = [dataset_topics(dataset) for dataset in datasets]
+    else:
+        # the map is copied to each worker once (shared copy-on-write where processes are forked), not per dataset
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(qid_to_topic, approach)) as pool:
+            results = pool.map(dataset_topics, datasets)
+    with open(output_tsv, 'w') as fout:
+        csvwriter = csv.writer(fout, delimiter="\t")
+        csvwriter.writerow(LONG_HEADER)
+        for lang, direction, switch_topics, noswitch_topics, s_no_topic, n_no_topic in results:
+            print("==== {0} ({1}) ====".format(lang, direction))
+            print_totals(switch_topics, noswitch_topics, s_no_topic, n_no_topic)
+            csvwriter.writerows(long_rows(lang, direction, switch_topics, noswitch_topics))
+    logging.info("Topics of {0} datasets written to {1}".format(len(results), output_tsv))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ores_output")
+    parser.add_argument("--switches_tsv",
+                        help="Switch dataset built by lda_predictive_model.py (.tsv or .parquet)")
+    parser.add_argument("--approach", default='best', help="How to count topics: one of naive, rand, all, best.")
+    parser.add_argument("--datasets", nargs="+",
+                        help="Batch mode: switch datasets as <wiki_db>:<to|from>:<path> (or a .parquet path), "
+                             "processed in parallel with one QID -> topic map (instead of --switches_tsv)")
+    parser.add_argument("--output_tsv",
+                        help="Batch mode: long-format TSV of topic x language x direction counts and proportions")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Batch mode: number of worker processes")
+    parser.add_argument("--topic_cache",
+                        help="JSON file with the QID -> topic map (built from --ores_output if missing or outdated)")
+    args = parser.parse_args()
+
+    print("==== {0} ====".format(args.approach))
+    qid_to_topic = load_qid_topics(args.ores_output, args.approach, args.topic_cache)
+
+    if args.datasets:
+        if not args.output_tsv:
+            raise Exception("Batch mode (--datasets) needs --output_tsv to write the combined table to.")
+        run_batch(args.datasets, qid_to_topic, args.approach, args.output_tsv, args.workers)
+        return
+
+    import pandas as pd
+
+    switch_topics, noswitch_topics, s_no_topic, n_no_topic = count_topics(args.switches_tsv, qid_to_topic,
+                                                                          args.approach)
+    total_switches = sum(switch_topics.values())
+    total_nonswitches = sum(noswitch_topics.values())
+    print_totals(switch_topics, noswitch_topics, s_no_topic, n_no_topic)
 
     all_topics = set(switch_topics.keys())
     all_topics.update(noswitch_topics.keys())
@@ -105,17 +236,10 @@ def main():
     topicdf.sort_values(by='switch_proportion', ascending=False, inplace=True)
     print(topicdf)
 
-    s_toptopics = {}
-    n_toptopics = {}
-    for t in all_topics:
-        if t:
-            toptopic = t.split('.')[0]
-        else:
-            toptopic = 'None'
-        s_toptopics[toptopic] = s_toptopics.get(toptopic, 0) + switch_topics.get(t, 0)
-        n_toptopics[toptopic] = n_toptopics.get(toptopic, 0) + noswitch_topics.get(t, 0)
+    s_toptopics = top_level(switch_topics)
+    n_toptopics = top_level(noswitch_topics)
     toptopicdf = pd.DataFrame([
-        (topic, s_toptopics[topic], n_toptopics[topic]) for topic in s_toptopics],
+        (topic, s_toptopics.get(topic, 0), n_toptopics.get(topic, 0)) for topic in set(s_toptopics) | set(n_toptopics)],
         columns=['topic', 'switch_count', 'nonswitch_count'])
     toptopicdf['switch_proportion'] = toptopicdf['switch_count'].apply(lambda x: x / total_switches)
     toptopicdf['nonswitch_proportion'] = toptopicdf['nonswitch_count'].apply(lambda x: x / total_nonswitches)
@@ -124,4 +248,5 @@ def main():
     print(toptopicdf)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,31 @@
+import os
+import tempfile
+
+from differential import compare
+from differential import session_cases, switch_cases, tsv_cases
+from differential import write_random_tsv
+
+def check(function, cases):
+    mismatches = compare(function, cases)
+    assert not mismatches, "{0}: {1} mismatches, e.g. {2}".format(function, len(mismatches), mismatches[0])
+
+def test_session_functions():
+    pvs_cases = session_cases(seed=0)
+    lang, nonlang = switch_cases(pvs_cases)
+    check('trim_session', [(pvs,) for pvs in pvs_cases])
+    check('get_lang_switch', lang)
+    check('get_nonlang_switch', nonlang)
+
+def test_tsv_to_sessions():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for seed in range(3):
+            tsv = os.path.join(tmpdir, 'pvs_{0}.tsv.gz'.format(seed))
+            write_random_tsv(tsv, num_users=200, seed=seed, malformed=0.1)
+            check('tsv_to_sessions', tsv_cases(tsv))
+
+def main():
+    test_session_functions()
+    test_tsv_to_sessions()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import random
+
+from histogram import LogHistogram
+from histogram import merge_histograms
+
+def test_quantiles():
+    rand = random.Random(0)
+    values = sorted(int(rand.expovariate(1 / 60)) for _ in range(20000))
+    hist = LogHistogram(resolution=8)
+    for v in values:
+        hist.add(v)
+    assert hist.count == len(values) and hist.max == values[-1]
+    for q in (0.25, 0.5, 0.9, 0.99):
+        exact = values[int(q * len(values))]
+        # within one bin (~9% at resolution 8)
+        assert abs(hist.quantile(q) - exact) <= 0.1 * exact + 1, (q, hist.quantile(q), exact)
+    assert LogHistogram().quantile(0.5) is None
+
+def test_merge_and_serialize():
+    a = LogHistogram()
+    b = LogHistogram()
+    whole = LogHistogram()
+    for v in range(-2, 5000, 3):
+        (a if v % 2 else b).add(v)
+        whole.add(v)
+    assert a.merge(b).counts == whole.counts and a.total == whole.total and a.max == whole.max
+    assert LogHistogram.from_dict(whole.to_dict()).counts == whole.counts
+    try:
+        a.merge(LogHistogram(4))
+        assert False, "resolutions must match"
+    except ValueError:
+        pass
+
+    shard1 = {'reader': {'latency': {'enwiki-dewiki': LogHistogram()}}}
+    shard2 = {'reader': {'latency': {'enwiki-dewiki': LogHistogram(), 'dewiki-enwiki': LogHistogram()}}}
+    shard1['reader']['latency']['enwiki-dewiki'].add(10)
+    shard2['reader']['latency']['enwiki-dewiki'].add(20)
+    merged = merge_histograms(shard1, shard2)
+    assert set(merged['reader']['latency']) == {'enwiki-dewiki', 'dewiki-enwiki'}
+    assert merged['reader']['latency']['enwiki-dewiki'].count == 2
+
+def main():
+    test_quantiles()
+    test_merge_and_serialize()
+
+if __name__ == "__main__":
+    main()
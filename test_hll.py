@@ -0,0 +1,48 @@
+from hll import HyperLogLog
+from hll import merge_sketches
+
+def test_estimates():
+    for precision in (10, 12):
+        error = 1.04 / (1 << precision) ** 0.5
+        for n in (10, 1000, 50000):
+            sketch = HyperLogLog(precision)
+            # repeated values must not change the estimate
+            for _ in range(2):
+                sketch.update('Q{0}'.format(i) for i in range(n))
+            assert abs(sketch.count() - n) <= max(4 * error * n, 1), (precision, n, sketch.count())
+    assert len(HyperLogLog()) == 0
+
+def test_merge_and_serialize():
+    a = HyperLogLog(10)
+    b = HyperLogLog(10)
+    whole = HyperLogLog(10)
+    for i in range(20000):
+        (a if i % 3 else b).add(i)
+        whole.add(i)
+    # ints and their string forms hash the same
+    b.add('7')
+    assert a.merge(b).registers == whole.registers
+    assert HyperLogLog.from_str(whole.to_str()).registers == whole.registers
+
+    try:
+        a.merge(HyperLogLog(12))
+        assert False, "precisions must match"
+    except ValueError:
+        pass
+
+    # nested sketches (as written by reader_language_overlap.py --hll) from two shards
+    shard1 = {'reader': {'pair': {'enwiki-dewiki': {'users': HyperLogLog(10)}}}}
+    shard2 = {'reader': {'pair': {'enwiki-dewiki': {'users': HyperLogLog(10)},
+                                  'dewiki-enwiki': {'users': HyperLogLog(10)}}}}
+    shard1['reader']['pair']['enwiki-dewiki']['users'].update(range(100))
+    shard2['reader']['pair']['enwiki-dewiki']['users'].update(range(50, 150))
+    merged = merge_sketches(shard1, shard2)
+    assert set(merged['reader']['pair']) == {'enwiki-dewiki', 'dewiki-enwiki'}
+    assert abs(merged['reader']['pair']['enwiki-dewiki']['users'].count() - 150) < 10
+
+def main():
+    test_estimates()
+    test_merge_and_serialize()
+
+if __name__ == "__main__":
+    main()
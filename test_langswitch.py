@@ -0,0 +1,24 @@
+from benchmarks import cold_start
+from benchmarks import heavy_imports
+from benchmarks import STARTUP_COMMANDS
+
+# extra seconds over a bare interpreter allowed for starting a command (importing scikit-learn alone takes ~1s)
+STARTUP_BUDGET = 0.5
+# heavy dependencies a command may import before doing any work
+ALLOWED = {'dataset': {'numpy'}, 'cube': {'numpy'}}
+
+def test_lazy_imports():
+    for argv in STARTUP_COMMANDS:
+        assert heavy_imports(argv) <= ALLOWED.get(argv[0], set()), argv
+
+def test_cold_start():
+    baseline = cold_start(['--help'])
+    for argv in [['stats', '--help'], ['overlap', '--help'], ['dataset', '--help'], ['multi', '--help']]:
+        assert cold_start(argv) - baseline < STARTUP_BUDGET, argv
+
+def main():
+    test_lazy_imports()
+    test_cold_start()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import tempfile
+import threading
+import urllib.parse
+
+from ores_scoring import score_revids
+from switches_by_category import get_pred_topic_best
+
+class StubORES(BaseHTTPRequestHandler):
+    """Stand-in for the ORES scores endpoint: every revision is STEM, except odd ones which are Culture.
+
+    Revision 13 has no score (as for deleted revisions) and requests are refused once `fail_after` is reached.
+    """
+    requests = []
+    fail_after = None
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        revids = urllib.parse.parse_qs(url.query)['revids'][0].split('|')
+        StubORES.requests.append(revids)
+        if StubORES.fail_after is not None and len(StubORES.requests) > StubORES.fail_after:
+            self.send_response(503)
+            self.end_headers()
+            return
+        scores = {}
+        for r in revids:
+            if r == '13':
+                scores[r] = {'drafttopic': {'error': {'type': 'RevisionNotFound'}}}
+            else:
+                topic = 'Culture.Media' if int(r) % 2 else 'STEM.Physics'
+                scores[r] = {'drafttopic': {'score': {'prediction': [topic], 'probability': {topic: 0.9, 'Other': 0.1}}}}
+        body = json.dumps({'enwiki': {'models': {'drafttopic': {'version': 'stub'}}, 'scores': scores}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_score_revids_end_to_end():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubORES)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    tmpdir = tempfile.mkdtemp()
+    revids_fn = os.path.join(tmpdir, 'qid_revids.json')
+    output_fn = os.path.join(tmpdir, 'ores_drafttopic.json')
+    with open(revids_fn, 'w') as fout:
+        for i in range(1, 24):
+            # rev_id 0 means no revision was found and is skipped
+            fout.write(json.dumps({'qid': 'Q{0}'.format(i), 'rev_id': i if i != 5 else 0}) + '\n')
+    try:
+        # first run dies after two batches; the written batches are kept
+        StubORES.fail_after = 2
+        try:
+            score_revids(revids_fn, output_fn, host=host, batch_size=4, workers=1, requests_per_second=0,
+                         retry_wait=0)
+            assert False, "stub server should have failed the run"
+        except OSError:
+            pass
+        with open(output_fn, 'a') as fout:
+            # simulate a record cut off mid-write
+            fout.write('{"qid": "Q')
+        StubORES.fail_after = None
+        StubORES.requests = []
+        score_revids(revids_fn, output_fn, host=host, batch_size=4, workers=3, requests_per_second=100)
+        assert all(len(r) <= 4 for r in StubORES.requests)
+
+        with open(output_fn, 'r') as fin:
+            records = [json.loads(line) for line in fin]
+        assert sorted(r['qid'] for r in records) == sorted('Q{0}'.format(i) for i in range(1, 24) if i != 5)
+        topics = {r['qid']: get_pred_topic_best(r) for r in records}
+        assert topics['Q2'] == 'STEM.Physics'
+        assert topics['Q3'] == 'Culture.Media'
+        assert topics['Q13'] is None
+    finally:
+        server.shutdown()
+        server.server_close()
+        for fn in (revids_fn, output_fn):
+            if os.path.exists(fn):
+                os.remove(fn)
+        os.rmdir(tmpdir)
+
+def main():
+    test_score_revids_end_to_end()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import numpy as np
+
+from lda_predictive_model import QidFeatures
+from topic_store import QidEmbeddings
+from topic_store import TopicStore
+
+def test_qid_features():
+    topic_model = np.array([[0.1, 0.9], [0.7, 0.3]], dtype=np.float32)
+    qids = np.array([7, 42], dtype=np.int64)
+    qid_rows = np.array([1, 0], dtype=np.int32)
+    store = TopicStore(topic_model, None, ['a', 'b'], qids, qid_rows)
+    featurizer = QidFeatures(QidEmbeddings(['en'], [store]))
+    # dataset rows: (..., item id, title, ...); a property id and a malformed id are treated as missing
+    rows = [('u1', 'enwiki', 'Q42', 'A'), ('u2', 'enwiki', 'P31', 'B'), ('u3', 'enwiki', 'Q7', 'C'),
+            ('u4', 'enwiki', 'foo', 'D'), ('u5', 'enwiki', 'Q1', 'E')]
+    assert list(featurizer.qids(rows)) == [42, 0, 7, 0, 1]
+    assert list(featurizer.found(rows)) == [True, False, True, False, False]
+    features = featurizer.features(rows)
+    assert np.allclose(features, [[0.1, 0.9], [0, 0], [0.7, 0.3], [0, 0], [0, 0]])
+
+def main():
+    test_qid_features()
+
+if __name__ == "__main__":
+    main()
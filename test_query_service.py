@@ -0,0 +1,101 @@
+import argparse
+import json
+import shutil
+import tempfile
+import threading
+import urllib.request
+
+from query_service import make_server, QueryService
+from session_utils import Pageview, Session
+from switch_index import SwitchIndex, SwitchIndexBuilder
+
+def build_index(index_dir):
+    builder = SwitchIndexBuilder(argparse.Namespace(maxpvs=500, switch_index_dir=index_dir))
+    sessions = [
+        # enwiki -> dewiki switch on Q1
+        Session('u1', 'US', [Pageview('2019-02-16T01:00:00', 'enwiki', 'A', 'Q1', 'google'),
+                             Pageview('2019-02-16T01:00:10', 'dewiki', 'A_de', 'Q1', 'enwiki')], 'reader'),
+        # enwiki -> dewiki switch on Q1 and an enwiki page without a switch
+        Session('u2', 'DE', [Pageview('2019-02-16T01:00:00', 'enwiki', 'B', 'Q2', 'google'),
+                             Pageview('2019-02-16T01:00:05', 'enwiki', 'A', 'Q1', 'enwiki'),
+                             Pageview('2019-02-16T01:00:10', 'dewiki', 'A_de', 'Q1', 'enwiki')], 'reader'),
+        # editor dewiki -> enwiki switch on Q2
+        Session('u3', 'DE', [Pageview('2019-02-16T01:00:00', 'dewiki', 'B_de', 'Q2', 'google'),
+                             Pageview('2019-02-16T01:00:10', 'enwiki', 'B', 'Q2', 'dewiki')], 'editor'),
+    ]
+    for session in sessions:
+        builder.consume(session)
+    builder.report()
+
+def test_query_service():
+    index_dir = tempfile.mkdtemp()
+    try:
+        build_index(index_dir)
+        service = QueryService(SwitchIndex.load(index_dir))
+
+        def get(path, query=''):
+            status, body = service.handle(path, query)
+            return status, json.loads(body)
+
+        assert get('/pairs', 'src=enwiki&dst=dewiki')[1]['switches'] == 2
+        assert get('/pairs', 'src=dewiki&dst=enwiki&usertype=reader')[1]['switches'] == 0
+        assert get('/pairs', 'dst=enwiki')[1]['switches'] == {'dewiki-enwiki': 1}
+        assert get('/pairs', 'src=enwiki&dst=dewiki&usertype=reader')[1]['src_views'] == 3
+
+        top = get('/top_pairs', 'k=5')[1]['pairs']
+        assert [(p['pair'], p['switches']) for p in top] == [('enwiki-dewiki', 2), ('dewiki-enwiki', 1)]
+        # weight_by_proj semantics: switches per source page view, 0 if the source has too few views
+        weighted = get('/top_pairs', 'k=5&weighted=1&min_views=0&usertype=reader')[1]['pairs']
+        assert weighted == [{'pair': 'enwiki-dewiki', 'value': 2 / 3, 'switches': 2}]
+        assert get('/top_pairs', 'weighted=1')[1]['pairs'] == []
+
+        q1 = get('/qid', 'qid=Q1')[1]
+        assert q1['views'] == 4 and q1['switch_out'] == 2 and q1['switch_in'] == 2
+        assert q1['projects']['enwiki'] == {'views': 2, 'switch_out': 2, 'switch_in': 0, 'switch_rate': 1.0}
+        assert get('/qid', 'qid=Q404')[1]['views'] == 0
+        articles = get('/top_switched', 'wiki=enwiki&count=switch_in')[1]['articles']
+        assert articles == [{'qid': 'Q2', 'value': 1.0, 'views': 2}]
+
+        assert get('/pairs')[0] == 400
+        assert get('/qid', 'qid=foo')[0] == 400
+        for k in ('-100000', '0'):
+            assert get('/top_pairs', 'k=' + k)[0] == 400
+            assert get('/top_switched', 'wiki=enwiki&k=' + k)[0] == 400
+        assert len(get('/top_pairs', 'k=100000000')[1]['pairs']) == 2
+        assert get('/qid', 'qid=P31')[0] == 400
+        assert get('/top_pairs', 'usertype=bot')[0] == 400
+        assert get('/nope')[0] == 404
+
+        # repeated queries (in any parameter order) are served from the cache
+        get('/pairs', 'dst=dewiki&src=enwiki')
+        assert get('/stats')[1]['cache']['hits'] >= 1
+
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = 'http://127.0.0.1:{0}/pairs?src=enwiki&dst=dewiki'.format(server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                assert json.load(response)['switches'] == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(index_dir)
+
+def test_invalid_qids():
+    builder = SwitchIndexBuilder(argparse.Namespace(maxpvs=500, switch_index_dir=None))
+    # an enwiki -> dewiki switch on a property: each of its page views is counted once as not a QID
+    builder.consume(Session('u1', 'US', [Pageview('2019-02-16T01:00:00', 'enwiki', 'P', 'P31', 'google'),
+                                         Pageview('2019-02-16T01:00:10', 'dewiki', 'P_de', 'P31', 'enwiki'),
+                                         Pageview('2019-02-16T01:00:20', 'enwiki', 'A', 'Q1', 'google')], 'reader'))
+    assert builder.invalid_qids == 2
+    assert len(builder.counts['views']) == 1
+    assert not builder.counts['switch_out'] and not builder.counts['switch_in']
+    assert sum(builder.pairs.values()) == 1
+
+def main():
+    test_query_service()
+    test_invalid_qids()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import random
+import tempfile
+
+from reporting import Report
+from reporting import top_k
+from reporting import weight_by_proj
+from reporting import weight_by_pvs
+from spill_counter import SpillCounter
+
+def test_top_k_matches_sort():
+    rand = random.Random(0)
+    # many ties: order must match a stable sort of the whole dict
+    countdict = {'Q{0}'.format(i): rand.randrange(20) for i in range(2000)}
+    expected = [(k, countdict[k]) for k in sorted(countdict, key=countdict.get, reverse=True)]
+    for k in (0, 1, 10, 41, 5000):
+        assert top_k(countdict, k) == expected[:k]
+
+def test_weighting_without_copies():
+    to_from = {'enwiki-dewiki': 10, 'dewiki-enwiki': 4, 'frwiki-enwiki': 3}
+    proj_pvs = {'enwiki': 1000, 'dewiki': 200, 'frwiki': 600}
+    weighted = weight_by_proj(to_from, proj_pvs)
+    assert dict(weighted.items()) == {'enwiki-dewiki': 0.01, 'dewiki-enwiki': 0, 'frwiki-enwiki': 0.005}
+    assert weighted['enwiki-dewiki'] == 0.01 and weighted.get('xx-yy') is None
+    assert to_from == {'enwiki-dewiki': 10, 'dewiki-enwiki': 4, 'frwiki-enwiki': 3}
+
+    lang_from = {'Q1': 5, 'Q2': 5}
+    wd_pvs = {'Q1': 100, 'Q2': 20}
+    assert list(weight_by_pvs(lang_from, wd_pvs).values()) == [0.05, 0]
+    assert lang_from == {'Q1': 5, 'Q2': 5}
+
+def test_report_output():
+    fn = os.path.join(tempfile.mkdtemp(), 'report.json')
+    report = Report(fn)
+    logging.disable(logging.INFO)
+    try:
+        report.section("Language pairs")
+        report.usertype("reader")
+        countdict = {'enwiki-dewiki': 6, 'dewiki-enwiki': 3, 'frwiki-enwiki': 1}
+        # threshold n shows n + 1 items
+        report.print_stats(countdict, 1, "", label=str.upper)
+        report.print_stats(countdict, 5, "", ignore=['enwiki-dewiki'], context_dict={'dewiki-enwiki': 'x'})
+        report.write()
+    finally:
+        logging.disable(logging.NOTSET)
+    with open(fn, 'r') as fin:
+        tables = json.load(fin)
+    os.remove(fn)
+    os.rmdir(os.path.dirname(fn))
+    assert tables[0]['section'] == "Language pairs" and tables[0]['usertype'] == "reader"
+    assert [(r['key'], r['label'], r['value']) for r in tables[0]['rows']] == [
+        ('enwiki-dewiki', 'ENWIKI-DEWIKI', 6), ('dewiki-enwiki', 'DEWIKI-ENWIKI', 3)]
+    assert tables[0]['rows'][0]['share'] == 0.6
+    assert tables[0]['total'] == 10 and tables[0]['remainder'] == 1
+    assert [(r['key'], r['context']) for r in tables[1]['rows']] == [('dewiki-enwiki', 'x'), ('frwiki-enwiki', 'N/A')]
+    assert tables[1]['total'] == 4 and tables[1]['remainder'] == 0
+
+def spilled(counts, max_items):
+    counter = SpillCounter(max_items=max_items)
+    for key, count in counts.items():
+        counter.counts[key] = count
+        counter.check()
+    return counter.finish()
+
+def test_weighting_spilled_norms():
+    rand = random.Random(0)
+    wd_pvs = {'Q{0}'.format(i): rand.randrange(200) for i in range(3000)}
+    lang_from = {'Q{0}'.format(i): rand.randrange(1, 20) for i in rand.sample(range(4000), 500)}
+    expected = dict(weight_by_pvs(lang_from, wd_pvs).items())
+    spilled_pvs = spilled(wd_pvs, 100)
+
+    def no_lookups(i):
+        raise AssertionError("norms are merged in key order, not looked up per key")
+    spilled_pvs._read_block = no_lookups
+    spilled_from = spilled(lang_from, 100)
+    try:
+        # counts in memory (sorted once) or spilled as well (already sorted)
+        for counts in (lang_from, spilled_from):
+            weighted = weight_by_pvs(counts, spilled_pvs)
+            assert dict(weighted.items()) == expected
+            assert sorted(weighted.values()) == sorted(expected.values())
+    finally:
+        spilled_pvs.close()
+        spilled_from.close()
+
+def main():
+    test_top_k_matches_sort()
+    test_weighting_without_copies()
+    test_weighting_spilled_norms()
+    test_report_output()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import contextlib
+import json
+import os
+import pickle
+import random
+import tempfile
+
+from desc_stats import DescStats
+from desc_stats import get_parser
+from differential import write_random_tsv
+from session_utils import scan_sessions
+from session_utils import SessionConsumer
+from spill_counter import SpillCounter
+from spill_counter import SpillDict
+
+class Crash(SessionConsumer):
+    """Raises after crash_after sessions to simulate an interrupted run."""
+
+    def __init__(self, crash_after=-1):
+        self.crash_after = crash_after
+        self.num_sessions = 0
+
+    def consume(self, session):
+        if self.num_sessions == self.crash_after:
+            raise KeyboardInterrupt
+        self.num_sessions += 1
+
+    def get_state(self):
+        return {'num_sessions': self.num_sessions}
+
+def test_spill_counter():
+    rand = random.Random(0)
+    expected = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        counter = SpillCounter(max_items=50, spill_dir=tmpdir)
+        for i in range(30000):
+            key = 'Q{0}'.format(int(rand.paretovariate(0.5)) % 3000)
+            counter.counts[key] = counter.counts.get(key, 0) + 1
+            expected[key] = expected.get(key, 0) + 1
+            if i == 10000:
+                # runs already written stay valid for a pickled (checkpointed) counter
+                counter = pickle.loads(pickle.dumps(counter))
+            counter.check()
+            assert len(counter.counts) <= 50
+        # enough runs to be merged in several rounds
+        assert len(counter.runs) > 64
+        counts = counter.finish()
+        assert dict(counts.items()) == expected
+        assert list(counts) == sorted(expected) and len(counts) == len(expected)
+        assert all(counts.get(key) == value for key, value in expected.items())
+        assert counts.get('Q-1', 0) == 0 and 'A' not in counts and None not in counts
+        counter.close()
+        assert not os.listdir(tmpdir)
+    # string values: the last value set wins, also across runs
+    titles = SpillDict(max_items=3)
+    expected = {}
+    for i in range(100):
+        key = 'Q{0}'.format(rand.randrange(10))
+        titles.counts[key] = expected[key] = 'Title_{0}_é'.format(i)
+        titles.check()
+    titles = titles.finish()
+    assert dict(titles.items()) == expected and titles['Q1'] == expected['Q1']
+    titles.close()
+    # nothing spilled: the plain dict is used as is
+    small = SpillCounter(max_items=50)
+    small.counts['Q1'] = 3
+    small.check()
+    assert small.finish() == {'Q1': 3} and small.temp_dir is None
+
+def report_tables(tsv, tmpdir, name, extra_args=(), crash_after=None):
+    report_fn = os.path.join(tmpdir, '{0}.json'.format(name))
+    args = get_parser().parse_args(['--tsvs', tsv, '--report_fn', report_fn] + list(extra_args))
+    checkpoint = os.path.join(tmpdir, '{0}.pkl'.format(name))
+    stats = DescStats(args)
+    if crash_after is not None:
+        try:
+            scan_sessions([tsv], [stats, Crash(crash_after)], checkpoint=checkpoint, checkpoint_every=7)
+            assert False, "the scan should have been interrupted"
+        except KeyboardInterrupt:
+            pass
+        stats = DescStats(args)
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        scan_sessions([tsv], [stats, Crash()], checkpoint=checkpoint, checkpoint_every=7, resume=True)
+    stats.report()
+    with open(report_fn, 'r') as fin:
+        tables = json.load(fin)
+    # spilled counts are read in key order, so tied rows may be in another order and ties at the cutoff may be
+    # broken in favor of other keys
+    return [(t['section'], t['usertype'], t['name'], t['total'], t['remainder'], [r['value'] for r in t['rows']],
+             sorted((r['value'], r['key'], r['label'], r.get('context'))
+                    for r in t['rows'] if r['value'] > t['rows'][-1]['value'])) for t in tables]
+
+def test_desc_stats():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tsv = os.path.join(tmpdir, 'pvs.tsv.gz')
+        write_random_tsv(tsv, num_users=300, seed=1, malformed=0)
+        in_memory = report_tables(tsv, tmpdir, 'in_memory')
+        spill_dir = os.path.join(tmpdir, 'spill')
+        spilled = report_tables(tsv, tmpdir, 'spilled', ['--max_counter_items', '2', '--spill_dir', spill_dir],
+                                crash_after=150)
+        assert spilled == in_memory
+        assert not os.listdir(spill_dir)
+
+def main():
+    test_spill_counter()
+    test_desc_stats()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import json
+import random
+
+from session_utils import get_lang_switch
+from session_utils import Pageview
+from session_utils import trim_session
+from stream_switches import SlidingWindowCounts
+from stream_switches import StreamingSession
+from stream_switches import SwitchStream
+
+PROJECTS = ['enwiki', 'dewiki', 'eswiki']
+
+def test_incremental_matches_batch():
+    rand = random.Random(0)
+    for _ in range(500):
+        pvs = [Pageview('2019-02-16T11:31:53', rand.choice(PROJECTS), 'T{0}'.format(rand.randrange(6)),
+                        rand.choice(['Q1', 'Q2', 'Q3', '']), rand.choice(PROJECTS + ['google']))
+               for _ in range(rand.randrange(1, 12))]
+        trim_session(pvs)
+        for wikidbs, ref_match in [((), False), (('enwiki',), False), ((), True)]:
+            session = StreamingSession(0)
+            streamed = []
+            for pv in pvs:
+                switches = session.add(pv.proj, pv.title, pv.wd, pv.referer, wikidbs, ref_match)
+                streamed.extend((i, session.num_pvs - 1) for i, _ in switches)
+            assert sorted(streamed) == get_lang_switch(pvs, wikidbs, ref_match), (pvs, wikidbs, ref_match)
+
+def test_sliding_windows():
+    counts = SlidingWindowCounts(window=30, slide=10)
+    closed = []
+    for epoch in [0, 5, 12, 25, 31, 44]:
+        closed.extend(counts.advance(epoch))
+        counts.add(epoch, 'x')
+    assert not counts.add(15, 'x'), "older than the window"
+    closed.extend(counts.advance(200))
+    assert [(start, end, c['x']) for start, end, c in closed] == [
+        (-20, 10, 2), (-10, 20, 3), (0, 30, 4), (10, 40, 3), (20, 50, 3), (30, 60, 2), (40, 70, 1)]
+
+def test_stream():
+    windows = []
+    stream = SwitchStream(window=60, slide=60, idle_seconds=100, max_users=2, maxpvs=3, emit=windows.append)
+    rows = [
+        ['u1', 'enwiki', 'A', '1', '2019-02-16T11:00:00', 'US', '', 'Q1'],
+        ['u2', 'enwiki', 'B', '2', '2019-02-16T11:00:01', 'US', '', 'Q2'],
+        ['u1', 'dewiki', 'A_de', '3', '2019-02-16T11:00:10', 'US', 'https://en.wikipedia.org/', 'Q1'],
+        ['u3', 'enwiki', 'A', '1', '2019-02-16T11:00:20', 'US', '', 'Q1'],
+        # u2 was evicted to stay within max_users: its session starts over
+        ['u2', 'eswiki', 'B_es', '4', '2019-02-16T11:00:30', 'US', '', 'Q2'],
+        ['u3', 'enwiki', 'EDITATTEMPT', '1', '2019-02-16T11:00:40', 'US', ''],
+        ['u3', 'dewiki', 'A_de', '3', '2019-02-16T11:01:10', 'US', '', 'Q1'],
+        # more than maxpvs page views: a bot
+        ['u4', 'enwiki', 'A', '1', '2019-02-16T11:01:20', 'US', '', 'Q1'],
+        ['u4', 'enwiki', 'B', '1', '2019-02-16T11:01:21', 'US', '', 'Q2'],
+        ['u4', 'enwiki', 'C', '1', '2019-02-16T11:01:22', 'US', '', 'Q3'],
+        ['u4', 'dewiki', 'A_de', '1', '2019-02-16T11:01:23', 'US', '', 'Q1'],
+    ]
+    for row in rows:
+        stream.process_line('\t'.join(row) + '\n')
+    stream.close()
+    first, second = [json.loads(w) for w in windows]
+    assert first['start'] == '2019-02-16T11:00:00' and first['end'] == '2019-02-16T11:01:00'
+    assert first['pairs'] == {'reader': [['enwiki-dewiki', 1]]}
+    assert first['total_views'] == {'reader': 5}
+    assert first['latency']['events'] == 6
+    assert second['pairs'] == {'editor': [['enwiki-dewiki', 1]]}
+    assert second['total_views'] == {'editor': 1, 'reader': 3}
+    assert stream.stats['evicted_full'] == 3 and stream.stats['bots'] == 1
+    assert len(stream.users) <= 2
+
+def main():
+    test_incremental_matches_batch()
+    test_sliding_windows()
+    test_stream()
+
+if __name__ == "__main__":
+    main()
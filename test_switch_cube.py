@@ -0,0 +1,66 @@
+import argparse
+import random
+import tempfile
+
+from reader_language_overlap import LanguageOverlap
+from session_utils import Pageview
+from session_utils import Session
+from session_utils import usertypes
+from switch_cube import KINDS
+from switch_cube import SwitchCube
+from switch_cube import SwitchCubeBuilder
+
+PROJECTS = ['enwiki', 'dewiki', 'eswiki', 'frwiki']
+COUNTRIES = ['US', 'Norway', 'Chile']
+
+def random_sessions(num_sessions, seed=0):
+    rand = random.Random(seed)
+    for i in range(num_sessions):
+        pvs = []
+        for j in range(rand.randrange(1, 8)):
+            proj = rand.choice(PROJECTS)
+            item = rand.randrange(4)
+            pvs.append(Pageview(str(j), proj, 'T{0}'.format(item), 'Q{0}'.format(item + 1)))
+        yield Session('u{0}'.format(i), rand.choice(COUNTRIES), pvs, rand.choice(usertypes))
+
+def test_cube():
+    args = argparse.Namespace(maxpvs=6, hll=False, cube_dir=None)
+    sessions = list(random_sessions(500))
+    overlap = LanguageOverlap(args)
+    builder = SwitchCubeBuilder(args)
+    by_country = {c: SwitchCubeBuilder(args) for c in COUNTRIES}
+    for session in sessions:
+        overlap.consume(session)
+        builder.consume(session)
+        by_country[session.country].consume(session)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        builder.build().save(tmpdir)
+        cube = SwitchCube.load(tmpdir)
+        # summing over countries gives the counts of reader_language_overlap.py
+        for ut in usertypes:
+            for kind, counts in [('switches', overlap.switch_to_from), ('cooccurrence', overlap.lang_cooccurrence)]:
+                table = {'{0}-{1}'.format(src, dst): n for src, dst, n in cube.table(kind, ['src', 'dst'], usertype=ut)}
+                assert table == counts[ut]
+            assert dict(cube.table('sessions', ['project'], usertype=ut)) == overlap.proj_pvs[ut]
+
+        # filtering on a country gives the counts of that country's sessions only
+        for country, country_builder in by_country.items():
+            country_cube = country_builder.build()
+            for kind, axes in KINDS.items():
+                assert sorted(cube.table(kind, axes, country=country)) == sorted(country_cube.table(kind, axes))
+                # ranges found by binary search (leading axes) and masks give the same cells
+                for ut in usertypes:
+                    assert (sorted(cube.table(kind, axes, usertype=ut, country=country))
+                            == sorted(cube.table(kind, axes, usertype=[ut], country=[country])))
+
+        pair = cube.reduce('switches', ['country'], src='enwiki', dst='dewiki')
+        assert pair.sum() == sum(overlap.switch_to_from[ut].get('enwiki-dewiki', 0) for ut in usertypes)
+        assert cube.reduce('switches', country='Atlantis') == 0
+        assert len(cube.table('cooccurrence', ['src', 'dst'], k=3)) == 3
+
+def main():
+    test_cube()
+
+if __name__ == "__main__":
+    main()
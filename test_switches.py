@@ -1,6 +1,20 @@
+from datetime import datetime, timezone
+import gzip
+import os
+import tempfile
+
 from session_utils import get_lang_switch
 from session_utils import get_nonlang_switch
 from session_utils import Pageview, Session
+from session_utils import scan_sessions
+from session_utils import SessionConsumer
+from session_utils import CompactPageviews
+from session_utils import dt_to_epoch
+from session_utils import pageview_epochs
+from session_utils import PageviewVocab
+from session_utils import trim_session
+from session_utils import tsv_to_sessions
+from session_utils import wilson_interval
 
 # NOTE: for testing, it's okay to reorder these page views even though the times no longer make sense then
 p1 = Pageview(dt='2019-02-16T11:31:53', proj='enwiki', title='Columbidae', wd='Q10856')
@@ -20,7 +34,236 @@ def session_with_enwikito_switches():
 def session_with_no_switches():
     return Session("USER_NO_SWITCHES", "COUNTRY", [p2, p3], 'reader')
 
+def test_compact_pageviews():
+    sessions = [session_with_enwikifrom_switches(), session_with_enwikifrom_twoswitches(),
+                session_with_enwikito_switches(), session_with_no_switches()]
+    for session in sessions:
+        pvs = session.pageviews
+        compact = CompactPageviews(pvs)
+        assert list(compact) == pvs
+        assert compact[0].proj == pvs[0].proj
+        for wikidbs in [(), ("enwiki",), ("eswiki",)]:
+            assert get_lang_switch(compact, wikidbs) == get_lang_switch(pvs, wikidbs)
+        for wikidb in ["enwiki", "eswiki", "dewiki", "frwiki"]:
+            for direction in ["from", "to"]:
+                assert (get_nonlang_switch(compact, wikidb, direction=direction) ==
+                        get_nonlang_switch(pvs, wikidb, direction=direction))
+
+    # minute-cached parsing matches datetime (the epochs are stored by CompactPageviews)
+    pvs = [p1, p2, p3, p4, p1._replace(dt='2019-02-16T11:32'), p1._replace(dt='2019-02-17T00:00:00Z')]
+    expected = [int(datetime.fromisoformat(pv.dt[:19]).replace(tzinfo=timezone.utc).timestamp()) for pv in pvs]
+    assert list(pageview_epochs(pvs)) == list(pageview_epochs(CompactPageviews(pvs))) == expected
+    assert dt_to_epoch('2019-02-16T11:32') == dt_to_epoch('2019-02-16T11:32:00')
+
+    pvs = [p1, p2, p1, p3, p2]
+    compact = CompactPageviews(pvs)
+    trim_session(pvs)
+    trim_session(compact)
+    assert pvs == [p1, p2, p3]
+    assert list(compact) == pvs
+
+HEADER = ['user', 'project', 'page_title', 'page_id', 'dt', 'country', 'referer', 'item_id']
+
+def write_tsv(rows):
+    """Write rows of pageview fields to a temporary gzipped TSV (with header) and return its path."""
+    fd, tsv = tempfile.mkstemp(suffix='.tsv.gz')
+    os.close(fd)
+    with gzip.open(tsv, 'wt') as fout:
+        for row in [HEADER] + rows:
+            fout.write('\t'.join(row) + '\n')
+    return tsv
+
+def test_tsv_to_sessions_trim():
+    tsv = write_tsv([
+        ['u1', 'enwiki', 'Columbidae', '1', '2019-02-16T11:31:53', 'Norway', 'https://www.google.com/', 'Q10856'],
+        ['u1', 'enwiki', 'Anarchism', '2', '2019-02-16T11:32:05', 'Norway', 'https://en.wikipedia.org/', 'Q6199'],
+        ['u1', 'enwiki', 'Columbidae', '1', '2019-02-16T11:32:10', 'Norway', 'https://en.wikipedia.org/', 'Q10856'],
+        ['u1', 'eswiki', 'Columbidae', '3', '2019-02-16T11:32:13', 'Norway', 'https://en.wikipedia.org/', 'Q10856'],
+        ['u1', 'enwiki', 'EDITATTEMPT', '2', '2019-02-16T11:33:00', 'Norway', 'https://en.wikipedia.org/'],
+        ['u2', 'enwiki', 'Anarchism', '2', '2019-02-16T11:32:05', 'Chile', '', 'Q6199'],
+        ['u2', 'enwiki', 'Anarchism', '2', '2019-02-16T11:32:06', 'Chile', '', 'Q6199'],
+    ])
+    try:
+        for compact in (False, True):
+            trimmed = list(tsv_to_sessions(tsv, trim=True, compact=compact))
+            untrimmed = list(tsv_to_sessions(tsv, trim=False, compact=compact))
+            assert [s.duplicates for s in trimmed] == [1, 1]
+            assert [s.usertype for s in trimmed] == ['editor', 'reader']
+            assert [pv.title for pv in trimmed[0].pageviews] == ['Columbidae', 'Anarchism', 'Columbidae']
+            assert [pv.referer for pv in trimmed[0].pageviews] == ['google', 'enwiki', 'enwiki']
+            for t, u in zip(trimmed, untrimmed):
+                pvs = list(u.pageviews)
+                assert trim_session(pvs) == t.duplicates
+                assert pvs == list(t.pageviews)
+    finally:
+        os.remove(tsv)
+
+def test_vocab_per_scan():
+    # every scan reads other titles (e.g., another day): vocabularies are per scan, so they do not accumulate
+    tsvs = [write_tsv([['u{0}'.format(u), 'enwiki', 'Day{0}_{1}'.format(day, u), '1', '2019-02-16T11:31:53', 'Chile',
+                        'https://en.wikipedia.org/', 'Q{0}'.format(u + 1)] for u in range(20)]) for day in range(3)]
+    try:
+        for tsv in tsvs:
+            sessions = list(tsv_to_sessions(tsv, compact=True))
+            vocab = sessions[0].pageviews.vocab
+            assert all(s.pageviews.vocab is vocab for s in sessions)
+            # missing value + 20 titles of this scan only
+            assert len(vocab.titles) == 21
+            assert len(vocab.projects) == 2
+        # a vocab passed in is shared (ids stay comparable across the scans) and holds the titles of all of them
+        vocab = PageviewVocab()
+        for tsv in tsvs:
+            list(tsv_to_sessions(tsv, compact=True, vocab=vocab))
+        assert len(vocab.titles) == 61
+    finally:
+        for tsv in tsvs:
+            os.remove(tsv)
+
+def test_sample_rate():
+    rows = []
+    for u in range(200):
+        usr = '{0:08x}'.format(u * 0x1000000 + 7) + 'a' * 120
+        rows.append([usr, 'enwiki', 'Anarchism', '2', '2019-02-16T11:32:05', 'Chile', 'x', 'Q6199'])
+        rows.append([usr, 'eswiki', 'Anarquismo', '3', '2019-02-16T11:32:06', 'Chile', 'x', 'Q6199'])
+    tsv = write_tsv(rows)
+    try:
+        everyone = [s.usrhash for s in tsv_to_sessions(tsv)]
+        sampled = [s.usrhash for s in tsv_to_sessions(tsv, sample_rate=0.25)]
+        # users are selected by hash prefix: the lowest quarter of the hash space
+        assert sampled == everyone[:64]
+        assert all(len(s.pageviews) == 2 for s in tsv_to_sessions(tsv, sample_rate=0.25))
+    finally:
+        os.remove(tsv)
+
+    # two users that only differ after the 64-bit key share a compact key
+    tsv = write_tsv([['0' * 15 + '1' * 113] + rows[0][1:], ['0' * 15 + '1' + '2' * 112] + rows[1][1:]])
+    try:
+        sessions = list(tsv_to_sessions(tsv))
+        assert len(sessions) == 2 and sessions[0].usrhash == sessions[1].usrhash == 1
+    finally:
+        os.remove(tsv)
+
+    p, low, high = wilson_interval(20, 100)
+    assert p == 0.2 and low < 0.2 < high
+
+def test_gap_sessions():
+    tsv = write_tsv([
+        ['u1', 'enwiki', 'Columbidae', '1', '2019-02-16T11:00:00', 'Norway', '', 'Q10856'],
+        ['u1', 'eswiki', 'Columbidae', '3', '2019-02-16T11:20:00', 'Norway', '', 'Q10856'],
+        # more than 30 minutes later: a new session, in which the first view of a page counts again
+        ['u1', 'enwiki', 'Columbidae', '1', '2019-02-16T11:50:01', 'Norway', '', 'Q10856'],
+        ['u1', 'enwiki', 'EDITATTEMPT', '1', '2019-02-16T11:51:00', 'Norway', 'https://en.wikipedia.org/'],
+        ['u1', 'enwiki', 'Columbidae', '1', '2019-02-16T11:52:00', 'Norway', '', 'Q10856'],
+        ['u1', 'enwiki', 'Anarchism', '2', '2019-02-16T13:00:00', 'Norway', '', 'Q6199'],
+        ['u2', 'enwiki', 'Anarchism', '2', '2019-02-16T13:00:01', 'Chile', '', 'Q6199'],
+    ])
+    try:
+        assert [len(s.pageviews) for s in tsv_to_sessions(tsv, trim=True)] == [3, 1]
+        for compact in (False, True):
+            sessions = list(tsv_to_sessions(tsv, trim=True, compact=compact, gap_seconds=1800))
+            assert [(s.subsession, len(s.pageviews), s.usertype, s.duplicates) for s in sessions] == [
+                (0, 2, 'reader', 0), (1, 1, 'editor', 1), (2, 1, 'reader', 0), (0, 1, 'reader', 0)]
+            assert len({s.usrhash for s in sessions[:3]}) == 1
+    finally:
+        os.remove(tsv)
+
+def test_early_bots():
+    rows = [['u1', 'enwiki', 'Anarchism', '2', '2019-02-16T11:32:05', 'Chile', 'x', 'Q6199']]
+    # more than 4 (distinct) page views
+    rows += [['u2', 'enwiki', 'T{0}'.format(p), '1', '2019-02-16T11:{0:02d}:00'.format(p), 'Chile', 'x', 'Q1']
+             for p in range(8)]
+    # more than 3 lines in a minute
+    rows += [['u3', 'enwiki', 'EDITATTEMPT', '1', '2019-02-16T12:00:00', 'Chile', 'x']]
+    rows += [['u3', 'enwiki', 'T0', '1', '2019-02-16T12:00:0{0}'.format(s), 'Chile', 'x', 'Q1'] for s in range(1, 5)]
+    # as many lines, but duplicates of one page in different minutes
+    rows += [['u4', 'enwiki', 'T0', '1', '2019-02-16T12:{0:02d}:00'.format(m), 'Chile', 'x', 'Q1'] for m in range(8)]
+    tsv = write_tsv(rows)
+    try:
+        for compact in (False, True):
+            everyone = list(tsv_to_sessions(tsv, trim=True, compact=compact))
+            stats = {}
+            sessions = list(tsv_to_sessions(tsv, trim=True, compact=compact, max_pvs=4, stats=stats))
+            assert [s.usrhash for s in sessions] == [s.usrhash for s in everyone if len(s.pageviews) <= 4]
+            assert stats == {'bots': {'reader': 1, 'editor': 0}, 'bot_lines': 3}
+            stats = {}
+            sessions = list(tsv_to_sessions(tsv, trim=True, compact=compact, max_pvs=4, max_per_minute=3,
+                                            stats=stats))
+            assert [s.usrhash for s in sessions] == [everyone[0].usrhash, everyone[3].usrhash]
+            assert stats == {'bots': {'reader': 1, 'editor': 1}, 'bot_lines': 4}
+    finally:
+        os.remove(tsv)
+
+class Recorder(SessionConsumer):
+    """Records the sessions it sees; raises after crash_after sessions to simulate an interrupted run."""
+
+    def __init__(self, crash_after=-1):
+        self.crash_after = crash_after
+        self.seen = []
+
+    def consume(self, session):
+        if len(self.seen) == self.crash_after:
+            raise KeyboardInterrupt
+        self.seen.append((session.usrhash, [pv.title for pv in session.pageviews]))
+
+    def get_state(self):
+        return {'seen': self.seen}
+
+def test_checkpoint_resume():
+    tsvs = []
+    for shard in range(3):
+        rows = []
+        for u in range(7):
+            usr = '{0}{1}'.format(shard, u) + 'f' * 126
+            for p in range(u % 3 + 1):
+                rows.append([usr, 'enwiki', 'T{0}'.format(p), '1', '2019-02-16T11:32:0{0}'.format(p), 'Chile', '', 'Q1'])
+        tsvs.append(write_tsv(rows))
+    checkpoint = tempfile.mktemp(suffix='.pkl')
+    try:
+        uninterrupted = Recorder()
+        assert scan_sessions(tsvs, [uninterrupted], checkpoint=checkpoint) == 21
+        # crash mid-file between checkpoints and at a file boundary, then resume (possibly crashing again)
+        for crash_after, checkpoint_every in [(10, 3), (14, 0), (5, 1)]:
+            os.remove(checkpoint)
+            try:
+                scan_sessions(tsvs, [Recorder(crash_after)], checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+                assert False, "should have been interrupted"
+            except KeyboardInterrupt:
+                pass
+            resumed = Recorder()
+            assert scan_sessions(tsvs, [resumed], checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                                 resume=True) == 21
+            assert resumed.seen == uninterrupted.seen
+        # with sessions split by inactivity, checkpoints are only taken between users
+        os.remove(checkpoint)
+        split = Recorder()
+        assert scan_sessions(tsvs, [split], gap_seconds=0) == 39
+        try:
+            scan_sessions(tsvs, [Recorder(8)], gap_seconds=0, checkpoint=checkpoint, checkpoint_every=1)
+            assert False, "should have been interrupted"
+        except KeyboardInterrupt:
+            pass
+        resumed = Recorder()
+        scan_sessions(tsvs, [resumed], gap_seconds=0, checkpoint=checkpoint, checkpoint_every=1, resume=True)
+        assert resumed.seen == split.seen
+        # a checkpoint only matches the files it was written for
+        try:
+            scan_sessions(tsvs[:2], [Recorder()], checkpoint=checkpoint, resume=True)
+            assert False, "checkpoint of other files must not be used"
+        except ValueError:
+            pass
+    finally:
+        for fn in tsvs + [checkpoint]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
 def main():
+    test_compact_pageviews()
+    test_sample_rate()
+    test_gap_sessions()
+    test_early_bots()
+    test_checkpoint_resume()
+    test_tsv_to_sessions_trim()
+    test_vocab_per_scan()
     assert get_lang_switch(pvs=session_with_enwikifrom_switches().pageviews, wikidbs=("enwiki",)) == [(0,2)]
     assert get_lang_switch(pvs=session_with_enwikifrom_twoswitches().pageviews, wikidbs=("enwiki",)) == [(0,2)]
     assert get_lang_switch(pvs=session_with_enwikifrom_twoswitches().pageviews, wikidbs=()) == [(0,2),(2,3)]
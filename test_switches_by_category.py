@@ -0,0 +1,64 @@
+import csv
+import json
+import os
+import tempfile
+
+from dataset_io import write_dataset
+from switches_by_category import count_topics
+from switches_by_category import load_qid_topics
+from switches_by_category import LONG_HEADER
+from switches_by_category import run_batch
+
+TOPICS = ['Culture.Biography.Biography*', 'Culture.Media.Music', 'STEM.Biology', 'Geography.Regions.Europe']
+
+def ores_record(qid, topics):
+    probability = {t: 1 / (i + 2) for i, t in enumerate(topics)}
+    return {'qid': qid, 'rev_id': 1, 'score': {'drafttopic': {'score': {'prediction': topics,
+                                                                        'probability': probability}}}}
+
+def dataset_rows(lang, seed):
+    rows = []
+    for i in range(40):
+        switch = 'N/A' if (i + seed) % 3 else 'enwiki'
+        rows.append([switch, 'US', 'Q{0}'.format(i % 12 + 1), 'T{0}'.format(i), '2019-02-16T11:31:53', 'reader', '1'])
+    return rows
+
+def test_batch():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ores_output = os.path.join(tmpdir, 'ores.json')
+        with open(ores_output, 'w') as fout:
+            # Q11 and Q12 have no ORES scores
+            for q in range(1, 11):
+                fout.write(json.dumps(ores_record('Q{0}'.format(q), TOPICS[q % 4:q % 4 + 2])) + '\n')
+        specs = []
+        for seed, (lang, direction) in enumerate([('eswiki', 'from'), ('dewiki', 'to'), ('frwiki', 'from')]):
+            fn = os.path.join(tmpdir, '{0}_{1}.tsv'.format(lang, direction))
+            write_dataset(fn, dataset_rows(lang, seed), lang, direction)
+            specs.append('{0}:{1}:{2}'.format(lang, direction, fn))
+
+        topic_cache = os.path.join(tmpdir, 'topics.json')
+        for approach in ['best', 'all']:
+            qid_to_topic = load_qid_topics(ores_output, approach, topic_cache)
+            # the second load comes from the cache
+            assert load_qid_topics(ores_output, approach, topic_cache) == qid_to_topic
+            output_tsv = os.path.join(tmpdir, 'topics_{0}.tsv'.format(approach))
+            run_batch(specs, qid_to_topic, approach, output_tsv, workers=2)
+            with open(output_tsv, 'r') as fin:
+                rows = list(csv.reader(fin, delimiter='\t'))
+            assert rows[0] == LONG_HEADER
+            for spec in specs:
+                lang, direction, fn = spec.split(':', 2)
+                switch_topics, noswitch_topics, s_no_topic, n_no_topic = count_topics(fn, qid_to_topic, approach)
+                assert s_no_topic + n_no_topic == 6
+                topic_rows = {r[3]: r for r in rows[1:] if r[:3] == [lang, direction, 'topic']}
+                assert {t: int(r[4]) for t, r in topic_rows.items() if int(r[4])} == switch_topics
+                assert {t: int(r[5]) for t, r in topic_rows.items() if int(r[5])} == noswitch_topics
+                toptopic_rows = [r for r in rows[1:] if r[:3] == [lang, direction, 'toptopic']]
+                assert {r[3] for r in toptopic_rows} <= {'Culture', 'STEM', 'Geography'}
+                assert abs(sum(float(r[6]) for r in toptopic_rows) - 1) < 1e-9
+
+def main():
+    test_batch()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""LDA topic models published once as memory-mapped .npy files so that any number of processes attach to the same pages
+in the OS page cache instead of each parsing and holding a private copy of the model."""
+
+import gzip
+import hashlib
+import json
+import os
+
+import numpy as np
+
+QID_TO_PID_HEADER = ['item_id', 'wiki_db', 'page_id', 'page_title']
+
+def title_hash(title):
+    return int.from_bytes(hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def hash_titles(titles):
+    return np.fromiter((title_hash(t) for t in titles), dtype=np.int64, count=len(titles))
+
+
+# files in store_dir per language (e.g., 'es'):
+#  {lang}_topics.npy: float32 matrix with one row of topic weights per title
+#  {lang}_title_hashes.npy / {lang}_title_rows.npy: sorted 64-bit title hashes and their rows
+#  {lang}_topic_descs.json: topic descriptions (written last: its presence marks a complete store)
+#  {lang}_qids.npy / {lang}_qid_rows.npy (optional, see publish_qid_index): sorted integer QIDs and their rows
+def _path(store_dir, lang, name):
+    return os.path.join(store_dir, '{0}_{1}'.format(lang, name))
+
+
+def exists(store_dir, lang):
+    return os.path.exists(_path(store_dir, lang, 'topic_descs.json'))
+
+
+def publish(store_dir, lang, titles, topic_model, topic_descs):
+    """Write a topic model as returned by lda_predictive_model.load_topic_model (titles: title -> row) to store_dir.
+
+    Files are written under temporary names and renamed, so processes attaching concurrently never see partial files.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    title_list = list(titles)
+    hashes = hash_titles(title_list)
+    rows = np.fromiter((titles[t] for t in title_list), dtype=np.int32, count=len(title_list))
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    if len(hashes) > 1 and np.any(hashes[1:] == hashes[:-1]):
+        raise ValueError("Title hash collision in {0} topic model.".format(lang))
+    arrays = [('topics.npy', np.ascontiguousarray(topic_model, dtype=np.float32)),
+              ('title_hashes.npy', hashes),
+              ('title_rows.npy', rows[order])]
+    for name, values in arrays:
+        tmp_fn = _path(store_dir, lang, name + '.tmp')
+        with open(tmp_fn, 'wb') as fout:
+            np.save(fout, values)
+        os.replace(tmp_fn, _path(store_dir, lang, name))
+    tmp_fn = _path(store_dir, lang, 'topic_descs.json.tmp')
+    with open(tmp_fn, 'w') as fout:
+        json.dump(topic_descs, fout)
+    os.replace(tmp_fn, _path(store_dir, lang, 'topic_descs.json'))
+
+
+def has_qid_index(store_dir, lang):
+    return os.path.exists(_path(store_dir, lang, 'qid_rows.npy'))
+
+
+def read_qid_titles(qid_to_pid_fn, wiki_dbs):
+    """Get {wiki_db: {int QID: title}} for the given wikis from a qid_to_pid.tsv.gz file."""
+    qid_titles = {wiki_db: {} for wiki_db in wiki_dbs}
+    item_idx = QID_TO_PID_HEADER.index('item_id')
+    wiki_idx = QID_TO_PID_HEADER.index('wiki_db')
+    title_idx = QID_TO_PID_HEADER.index('page_title')
+    with gzip.open(qid_to_pid_fn, 'rt') as fin:
+        assert next(fin).strip().split('\t') == QID_TO_PID_HEADER
+        for line in fin:
+            line = line.strip().split('\t')
+            if line[wiki_idx] in qid_titles:
+                qid_titles[line[wiki_idx]][int(line[item_idx][1:])] = line[title_idx]
+    return qid_titles
+
+
+def publish_qid_index(store_dir, lang, qid_titles):
+    """Add a QID -> row index to a published topic model given {int QID: title} for its wiki.
+
+    Returns the number of QIDs whose title has topics.
+    """
+    titles = TopicStore.attach(store_dir, lang).titles
+    qids = np.fromiter(qid_titles.keys(), dtype=np.int64, count=len(qid_titles))
+    # titles are stored with underscores as in load_topic_model
+    rows = titles.lookup([t.replace(" ", "_") for t in qid_titles.values()])
+    found = rows >= 0
+    qids = qids[found]
+    rows = rows[found].astype(np.int32)
+    order = np.argsort(qids, kind='stable')
+    for name, values in [('qids.npy', qids[order]), ('qid_rows.npy', rows[order])]:
+        tmp_fn = _path(store_dir, lang, name + '.tmp')
+        with open(tmp_fn, 'wb') as fout:
+            np.save(fout, values)
+        os.replace(tmp_fn, _path(store_dir, lang, name))
+    return len(qids)
+
+
+def _lookup_sorted(keys, values, queries):
+    """values for queries in sorted keys (-1 where missing)."""
+    if not len(keys):
+        return np.full(len(queries), -1, dtype=np.int64)
+    idx = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[idx] == queries, values[idx], -1)
+
+
+class TitleIndex:
+    """Read-only title -> row mapping over sorted title hashes (usable like the titles dict of load_topic_model)."""
+
+    def __init__(self, hashes, rows):
+        self.hashes = hashes
+        self.rows = rows
+
+    def lookup(self, titles):
+        """Rows for many titles at once (-1 for titles without topics)."""
+        return self.lookup_hashes(hash_titles(titles))
+
+    def lookup_hashes(self, hashes):
+        return _lookup_sorted(self.hashes, self.rows, hashes)
+
+    def get(self, title, default=None):
+        row = self.lookup([title])[0]
+        return int(row) if row >= 0 else default
+
+    def __contains__(self, title):
+        return self.get(title) is not None
+
+    def __getitem__(self, title):
+        row = self.get(title)
+        if row is None:
+            raise KeyError(title)
+        return row
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class TopicStore:
+    """A published topic model attached zero-copy (memory-mapped, read-only)."""
+
+    def __init__(self, topic_model, titles, topic_descs, qids=None, qid_rows=None):
+        self.topic_model = topic_model
+        self.titles = titles
+        self.topic_descs = topic_descs
+        self.ndims = topic_model.shape[1] if topic_model.ndim == 2 else 0
+        # sorted int QIDs with topics and their rows, if a QID index was published
+        self.qids = qids
+        self.qid_rows = qid_rows
+
+    @classmethod
+    def attach(cls, store_dir, lang):
+        with open(_path(store_dir, lang, 'topic_descs.json'), 'r') as fin:
+            topic_descs = json.load(fin)
+        topic_model = np.load(_path(store_dir, lang, 'topics.npy'), mmap_mode='r')
+        titles = TitleIndex(np.load(_path(store_dir, lang, 'title_hashes.npy'), mmap_mode='r'),
+                            np.load(_path(store_dir, lang, 'title_rows.npy'), mmap_mode='r'))
+        qids = qid_rows = None
+        if has_qid_index(store_dir, lang):
+            qids = np.load(_path(store_dir, lang, 'qids.npy'), mmap_mode='r')
+            qid_rows = np.load(_path(store_dir, lang, 'qid_rows.npy'), mmap_mode='r')
+        return cls(topic_model, titles, topic_descs, qids, qid_rows)
+
+    def qid_lookup(self, qids):
+        """Rows for an array of int QIDs (-1 for QIDs without topics)."""
+        if self.qids is None:
+            raise ValueError("No QID index published for this topic model (see publish_qid_index).")
+        return _lookup_sorted(self.qids, self.qid_rows, np.asarray(qids, dtype=np.int64))
+
+    def vectors(self, titles):
+        """Topic vectors for many titles at once (zeros for titles without topics)."""
+        rows = self.titles.lookup(titles)
+        vectors = np.zeros((len(rows), self.ndims), dtype=np.float32)
+        found = rows >= 0
+        vectors[found] = self.topic_model[rows[found]]
+        return vectors
+
+
+class QidEmbeddings:
+    """Topic vectors keyed by integer QID, concatenated over one or more languages' topic models.
+
+    The first language is primary: an article has an embedding if it has topics there; the other languages' parts are
+    zeros when the article does not exist or has no topics in that language.
+    """
+
+    def __init__(self, langs, stores):
+        self.langs = langs
+        self.stores = stores
+        self.ndims = sum(s.ndims for s in stores)
+        self.topic_descs = ['{0}: {1}'.format(lang, desc) for lang, s in zip(langs, stores) for desc in s.topic_descs]
+
+    @classmethod
+    def attach(cls, store_dir, langs):
+        return cls(langs, [TopicStore.attach(store_dir, lang) for lang in langs])
+
+    def found(self, qids):
+        """Boolean mask of the QIDs with topics in the primary language."""
+        return self.stores[0].qid_lookup(qids) >= 0
+
+    def features(self, qids):
+        """(len(qids) x ndims) float32 matrix of concatenated topic vectors."""
+        qids = np.asarray(qids, dtype=np.int64)
+        features = np.zeros((len(qids), self.ndims), dtype=np.float32)
+        offset = 0
+        for store in self.stores:
+            rows = store.qid_lookup(qids)
+            found = rows >= 0
+            features[found, offset:offset + store.ndims] = store.topic_model[rows[found]]
+            offset += store.ndims
+        return features